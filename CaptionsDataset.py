@@ -1,14 +1,106 @@
+import os
+import json
 import clip
 import torch
-import pickle
 import random
-from typing import Tuple
-from torch.utils.data import Dataset
+import itertools
+import hashlib
+import numpy as np
+from typing import Any, Iterator, List, Optional, Sequence, Tuple
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import Dataset, Sampler
 from transformers import AutoTokenizer
-from utils import parse_entities, padding_captions
+from feature_store import RECORDS_FILE, FeatureStore, features_path, load_features
+from utils import DiscretePromptsCache, parse_entities, padding_captions
 from load_annotations import load_entities_text, load_stopwords
 
 
+def load_tokens_cache(
+    path_of_datasets: str,
+    language_model: str,
+    tokenizer: AutoTokenizer,
+    records: Sequence[List[Any]],
+    with_clip_tokens: bool = True,
+    batch_size: int = 4096,
+) -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    """
+    Tokenizing captions once and memory-mapping the tokens in later runs. The cache lives in tokens_cache/ beside the datasets,
+    in a directory keyed by the name of the tokenizer and the size and modification time of the datasets, so a rewritten dataset
+    builds a new cache without hashing every caption on each startup.
+    Args:
+        path_of_datasets: the path of training datasets
+        language_model: the name of tokenizer
+        tokenizer: the tokenizer of language model
+        records: rows of the datasets with the caption as their second item, only read when building the cache
+        with_clip_tokens: whether to load (building if missing) the clip tokens
+        batch_size: the number of captions tokenized at once when building the cache
+    Return:
+        lm_tokens: (num_tokens, ) int32, tokens of all captions concatenated
+        lm_offsets: (num_captions + 1, ) int64, the tokens of i-th caption are lm_tokens[lm_offsets[i]: lm_offsets[i + 1]]
+        clip_tokens: (num_captions, 77) int32, None if not with_clip_tokens
+    """
+    path = path_of_datasets
+    if os.path.isdir(path):  # a feature store, whose captions are in its records
+        path = os.path.join(path, RECORDS_FILE)
+    stat = os.stat(path)
+    key = [language_model, os.path.realpath(path), stat.st_size, stat.st_mtime_ns]
+    digest = hashlib.sha1(json.dumps(key).encode("utf-8"))
+    name = os.path.basename(os.path.normpath(path_of_datasets))
+    cache_dir = os.path.join(
+        os.path.dirname(os.path.normpath(path_of_datasets)),
+        "tokens_cache",
+        f"{name}-{language_model.replace('/', '_')}-{digest.hexdigest()[:16]}",
+    )
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    def batches_of_captions() -> Iterator[List[str]]:
+        for start in range(0, len(records), batch_size):
+            yield [record[1] for record in records[start : start + batch_size]]
+
+    lm_tokens_path = os.path.join(cache_dir, "lm_tokens.npy")
+    lm_offsets_path = os.path.join(cache_dir, "lm_offsets.npy")
+    if not os.path.exists(lm_offsets_path):
+        print(f"Building tokens cache: {cache_dir}")
+        lm_tokens, lm_lengths = [], []  # one array per batch of captions
+        for captions in batches_of_captions():
+            input_ids = tokenizer(captions)["input_ids"]
+            lm_lengths.append(np.fromiter(map(len, input_ids), dtype=np.int64))
+            lm_tokens.append(
+                np.fromiter(
+                    itertools.chain.from_iterable(input_ids),
+                    dtype=np.int32,
+                    count=int(lm_lengths[-1].sum()),
+                )
+            )
+        lm_offsets = np.zeros(len(records) + 1, dtype=np.int64)
+        np.cumsum(np.concatenate(lm_lengths), out=lm_offsets[1:])
+        lm_tokens = np.concatenate(lm_tokens)
+        # offsets are written last (atomically), their existence marks a complete cache
+        np.save(lm_tokens_path, lm_tokens)
+        np.save(lm_offsets_path + ".tmp.npy", lm_offsets)
+        os.replace(lm_offsets_path + ".tmp.npy", lm_offsets_path)
+
+    clip_tokens = None
+    clip_tokens_path = os.path.join(cache_dir, "clip_tokens.npy")
+    if with_clip_tokens and not os.path.exists(clip_tokens_path):
+        clip_tokens = np.concatenate(
+            [
+                clip.tokenize(captions, truncate=True).numpy().astype(np.int32)
+                for captions in batches_of_captions()
+            ]
+        )
+        np.save(clip_tokens_path + ".tmp.npy", clip_tokens)
+        os.replace(clip_tokens_path + ".tmp.npy", clip_tokens_path)
+
+    # copy-on-write memory maps, shared by the dataloader workers through the page cache
+    lm_tokens = np.load(lm_tokens_path, mmap_mode="c")
+    lm_offsets = np.load(lm_offsets_path, mmap_mode="c")
+    if with_clip_tokens:
+        clip_tokens = np.load(clip_tokens_path, mmap_mode="c")
+    return lm_tokens, lm_offsets, clip_tokens
+
+
 class CaptionsDataset(Dataset):
 
     def __init__(
@@ -38,49 +130,47 @@ class CaptionsDataset(Dataset):
         # [[['baby', 'giraffe', 'wall', 'zoo', 'environment'],
         #   A baby giraffe standing against a wall in a zoo like environment.',
         #   torch.tensor (size = (clip_hidden_size, ))], ...]
-        with open(path_of_datasets, "rb") as infile:  # loading datasets
-            captions_with_entities = pickle.load(infile)
+        # path_of_datasets is either a pickle or a feature store directory (features memory-mapped instead of loaded)
+        path_of_datasets = features_path(path_of_datasets)
+        captions_with_entities = load_features(path_of_datasets)  # loading datasets
+        indices = list(range(len(captions_with_entities)))
 
         # low-data settings
         if args.few_shot_ratio < 1.0:
-            random.shuffle(captions_with_entities)
+            random.shuffle(indices)
             N = len(captions_with_entities) * args.few_shot_ratio
-            captions_with_entities = captions_with_entities[: int(N)]
+            indices = indices[: int(N)]
 
         if debug:  # debug
-            captions_with_entities = captions_with_entities[:500]
-
-        captions_lm_lengths = []
-        self.detected_entities = []
-        self.captions = []
-        self.captions_lm_tokens = []
-        if self.using_clip_features:
-            self.captions_clip_features = []
+            indices = indices[:500]
+
+        # rows of the datasets are only indexed (by self.indices) instead of copied per item, with a feature store
+        # the clip features stay in its memory map and the records hold [entities, caption]
+        if isinstance(captions_with_entities, FeatureStore):
+            self.records = captions_with_entities.records
+            self.captions_clip_features = captions_with_entities.features
         else:
-            self.captions_clip_tokens = []
+            self.records = captions_with_entities
+            self.captions_clip_features = None
 
-        for caption_with_entities in captions_with_entities:
-            if self.using_clip_features:
-                temp_detected_entities, temp_caption, temp_clip_features = (
-                    caption_with_entities
-                )
-                self.captions_clip_features.append(
-                    temp_clip_features
-                )  # dtype = float16, size = (clip_hidden_size, )
-            else:
-                temp_detected_entities, temp_caption = caption_with_entities
-                self.captions_clip_tokens.append(
-                    clip.tokenize(temp_caption, truncate=True).squeeze(dim=0)
-                )  # dtype = int32, size = (77, )
-            self.captions.append(temp_caption)
-            self.detected_entities.append(temp_detected_entities[:max_num_of_entities])
-
-            # captions_lm_tokens are used for auto-regressive training, while captions_clip_tokens are accounted as image features during text-only training
-            self.captions_lm_tokens.append(
-                torch.tensor(tokenizer.encode(temp_caption), dtype=torch.int64)
-            )  # dtype = int64, size = (n_seq,)
-            captions_lm_lengths.append(len(self.captions_lm_tokens[-1]))
+        # tokens of all captions are loaded from (or built into) a cache keyed by the tokenizer and the datasets file
+        # (num_tokens, ) int32, (num_captions + 1, ) int64, (num_captions, 77) int32
+        self.captions_lm_tokens, self.captions_lm_offsets, self.captions_clip_tokens = (
+            load_tokens_cache(
+                path_of_datasets,
+                language_model,
+                tokenizer,
+                self.records,
+                with_clip_tokens=not self.using_clip_features,
+            )
+        )
 
+        # item -> row of the caption in the datasets and cache
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.max_num_of_entities = max_num_of_entities
+
+        # captions_lm_tokens are used for auto-regressive training, while captions_clip_tokens are accounted as image features during text-only training
+        captions_lm_lengths = np.diff(self.captions_lm_offsets)[self.indices]
         self.captions_lm_lengths = torch.tensor(
             captions_lm_lengths, dtype=torch.float32
         )
@@ -90,30 +180,39 @@ class CaptionsDataset(Dataset):
         )
         self.args = args
         self.tokenizer = tokenizer
-        self.stopwords = load_stopwords()
-
-        self.people_vocabs = [
-            "people",
-            "person",
-            "man",
-            "men",
-            "woman",
-            "women",
-            "adult",
-            "boy",
-            "girl",
-            "kid",
-            "children",
-            "child",
-            "baby",
-            "guy",
-            "player",
-            "male",
-            "female",
-            "worker",
-        ]
+        self.prompts_cache = DiscretePromptsCache(
+            tokenizer
+        )  # tokens of hard prompts assembled from cached entity tokens
+        # vocabularies are frozensets, membership is tested for every entity of every sample
+        self.stopwords = load_stopwords(as_set=True)
+
+        self.people_vocabs = frozenset(
+            [
+                "people",
+                "person",
+                "man",
+                "men",
+                "woman",
+                "women",
+                "adult",
+                "boy",
+                "girl",
+                "kid",
+                "children",
+                "child",
+                "baby",
+                "guy",
+                "player",
+                "male",
+                "female",
+                "worker",
+            ]
+        )
         self.objects_vocabs = load_entities_text(
-            args.name_of_objects_vocabs, args.path_of_objects_vocabs, all_entities=False
+            args.name_of_objects_vocabs,
+            args.path_of_objects_vocabs,
+            all_entities=False,
+            as_set=True,
         )
         print(
             "Dataset Loading: {} successful. Max sentence length: {}".format(
@@ -123,27 +222,24 @@ class CaptionsDataset(Dataset):
 
     def __len__(self) -> int:
         # return the size of this dataset
-        return len(self.captions)
+        return len(self.indices)
 
     def pad_tokens(self, item: int) -> Tuple[torch.Tensor, ...]:
         """
         Return:
-            tokens: tensor with a shape of (n_seq, ), padding 0 or truncating caption tokens to n_seq
+            tokens: tensor with a shape of (n_seq, ), caption tokens truncated to max_length_per_caption
+                    (padding to the longest caption of a batch is left to collate)
             mask: tensor with a shape of (n_seq, ), valid texts for attention computing
         """
-        tokens = self.captions_lm_tokens[item]  # caption tokens
-        padding = self.max_length_per_caption - len(tokens)
-        tokens = tokens[
-            : self.max_length_per_caption
-        ]  # truncating tokens to max_seq_len
-        if padding > 0:  # padding 0 to max_seq_len
-            tokens = torch.cat((tokens, torch.zeros(padding, dtype=torch.int64) - 1))
-
-        mask = tokens.ge(0)
-        tokens[~mask] = (
-            0  # when calculating loss, the position where idx = 0 should be ignored
-        )
-        mask = mask.float()
+        row = self.indices[item]
+        start = self.captions_lm_offsets[row]
+        end = min(
+            self.captions_lm_offsets[row + 1], start + self.max_length_per_caption
+        )  # truncating tokens to max_seq_len
+        tokens = torch.from_numpy(
+            self.captions_lm_tokens[start:end].astype(np.int64)
+        )  # caption tokens
+        mask = torch.ones(len(tokens), dtype=torch.float32)
 
         return tokens, mask
 
@@ -157,12 +253,17 @@ class CaptionsDataset(Dataset):
         """
         caption_lm_tokens, mask = self.pad_tokens(item)
 
-        if self.using_clip_features:
-            captions_clip = self.captions_clip_features[item]
+        row = self.indices[item]
+        if not self.using_clip_features:
+            # dtype = int32, size = (77, )
+            captions_clip = torch.from_numpy(self.captions_clip_tokens[row])
+        elif self.captions_clip_features is not None:
+            # dtype = float16, size = (clip_hidden_size, ), viewing the memory map
+            captions_clip = torch.from_numpy(self.captions_clip_features[row])
         else:
-            captions_clip = self.captions_clip_tokens[item]
+            captions_clip = self.records[row][2]
 
-        detected_entities = self.detected_entities[item]
+        detected_entities = self.records[row][0][: self.max_num_of_entities]
         masks = mask
         captions_gpt_tokens = caption_lm_tokens
 
@@ -175,22 +276,135 @@ class CaptionsDataset(Dataset):
                 self.stopwords,
                 self.people_vocabs,
                 self.objects_vocabs,
+                self.prompts_cache,
             )[0]
         return self.args, captions_clip, captions_gpt_tokens, masks, discrete_tokens
 
 
-def collate(batch):
+class BucketBatchSampler(Sampler):
+
+    def __init__(
+        self,
+        lengths: torch.Tensor,
+        batch_size: int,
+        drop_last: bool = True,
+        bucket_size: int = 100,
+        shuffle: bool = True,
+    ) -> None:
+        """
+        Batching captions of similar length together, so that padding each batch to its longest caption wastes little computation.
+        Each epoch, the (shuffled) captions are split into buckets of bucket_size batches, sorted by length within a bucket and cut
+        into batches, and the order of batches is shuffled again.
+        Args:
+            lengths: tensor with a shape of (num_captions, ), the length of each caption
+            batch_size: the number of captions per batch
+            drop_last: dropping the last incomplete batch
+            bucket_size: the number of batches in a bucket, a larger bucket gives less padding but less randomness
+            shuffle: shuffling captions and batches each epoch
+        """
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self) -> Iterator[List[int]]:
+        num_of_captions = len(self.lengths)
+        if self.shuffle:
+            indices = torch.randperm(num_of_captions)
+        else:
+            indices = torch.arange(num_of_captions)
+        bucket = self.batch_size * self.bucket_size
+        indices = torch.cat(
+            [
+                indices[start : start + bucket][
+                    self.lengths[indices[start : start + bucket]].argsort(stable=True)
+                ]
+                for start in range(0, num_of_captions, bucket)
+            ]
+        )  # sorting by length within each bucket
+        batches = list(indices[: len(self) * self.batch_size].split(self.batch_size))
+        if not self.drop_last and len(self) * self.batch_size < num_of_captions:
+            batches.append(indices[len(self) * self.batch_size :])
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches))]
+        for batch in batches:
+            yield batch.tolist()
+
+
+class EpochBatches(Dataset):
+
+    def __init__(
+        self, datasets: CaptionsDataset, batches: Sequence[List[int]], seed: int
+    ) -> None:
+        """
+        The batches of an epoch as items, loaded with DataLoader(batch_size = None). The random entity masks of a batch are drawn
+        from a generator seeded with seed + its step, so they are the same whichever worker loads the batch, and when the epoch
+        is resumed from a step.
+        Args:
+            datasets: CaptionsDataset
+            batches: the indices of captions in each batch, in the order of steps
+            seed: the seed of random entity masks in this epoch
+        """
+        self.datasets = datasets
+        self.batches = batches
+        self.seed = seed
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    def __getitem__(self, step: int) -> List[Tuple[torch.Tensor, ...]]:
+        # the state of python random is kept around the batch, the main process draws from it when num_workers = 0
+        state = random.getstate()
+        random.seed(self.seed + step)
+        try:
+            return [self.datasets[item] for item in self.batches[step]]
+        finally:
+            random.setstate(state)
+
+
+def collate(batch, max_length_per_caption: Optional[int] = None):
+    """
+    Padding captions to the longest one in the batch instead of a fixed length, the loss and masks are unchanged
+    since the positions behind each caption are padding anyway.
+    Args:
+        batch: items of CaptionsDataset
+        max_length_per_caption: the length captions are truncated to in datasets, when given, hard prompts + captions
+                                are truncated as if every caption were padded to it (the batch maximum by default)
+    """
     batch_size = len(batch)
     args = batch[0][0]
     _, captions_clip, captions_gpt_tokens, masks, discrete_tokens = zip(*batch)
     captions_clip = torch.stack(captions_clip)
-    captions_gpt_tokens = torch.stack(captions_gpt_tokens, dim=0)
-    masks = torch.stack(masks)
+    captions_lengths = [len(tokens) for tokens in captions_gpt_tokens]
+    captions_gpt_tokens = pad_sequence(
+        captions_gpt_tokens, batch_first=True
+    )  # (b, longest caption in batch)
+    masks = pad_sequence(masks, batch_first=True)
 
     hard_prompts_length = None
     if args.using_hard_prompt:
+        max_length = None
+        if max_length_per_caption is not None:
+            max_length = min(
+                2 * args.max_num_of_entities
+                - 1
+                + args.prompt_template_length
+                + max_length_per_caption,
+                max(
+                    len(tokens) + length
+                    for tokens, length in zip(discrete_tokens, captions_lengths)
+                ),
+            )  # the longest hard prompt + caption in batch
         captions_gpt_tokens, captions_tokens_for_loss, masks, hard_prompts_length = (
-            padding_captions(args, captions_gpt_tokens, masks, discrete_tokens)
+            padding_captions(
+                args, captions_gpt_tokens, masks, discrete_tokens, max_length
+            )
         )
     else:
         captions_gpt_tokens, captions_tokens_for_loss, masks = padding_captions(
@@ -1,8 +1,9 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as nnf
-from typing import Tuple, Optional, List
+from typing import Any, Dict, Tuple, Optional, List, Union
 from transformers import GPT2LMHeadModel
+from utils import pack_sequences
 from dalle2_pytorch.train_configs import TrainDiffusionPriorConfig
 
 
@@ -238,6 +239,22 @@ def get_prior_model(config, weight):
     return prior
 
 
+# checkpoints holding the trainable parameters only, together with the arguments rebuilding the model around the pretrained language model
+TRAINABLE_CHECKPOINT = "trainable_parameters"
+
+
+def is_trainable_checkpoint(checkpoint: Dict[str, Any]) -> bool:
+    return checkpoint.get("format") == TRAINABLE_CHECKPOINT
+
+
+# the state --resume continues training from (see training_state in main.py), its 'model' is what ClipCaptionModel.checkpoint returns
+TRAINING_STATE = "training_state"
+
+
+def is_training_state(checkpoint: Dict[str, Any]) -> bool:
+    return checkpoint.get("format") == TRAINING_STATE
+
+
 class ClipCaptionModel(nn.Module):
 
     def __init__(
@@ -263,6 +280,16 @@ class ClipCaptionModel(nn.Module):
             only_hard_prompt: using the hard prompts only
         """
         super(ClipCaptionModel, self).__init__()
+        self.config = {
+            "continuous_length": continuous_length,
+            "clip_project_length": clip_project_length,
+            "clip_hidden_size": clip_hidden_size,
+            "num_layers": num_layers,
+            "num_heads": num_heads,
+            "gpt_type": gpt_type,
+            "soft_prompt_first": soft_prompt_first,
+            "only_hard_prompt": only_hard_prompt,
+        }
         self.soft_prompt_first = soft_prompt_first
         self.only_hard_prompt = only_hard_prompt
         self.continuous_length = continuous_length
@@ -282,6 +309,81 @@ class ClipCaptionModel(nn.Module):
             "../../../checkpoints/DALLE/prior.pth",
         )
 
+    def trainable_state_dict(self) -> Dict[str, torch.Tensor]:
+        # the parameters optimized in training (see ClipCaptionPrefix.parameters), tied weights are named once
+        trainable = set(id(parameter) for parameter in self.parameters())
+        return {
+            name: parameter.detach()
+            for name, parameter in self.named_parameters()
+            if id(parameter) in trainable
+        }
+
+    def trainable_checkpoint(self) -> Dict[str, Any]:
+        return {
+            "format": TRAINABLE_CHECKPOINT,
+            "model": type(self).__name__,
+            "config": dict(self.config),
+            "state_dict": self.trainable_state_dict(),
+        }
+
+    def checkpoint(self) -> Dict[str, Any]:
+        # what training saves, the full state dict (ClipCaptionPrefix saves its trainable parameters only)
+        return self.state_dict()
+
+    def load_checkpoint(
+        self,
+        checkpoint: Union[str, Dict[str, Any]],
+        map_location: Optional[Union[str, torch.device]] = None,
+        strict: bool = True,
+    ) -> "ClipCaptionModel":
+        """
+        Args:
+            checkpoint: path or content of a full state dict, a trainable checkpoint or a training state (e.g., <prefix>_latest.pt)
+            map_location: used when checkpoint is a path
+            strict: for a full state dict, the same as load_state_dict. The parameters of a trainable checkpoint
+                are always loaded strictly, while the others keep the weights of the pretrained language model (and prior)
+        """
+        if isinstance(checkpoint, str):
+            checkpoint = torch.load(checkpoint, map_location=map_location)
+        if is_training_state(checkpoint):
+            checkpoint = checkpoint["model"]
+        if not is_trainable_checkpoint(checkpoint):
+            self.load_state_dict(checkpoint, strict=strict)
+            return self
+
+        if checkpoint["config"]["gpt_type"] != self.gpt_type:
+            raise ValueError(
+                f"The checkpoint is trained with {checkpoint['config']['gpt_type']} instead of {self.gpt_type}!"
+            )
+        _, unexpected_keys = self.load_state_dict(
+            checkpoint["state_dict"], strict=False
+        )
+        if len(unexpected_keys) > 0:
+            raise RuntimeError(
+                f"Unexpected key(s) in the trainable checkpoint: {unexpected_keys}"
+            )
+        return self
+
+    @classmethod
+    def from_checkpoint(
+        cls,
+        path: str,
+        map_location: Optional[Union[str, torch.device]] = None,
+    ) -> "ClipCaptionModel":
+        # rebuilding the model saved by a trainable checkpoint from the pretrained language model
+        checkpoint = torch.load(path, map_location=map_location)
+        if is_training_state(checkpoint):
+            checkpoint = checkpoint["model"]
+        assert is_trainable_checkpoint(
+            checkpoint
+        ), "A full state dict has no arguments of the model, building the model and calling load_checkpoint instead!"
+        model_class = {
+            "ClipCaptionModel": ClipCaptionModel,
+            "ClipCaptionPrefix": ClipCaptionPrefix,
+        }[checkpoint["model"]]
+        model = model_class(**checkpoint["config"])
+        return model.load_checkpoint(checkpoint)
+
     def word_embed(self, caption_tokens):
         if "gpt" in self.gpt_type:
             caption_embeddings = self.gpt.transformer.wte(
@@ -291,6 +393,69 @@ class ClipCaptionModel(nn.Module):
             caption_embeddings = self.gpt.model.decoder.embed_tokens(caption_tokens)
         return caption_embeddings
 
+    def packed_gpt_forward(
+        self,
+        embeddings: torch.Tensor,
+        mask: torch.Tensor,
+        max_packed_length: int,
+    ) -> torch.Tensor:
+        """
+        Running gpt2 over the samples packed into fewer rows, i.e., several (soft prompt + hard prompt + caption) segments are
+        concatenated in a row, attending only inside their own segment (block-diagonal) with positions restarting from 0 per segment.
+        Args:
+            embeddings: tensor with a shape of (b, n_seq, gpt_hidden_size), the valid positions (mask = 1) of each sample come first
+            mask: tensor with a shape of (b, n_seq), valid texts for attention computing
+            max_packed_length: the maximum length of a packed row
+        Return:
+            logits with a shape of (num_of_tokens, vocab_size) at the valid positions only, in the (row-major) order of mask,
+            i.e., aligned with targets[mask > 0], the same as running each sample alone. The vocabulary projection is never
+            computed for padding
+        """
+        assert "gpt" in self.gpt_type, "Packing is only implemented for gpt2!"
+        device = embeddings.device
+        b = embeddings.shape[0]
+        lengths = mask.sum(dim=-1).long()  # (b, )
+        rows, starts, num_of_rows, packed_length = pack_sequences(
+            lengths.tolist(), max_packed_length
+        )
+        # (num_of_tokens, ): the sample, position in sample, packed row and position in packed row of each valid token
+        samples = torch.repeat_interleave(torch.arange(b, device=device), lengths)
+        positions = torch.arange(len(samples), device=device) - torch.repeat_interleave(
+            lengths.cumsum(dim=0) - lengths, lengths
+        )
+        packed_rows = torch.tensor(rows, device=device)[samples]
+        packed_positions = torch.tensor(starts, device=device)[samples] + positions
+
+        transformer = self.gpt.transformer
+        packed_embeddings = embeddings.new_zeros(
+            (num_of_rows, packed_length, embeddings.shape[-1])
+        )  # (num_of_rows, packed_length, gpt_hidden_size)
+        packed_embeddings[packed_rows, packed_positions] = embeddings[
+            samples, positions
+        ]
+        position_ids = torch.zeros(
+            (num_of_rows, packed_length), dtype=torch.int64, device=device
+        )
+        position_ids[packed_rows, packed_positions] = positions
+        segments = torch.full(
+            (num_of_rows, packed_length), -1, dtype=torch.int64, device=device
+        )  # padding is a segment of -1, attending to itself only
+        segments[packed_rows, packed_positions] = samples
+        # additive mask with a shape of (num_of_rows, 1, packed_length, packed_length), gpt2 applies the causal mask by itself
+        attention_mask = (
+            segments.unsqueeze(dim=2) != segments.unsqueeze(dim=1)
+        ).unsqueeze(dim=1).to(self.gpt.dtype) * torch.finfo(self.gpt.dtype).min
+
+        hidden_states = transformer.drop(
+            packed_embeddings.type(self.gpt.dtype) + transformer.wpe(position_ids)
+        )
+        for block in transformer.h:
+            hidden_states = block(hidden_states, attention_mask=attention_mask)[0]
+        hidden_states = transformer.ln_f(hidden_states)
+
+        # (num_of_tokens, vocab_size), samples and positions enumerate the valid positions in the order of mask
+        return self.gpt.lm_head(hidden_states[packed_rows, packed_positions])
+
     def forward(
         self,
         captions_clip_tokens: torch.Tensor,
@@ -299,6 +464,7 @@ class ClipCaptionModel(nn.Module):
         hard_prompts_length: Optional[List] = None,
         mask: Optional[torch.Tensor] = None,
         use_prior: Optional[bool] = False,
+        max_packed_length: Optional[int] = None,
     ) -> Tuple[torch.Tensor, ...]:
         """
         Args:
@@ -307,6 +473,7 @@ class ClipCaptionModel(nn.Module):
             caption_gpt_tokens: caption tokens with a shape of (b, max_length_per_caption)
             hard_prompts_length: list with len = batch size, the length of hard prompts constructed for each caption
             mask: tensor with a shape of (b, discrete_length + continuous_length + max_length_per_caption), valid texts for attention computing
+            max_packed_length: packing samples into rows of (at most) this length for the language model, None -> without packing
         Return:
             the output of language model
         """
@@ -369,6 +536,18 @@ class ClipCaptionModel(nn.Module):
                 (continuous_embeddings, caption_embeddings), dim=1
             )  # (b, continuous_length + caption_length, gpt_hidden_size)
 
+        if max_packed_length is not None:
+            logits_origin = self.packed_gpt_forward(
+                embeddings_origin, mask, max_packed_length
+            )
+            if use_prior:
+                return (
+                    logits_origin,
+                    self.packed_gpt_forward(embeddings_prior, mask, max_packed_length),
+                    prior_loss,
+                )
+            return logits_origin, 0, prior_loss
+
         out_origin = self.gpt(
             inputs_embeds=embeddings_origin.type(self.gpt.dtype), attention_mask=mask
         )
@@ -389,6 +568,10 @@ class ClipCaptionPrefix(ClipCaptionModel):
     def parameters(self, recurse: bool = True):
         return self.mapping_network.parameters()
 
+    def checkpoint(self) -> Dict[str, Any]:
+        # the mapping network only, the frozen language model (and prior) is rebuilt from its pretrained weights
+        return self.trainable_checkpoint()
+
     def train(self, mode: bool = True):
         super(ClipCaptionPrefix, self).train(mode)
         self.gpt.eval()
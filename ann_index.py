@@ -0,0 +1,373 @@
+import os
+import time
+import torch
+import pickle
+import hashlib
+import argparse
+import numpy as np
+from typing import Dict, List, Tuple
+from retrieval_categories import VocabularyIndex
+
+
+def kmeans(
+    x: np.ndarray,
+    k: int,
+    iterations: int = 20,
+    seed: int = 0,
+    spherical: bool = False,
+    max_training_points: int = 256,
+) -> np.ndarray:
+    """
+    Args:
+        x: (n, d) float32, points to cluster
+        k: the number of centroids
+        iterations: the number of Lloyd iterations
+        seed: the random seed of initialization and sampling
+        spherical: normalizing centroids and assigning points by inner product (for normalized embeddings)
+        max_training_points: training on at most max_training_points * k sampled points
+    Return:
+        centroids with a shape of (k, d), float32
+    """
+    rng = np.random.RandomState(seed)
+    if len(x) > max_training_points * k:
+        x = x[rng.choice(len(x), max_training_points * k, replace=False)]
+    centroids = x[rng.choice(len(x), k, replace=len(x) < k)].copy()
+    for _ in range(iterations):
+        assignments = assign(x, centroids, spherical)
+        counts = np.bincount(assignments, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # re-seeding empty clusters with random points
+        centroids[empty] = x[rng.choice(len(x), int(empty.sum()))]
+        if spherical:
+            centroids /= np.linalg.norm(centroids, axis=-1, keepdims=True) + 1e-12
+    return centroids
+
+
+def assign(
+    x: np.ndarray,
+    centroids: np.ndarray,
+    spherical: bool = False,
+    chunk_size: int = 16384,
+) -> np.ndarray:
+    # Return: (n, ) the nearest centroid of each point, by inner product (spherical) or euclidean distance
+    # argmin |x - c|^2 = argmax x·c - |c|^2 / 2
+    bias = 0.0 if spherical else -0.5 * (centroids**2).sum(axis=-1)
+    assignments = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk_size):
+        scores = x[start : start + chunk_size] @ centroids.T + bias
+        assignments[start : start + chunk_size] = scores.argmax(axis=-1)
+    return assignments
+
+
+class IVFPQVocabularyIndex:
+
+    def __init__(
+        self,
+        texts: List[str],
+        arrays: Dict[str, np.ndarray],
+        nprobe: int = 8,
+        rerank: int = 64,
+    ) -> None:
+        """
+        Approximate category retrieval with an inverted file (IVF) index, optionally scoring candidates with product quantization (PQ).
+        Each query only scores the categories in its nprobe nearest lists, and probabilities are normalized over those candidates,
+        which approximates the softmax over the whole vocabulary as the mass concentrates on the nearest categories (temperature 0.01).
+        Args:
+            texts: name of categories, i.e., ['category1', 'category2', ...]
+            arrays: the index built by IVFPQVocabularyIndex.build (or loaded from its .npz)
+            nprobe: the number of lists scored per query
+            rerank: with pq, the number of best candidates rescored with the exact embeddings
+        """
+        self.texts = texts
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.centroids = arrays["centroids"]  # (nlist, d), float32
+        # (nlist + 1, ), categories of list i are list_ids[list_offsets[i]: list_offsets[i + 1]]
+        self.list_offsets = arrays["list_offsets"]
+        self.list_ids = arrays["list_ids"]  # (num_categories, )
+        # (num_categories, d), float16, normalized embeddings in list order
+        self.vectors = arrays["vectors"]
+        self.codebooks = arrays.get("codebooks")  # (pq_m, 256, d / pq_m), float32
+        self.codes = arrays.get("codes")  # (num_categories, pq_m), uint8, in list order
+        if self.codebooks is not None and self.codebooks.size == 0:
+            self.codebooks, self.codes = None, None
+        self.digest = str(arrays["digest"])
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @staticmethod
+    def build(
+        texts_embeddings: torch.Tensor, nlist: int = 0, pq_m: int = 0, seed: int = 0
+    ) -> Dict[str, np.ndarray]:
+        """
+        Args:
+            texts_embeddings: (num_categories, clip_hidden_size), the output of clip_texts_embeddings
+            nlist: the number of inverted lists, 0 -> 4 * sqrt(num_categories)
+            pq_m: the number of pq sub-quantizers (dividing clip_hidden_size), 0 -> scoring candidates with exact embeddings
+        Return:
+            the arrays of index
+        """
+        vectors = texts_embeddings.float().cpu().numpy()
+        vectors = vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+        nlist = nlist if nlist > 0 else max(1, int(4 * np.sqrt(len(vectors))))
+        nlist = min(nlist, len(vectors))
+        centroids = kmeans(vectors, nlist, seed=seed, spherical=True)
+        assignments = assign(vectors, centroids, spherical=True)
+        list_ids = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=nlist), out=list_offsets[1:])
+        arrays = {
+            "centroids": centroids.astype(np.float32),
+            "list_offsets": list_offsets,
+            "list_ids": list_ids,
+            "vectors": vectors[list_ids].astype(np.float16),
+            "codebooks": np.zeros((0,), dtype=np.float32),
+            "codes": np.zeros((0,), dtype=np.uint8),
+            "digest": np.array(embeddings_digest(texts_embeddings)),
+        }
+        if pq_m > 0:
+            assert (
+                vectors.shape[-1] % pq_m == 0
+            ), "pq_m should divide the dimension of embeddings!"
+            subvectors = vectors[list_ids].reshape(
+                len(vectors), pq_m, -1
+            )  # (num_categories, pq_m, d / pq_m)
+            ksub = min(256, len(vectors))
+            codebooks = np.stack(
+                [kmeans(subvectors[:, j], ksub, seed=seed + j) for j in range(pq_m)]
+            )  # (pq_m, ksub, d / pq_m)
+            codes = np.stack(
+                [assign(subvectors[:, j], codebooks[j]) for j in range(pq_m)], axis=-1
+            )  # (num_categories, pq_m)
+            arrays["codebooks"] = codebooks.astype(np.float32)
+            arrays["codes"] = codes.astype(np.uint8)
+        return arrays
+
+    def search(
+        self, queries: np.ndarray, top_k: int, temperature: float = 0.01
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Args:
+            queries: (num_queries, d), float32, normalized
+        Return:
+            ids: (num_queries, top_k), indices of categories, -1 if fewer than top_k candidates are probed
+            probs: (num_queries, top_k), probability normalized over the candidates, 0 for -1
+        """
+        nprobe = min(self.nprobe, len(self.centroids))
+        coarse_scores = queries @ self.centroids.T  # (num_queries, nlist)
+        probed = np.argpartition(-coarse_scores, nprobe - 1, axis=-1)[:, :nprobe]
+        ids = np.full((len(queries), top_k), -1, dtype=np.int64)
+        probs = np.zeros((len(queries), top_k), dtype=np.float32)
+        for i, query in enumerate(queries):
+            candidates = np.concatenate(
+                [
+                    np.arange(self.list_offsets[l], self.list_offsets[l + 1])
+                    for l in probed[i]
+                ]
+            )  # positions in list order
+            if len(candidates) == 0:
+                continue
+            if self.codes is None:
+                scores = self.vectors[candidates].astype(np.float32) @ query
+            else:  # asymmetric distance computation with a lookup table, then rescoring the best ones exactly
+                table = np.einsum(
+                    "msd,md->ms", self.codebooks, query.reshape(len(self.codebooks), -1)
+                )  # (pq_m, ksub)
+                codes = self.codes[candidates]  # (num_candidates, pq_m)
+                scores = table[np.arange(len(table)), codes].sum(axis=-1)
+                rerank = min(self.rerank, len(scores))
+                best = np.argpartition(-scores, rerank - 1)[:rerank]
+                scores[best] = self.vectors[candidates[best]].astype(np.float32) @ query
+            logits = scores / temperature
+            logits = np.exp(logits - logits.max())
+            k = min(top_k, len(candidates))
+            top = np.argpartition(-logits, k - 1)[:k]
+            top = top[np.argsort(-logits[top], kind="stable")]
+            ids[i, :k] = self.list_ids[candidates[top]]
+            probs[i, :k] = logits[top] / logits.sum()
+        return ids, probs
+
+    @torch.no_grad()
+    def query(
+        self,
+        images_features: torch.Tensor,
+        top_k: int = 5,
+        threshold: float = 0.0,
+        temperature: float = 0.01,
+    ) -> Tuple[torch.Tensor, List[List[str]], torch.Tensor]:
+        """
+        The same interface as VocabularyIndex.query.
+        Return:
+            top_k_ids: (num_images, top_k), indices of the top k categories
+            top_k_texts: [[category1, category2, ...], [], ...], categories with a probability not less than threshold
+            top_k_probs: (num_images, top_k), probability of the top k categories
+        """
+        queries = images_features.float().cpu().numpy()
+        queries = queries / np.linalg.norm(queries, axis=-1, keepdims=True)
+        ids, probs = self.search(queries, top_k, temperature)
+        # stopping at the first probability below threshold (or missing category)
+        keep = np.cumprod((probs >= threshold) & (ids >= 0), axis=-1).astype(bool)
+        top_k_texts = [
+            [self.texts[idx] for idx in ids[i][keep[i]]] for i in range(len(ids))
+        ]
+        return torch.from_numpy(ids), top_k_texts, torch.from_numpy(probs)
+
+
+def embeddings_digest(texts_embeddings: torch.Tensor) -> str:
+    # identifying the embeddings an index is built from, a stale index is rebuilt
+    return hashlib.sha1(texts_embeddings.float().cpu().numpy().tobytes()).hexdigest()
+
+
+def ann_index_path(embeddings_path: str, nlist: int = 0, pq_m: int = 0) -> str:
+    # persisted next to the embeddings pickle, e.g., vgoi_embeddings_ViT-L14_ivf0_pq0.npz
+    return os.path.splitext(embeddings_path)[0] + f"_ivf{nlist}_pq{pq_m}.npz"
+
+
+def load_ann_index(
+    texts: List[str],
+    texts_embeddings: torch.Tensor,
+    embeddings_path: str,
+    nlist: int = 0,
+    pq_m: int = 0,
+    nprobe: int = 8,
+    rerank: int = 64,
+) -> IVFPQVocabularyIndex:
+    """
+    Loading the index persisted next to the embeddings pickle, building (and saving) it if missing or built from other embeddings.
+    """
+    path = ann_index_path(embeddings_path, nlist, pq_m)
+    if os.path.exists(path):
+        arrays = dict(np.load(path))
+        if str(arrays["digest"]) == embeddings_digest(texts_embeddings):
+            return IVFPQVocabularyIndex(texts, arrays, nprobe, rerank)
+    arrays = IVFPQVocabularyIndex.build(texts_embeddings, nlist, pq_m)
+    with open(path + ".tmp", "wb") as outfile:
+        np.savez(outfile, **arrays)
+    os.replace(path + ".tmp", path)
+    return IVFPQVocabularyIndex(texts, arrays, nprobe, rerank)
+
+
+def recall_report(
+    ann_index: IVFPQVocabularyIndex,
+    exact_index: VocabularyIndex,
+    images_features: torch.Tensor,
+    top_k: int = 5,
+    temperature: float = 0.01,
+    nprobes: Tuple[int, ...] = (1, 2, 4, 8, 16, 32),
+) -> List[Dict[str, float]]:
+    """
+    Comparing the approximate top k categories with the exact ones for each nprobe.
+    Return:
+        [{'nprobe': int, 'recall': recall@top_k, 'top1': top 1 agreement, 'prob_error': mean |approximate - exact| top k probability,
+          'ms_per_query': float}, ...], the exact search is reported with nprobe = 0
+    """
+    start = time.time()
+    exact_ids, _, exact_probs = exact_index.query(
+        images_features, top_k, 0.0, temperature
+    )
+    exact_time = time.time() - start
+    exact_ids, exact_probs = exact_ids.cpu().numpy(), exact_probs.cpu().numpy()
+    reports = [
+        {
+            "nprobe": 0,
+            "recall": 1.0,
+            "top1": 1.0,
+            "prob_error": 0.0,
+            "ms_per_query": 1000 * exact_time / len(exact_ids),
+        }
+    ]
+    default_nprobe = ann_index.nprobe
+    for nprobe in nprobes:
+        ann_index.nprobe = nprobe
+        start = time.time()
+        ids, _, probs = ann_index.query(images_features, top_k, 0.0, temperature)
+        elapsed = time.time() - start
+        ids, probs = ids.numpy(), probs.numpy()
+        hits = [len(set(ids[i]) & set(exact_ids[i])) for i in range(len(ids))]
+        reports.append(
+            {
+                "nprobe": nprobe,
+                "recall": float(np.sum(hits) / exact_ids.size),
+                "top1": float(np.mean(ids[:, 0] == exact_ids[:, 0])),
+                "prob_error": float(np.abs(probs - exact_probs).mean()),
+                "ms_per_query": 1000 * elapsed / len(ids),
+            }
+        )
+    ann_index.nprobe = default_nprobe
+    return reports
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--embeddings", required=True, help="pickle written by clip_texts_embeddings"
+    )
+    parser.add_argument(
+        "--queries",
+        default="",
+        help="image features (pickle or feature store), random vocabulary embeddings with noise by default",
+    )
+    parser.add_argument("--num_queries", type=int, default=1000)
+    parser.add_argument(
+        "--nlist", type=int, default=0, help="0 -> 4 * sqrt(num_categories)"
+    )
+    parser.add_argument(
+        "--pq_m",
+        type=int,
+        default=0,
+        help="0 -> scoring candidates with exact embeddings",
+    )
+    parser.add_argument("--top_k", type=int, default=3)
+    parser.add_argument("--temperature", type=float, default=0.01)
+    args = parser.parse_args()
+
+    with open(args.embeddings, "rb") as infile:
+        texts_embeddings = pickle.load(infile)  # (num_categories, clip_hidden_size)
+    texts = [str(i) for i in range(len(texts_embeddings))]
+    if args.queries:
+        from feature_store import load_features
+
+        rows = load_features(args.queries)
+        rows = [rows[i] for i in range(min(args.num_queries, len(rows)))]
+        images_features = torch.stack(
+            [item for row in rows for item in row if isinstance(item, torch.Tensor)]
+        ).float()  # the features of each row, wherever the layout puts them
+    else:
+        generator = torch.Generator().manual_seed(0)
+        samples = torch.randint(
+            len(texts_embeddings), (args.num_queries,), generator=generator
+        )
+        images_features = torch.nn.functional.normalize(
+            texts_embeddings[samples].float(), dim=-1
+        )
+        images_features = images_features + 0.05 * torch.randn(
+            images_features.shape, generator=generator
+        )
+
+    start = time.time()
+    ann_index = load_ann_index(
+        texts, texts_embeddings, args.embeddings, args.nlist, args.pq_m
+    )
+    print(
+        f"index of {len(texts)} categories, {len(ann_index.centroids)} lists, pq_m = {args.pq_m}, ready in {time.time() - start:.1f}s"
+    )
+    exact_index = VocabularyIndex(texts, texts_embeddings)
+    for report in recall_report(
+        ann_index, exact_index, images_features, args.top_k, args.temperature
+    ):
+        print(
+            "nprobe {:>3} ({}): recall@{} {:.4f}, top1 {:.4f}, prob error {:.5f}, {:.3f} ms/query".format(
+                report["nprobe"],
+                "exact" if report["nprobe"] == 0 else "ann",
+                args.top_k,
+                report["recall"],
+                report["top1"],
+                report["prob_error"],
+                report["ms_per_query"],
+            )
+        )
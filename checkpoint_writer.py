@@ -0,0 +1,113 @@
+import os
+import re
+import torch
+import threading
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def snapshot_to_cpu(obj: Any, memo: Optional[Dict[int, torch.Tensor]] = None) -> Any:
+    # copying every tensor of a (nested) checkpoint to cpu, so training can keep updating the originals while it is written,
+    # a tensor appearing several times (memo, by id) is copied once
+    memo = {} if memo is None else memo
+    if isinstance(obj, torch.Tensor):
+        if id(obj) not in memo:
+            memo[id(obj)] = obj.detach().to("cpu", copy=True)
+        return memo[id(obj)]
+    if isinstance(obj, dict):
+        return type(obj)(
+            (key, snapshot_to_cpu(value, memo)) for key, value in obj.items()
+        )
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(value, memo) for value in obj)
+    return obj
+
+
+def existing_checkpoints(directory: Optional[str], pattern: Optional[str]) -> List[str]:
+    # Return: paths of the files in directory fully matching pattern, sorted by the integer of its first group
+    if directory is None or pattern is None or not os.path.isdir(directory):
+        return []
+    orders = {}
+    for name in os.listdir(directory):
+        match = re.fullmatch(pattern, name)
+        if match is not None:
+            orders[os.path.join(directory, name)] = int(match.group(1))
+    return sorted(orders, key=orders.get)
+
+
+class CheckpointWriter:
+
+    def __init__(
+        self,
+        keep_last: int = 0,
+        directory: Optional[str] = None,
+        pattern: Optional[str] = None,
+    ) -> None:
+        """
+        Writing checkpoints in a background thread instead of stalling the training loop on torch.save.
+        A checkpoint is snapshotted to cpu memory when saved, written to a temporary file and renamed atomically,
+        so a crash never leaves a truncated checkpoint behind. At most one save is in flight: saving again waits for the previous one.
+        Args:
+            keep_last: the number of rotated checkpoints kept on disk, the oldest ones are removed, 0 -> keeping all
+            directory: the directory of rotated checkpoints, whose existing ones (e.g., of a resumed run) are rotated as well
+            pattern: regex matching the file names of rotated checkpoints in directory, its first group orders them, e.g., epoch
+        """
+        self.keep_last = keep_last
+        self.rotated = deque(existing_checkpoints(directory, pattern))
+        self.thread: Optional[threading.Thread] = None
+        self.error: Optional[BaseException] = None
+
+    def save(self, checkpoint: Any, path: str, rotate: bool = False) -> None:
+        """
+        Args:
+            checkpoint: anything torch.save takes, e.g., model.checkpoint()
+            path: the path of the checkpoint, overwritten if existing
+            rotate: counting this checkpoint in the rotation, e.g., per epoch checkpoints but not the latest one
+        """
+        self.save_all([(checkpoint, path, rotate)])
+
+    def save_all(self, checkpoints: List[Tuple[Any, str, bool]]) -> None:
+        """
+        Saving several checkpoints in one background job, written in order, tensors shared by them are snapshotted once.
+        Args:
+            checkpoints: [(checkpoint, path, rotate), ...], the same as the arguments of save
+        """
+        self.flush()
+        memo = {}
+        snapshots = [
+            (snapshot_to_cpu(checkpoint, memo), path, rotate)
+            for checkpoint, path, rotate in checkpoints
+        ]
+        self.thread = threading.Thread(
+            target=self._write, args=(snapshots,), daemon=True
+        )
+        self.thread.start()
+
+    def _write(self, snapshots: List[Tuple[Any, str, bool]]) -> None:
+        try:
+            for snapshot, path, rotate in snapshots:
+                torch.save(snapshot, path + ".tmp")
+                os.replace(path + ".tmp", path)
+                if rotate:
+                    self.rotate(path)
+        except BaseException as error:
+            # raised on the training thread by the next save or flush
+            self.error = error
+
+    def rotate(self, path: str) -> None:
+        if path in self.rotated:
+            self.rotated.remove(path)
+        self.rotated.append(path)
+        while self.keep_last > 0 and len(self.rotated) > self.keep_last:
+            stale = self.rotated.popleft()
+            if os.path.exists(stale):
+                os.remove(stale)
+
+    def flush(self) -> None:
+        # waiting for the save in flight, e.g., before saving again and at the end of training
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
@@ -0,0 +1,213 @@
+import os
+import json
+import torch
+import pickle
+import hashlib
+import argparse
+from typing import List, Optional, Tuple
+from load_annotations import ENTITIES_ANNOTATIONS, load_entities_text
+from retrieval_categories import VocabularyIndex, clip_texts_embeddings
+from generating_prompt_ensemble import (
+    DEFAULT_PROMPT_TEMPLATES,
+    generate_ensemble_prompt_embeddings,
+)
+
+
+def cache_key(*parts) -> str:
+    # content address of json serializable parts, e.g., (entities, prompt_templates, clip_type, dtype)
+    return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+def save_atomically(obj, path: str) -> None:
+    # never leaving a truncated pickle behind for the next run to trust
+    with open(path + ".tmp", "wb") as outfile:
+        pickle.dump(obj, outfile)
+    os.replace(path + ".tmp", path)
+
+
+class EmbeddingsCache:
+
+    def __init__(
+        self,
+        cache_dir: str,
+        clip_type: str,
+        prompt_templates: Optional[List[str]] = None,
+        dtype: torch.dtype = torch.float32,
+        device: str = "cpu",
+        batch_size: int = 256,
+    ) -> None:
+        """
+        Embeddings of entities addressed by what they are computed from instead of a hard-coded path, so a changed vocabulary never
+        reuses stale embeddings. The embedding of each entity is stored once per (prompt templates, clip, dtype), and a vocabulary
+        only computes the entities missing from that store.
+        Args:
+            cache_dir: directory of the cache, created if missing
+            clip_type: clip backbone used, e.g., 'ViT-L/14'
+            prompt_templates: templates ensembled by generate_ensemble_prompt_embeddings, None -> the single prompt of clip_texts_embeddings
+            dtype: dtype of the cached embeddings
+            device: device running clip for the missing entities
+            batch_size: the number of texts encoded together
+        """
+        self.cache_dir = cache_dir
+        self.clip_type = clip_type
+        self.prompt_templates = prompt_templates
+        self.dtype = dtype
+        self.device = device
+        self.batch_size = batch_size
+        self.namespace = cache_key(prompt_templates, clip_type, str(dtype))
+        self.store_path = os.path.join(cache_dir, f"entities_{self.namespace}.pickle")
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, entities: List[str]) -> str:
+        # e.g., ViT-L14_<sha1>.pickle, the ann index of the vocabulary is persisted next to it
+        key = cache_key(
+            list(entities), self.prompt_templates, self.clip_type, str(self.dtype)
+        )
+        return os.path.join(
+            self.cache_dir, f"{self.clip_type.replace('/', '')}_{key}.pickle"
+        )
+
+    def encode(self, entities: List[str]) -> torch.Tensor:
+        # Return: (len(entities), clip_hidden_size), nothing is written by the underlying functions given an empty outpath
+        if self.prompt_templates is None:
+            embeddings = clip_texts_embeddings(
+                entities, "", self.device, self.batch_size, self.clip_type
+            )
+        else:
+            embeddings = generate_ensemble_prompt_embeddings(
+                self.device,
+                self.clip_type,
+                entities,
+                self.prompt_templates,
+                "",
+                self.batch_size,
+            )
+        return embeddings.float().to("cpu").to(self.dtype)
+
+    def load_store(self) -> Tuple[List[str], Optional[torch.Tensor]]:
+        if not os.path.exists(self.store_path):
+            return [], None
+        with open(self.store_path, "rb") as infile:
+            store = pickle.load(infile)
+        return store["texts"], store["embeddings"]
+
+    def __call__(self, entities: List[str]) -> Tuple[torch.Tensor, str]:
+        """
+        Return:
+            embeddings: (len(entities), clip_hidden_size), in the order of entities
+            path: the cache entry of this vocabulary
+        """
+        path = self.path(entities)
+        if os.path.exists(path):
+            with open(path, "rb") as infile:
+                return pickle.load(infile), path
+
+        texts, embeddings = self.load_store()
+        rows = {text: i for i, text in enumerate(texts)}
+        missing = list(
+            dict.fromkeys(entity for entity in entities if entity not in rows)
+        )
+        if len(missing) > 0:
+            print(
+                f"Computing the embeddings of {len(missing)}/{len(entities)} entities missing from {self.store_path}"
+            )
+            missing_embeddings = self.encode(missing)
+            embeddings = (
+                missing_embeddings
+                if embeddings is None
+                else torch.cat((embeddings, missing_embeddings), dim=0)
+            )
+            for text in missing:
+                rows[text] = len(texts)
+                texts.append(text)
+            save_atomically({"texts": texts, "embeddings": embeddings}, self.store_path)
+
+        # (len(entities), clip_hidden_size)
+        vocabulary_embeddings = embeddings[
+            torch.tensor([rows[entity] for entity in entities], dtype=torch.long)
+        ]
+        save_atomically(vocabulary_embeddings, path)
+        return vocabulary_embeddings, path
+
+
+def build_vocabulary(args, device: str) -> Tuple[VocabularyIndex, str]:
+    """
+    Loading the entities vocabulary of the inference and validation scripts, with the flags of add_retrieval_args.
+    Embeddings are addressed by the vocabulary, prompts and clip they are computed from, only missing entities are encoded.
+    Return:
+        vocabulary: the exact index on device, or the approximate (ivf) index of ann_index.py persisted next to the embeddings
+            given args.ann, both answering query()
+        embeddings_path: the cache entry of the vocabulary embeddings
+    """
+    entities_text = load_entities_text(
+        args.name_of_entities_text,
+        ENTITIES_ANNOTATIONS[args.name_of_entities_text],
+        not args.disable_all_entities,
+    )
+    embeddings_cache = EmbeddingsCache(
+        args.embeddings_cache_dir,
+        args.clip_model,
+        DEFAULT_PROMPT_TEMPLATES if args.prompt_ensemble else None,
+        device=device,
+    )
+    texts_embeddings, embeddings_path = embeddings_cache(entities_text)
+    if args.ann:
+        # the ivf (pq) index is only imported for approximate retrieval
+        from ann_index import load_ann_index
+
+        vocabulary = load_ann_index(
+            entities_text,
+            texts_embeddings,
+            embeddings_path,
+            args.ann_nlist,
+            args.ann_pq_m,
+            args.ann_nprobe,
+        )
+    else:
+        vocabulary = VocabularyIndex(entities_text, texts_embeddings, device)
+    return vocabulary, embeddings_path
+
+
+def add_retrieval_args(
+    parser: argparse.ArgumentParser, prompt_ensemble: bool = False
+) -> None:
+    """
+    Adding the flags of build_vocabulary shared by the inference and validation scripts.
+    Args:
+        prompt_ensemble: the default of --prompt_ensemble, validation ensembles prompt templates by default
+    """
+    parser.add_argument(
+        "--ann",
+        action="store_true",
+        default=False,
+        help="retrieving entities with an approximate (ivf) index instead of the exact similarity",
+    )
+    parser.add_argument(
+        "--ann_nlist", type=int, default=0, help="0 -> 4 * sqrt(num_entities)"
+    )
+    parser.add_argument("--ann_nprobe", type=int, default=8)
+    parser.add_argument(
+        "--ann_pq_m",
+        type=int,
+        default=0,
+        help="number of pq sub-quantizers, 0 -> scoring candidates exactly",
+    )
+    parser.add_argument(
+        "--disable_all_entities",
+        action="store_true",
+        default=False,
+        help="whether to use entities with a single word only",
+    )
+    parser.add_argument(
+        "--name_of_entities_text",
+        default="vinvl_vgoi_entities",
+        choices=tuple(ENTITIES_ANNOTATIONS),
+    )
+    parser.add_argument(
+        "--prompt_ensemble", action="store_true", default=prompt_ensemble
+    )
+    parser.add_argument(
+        "--embeddings_cache_dir",
+        default="../../../dataset/annotations/embeddings_cache",
+        help="embeddings of entities cached by vocabulary, prompt templates and clip (and hard prompts retrieved for validation)",
+    )
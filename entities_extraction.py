@@ -1,31 +1,79 @@
 import os
 import nltk
 import pickle
+import argparse
+from tqdm import tqdm
 from typing import List
+from functools import lru_cache
+from multiprocessing import Pool
 from nltk.stem import WordNetLemmatizer
 from load_annotations import load_captions
+from feature_store import load_pickle_frames
 
+lemmatizer = WordNetLemmatizer()
+
+
+@lru_cache(maxsize=None)
+def lemmatize(word: str) -> str:
+    # the vocabulary of nouns is tiny compared with the number of captions, caching the lemma of each word (per process)
+    return lemmatizer.lemmatize(word)
 
-def main(captions: List[str], path: str) -> None:
-    # writing list file, i.e., [[[entity1, entity2,...], caption], ...]
 
-    lemmatizer = WordNetLemmatizer()
-    new_captions = []
-    for caption in captions:
-        detected_entities = []
-        pos_tags = nltk.pos_tag(nltk.word_tokenize(caption))  # [('woman': 'NN'), ...]
-        for entities_with_pos in pos_tags:
-            if entities_with_pos[1] == "NN" or entities_with_pos[1] == "NNS":
-                entity = lemmatizer.lemmatize(entities_with_pos[0].lower().strip())
-                detected_entities.append(entity)
-        detected_entities = list(set(detected_entities))
-        new_captions.append([detected_entities, caption])
+def extract_entities(caption: str) -> List[str]:
+    detected_entities = []
+    pos_tags = nltk.pos_tag(nltk.word_tokenize(caption))  # [('woman': 'NN'), ...]
+    for entities_with_pos in pos_tags:
+        if entities_with_pos[1] == "NN" or entities_with_pos[1] == "NNS":
+            entity = lemmatize(entities_with_pos[0].lower().strip())
+            detected_entities.append(entity)
+    detected_entities = list(set(detected_entities))
+    return detected_entities
 
-    with open(path, "wb") as outfile:
-        pickle.dump(new_captions, outfile)
+
+def extract_chunk(captions: List[str]) -> List[List]:
+    # [caption1, caption2, ...] -> [[[entity1, entity2,...], caption1], ...]
+    return [[extract_entities(caption), caption] for caption in captions]
+
+
+def main(
+    captions: List[str], path: str, num_workers: int = 0, chunk_size: int = 1000
+) -> None:
+    # writing list file, i.e., [[[entity1, entity2,...], caption], ...]
+    # captions are processed in chunks by num_workers processes (in this process when num_workers = 0),
+    # and the results of each chunk are appended to the file as a pickle frame as soon as the chunk is done,
+    # so memory stays bounded by the chunks in flight. load_pickle_frames reads the frames back as a single list
+
+    chunks = (
+        captions[start : start + chunk_size]
+        for start in range(0, len(captions), chunk_size)
+    )
+    progress = tqdm(total=len(captions))
+    # written to a temporary file and renamed, a partial file is never taken as the whole datasets
+    with open(path + ".tmp", "wb") as outfile:
+        if num_workers > 0:
+            with Pool(num_workers) as pool:
+                for results in pool.imap(extract_chunk, chunks):
+                    pickle.dump(results, outfile)
+                    progress.update(len(results))
+        else:
+            for chunk in chunks:
+                pickle.dump(extract_chunk(chunk), outfile)
+                progress.update(len(chunk))
+    os.replace(path + ".tmp", path)
+    progress.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of processes extracting entities, 0 -> extracting in the main process",
+    )
+    parser.add_argument("--chunk_size", type=int, default=1000)
+    args = parser.parse_args()
+
     datasets = ["coco_captions", "flickr30k_captions"]
     captions_path = [
         "../../../dataset/coco/annotations/train_captions.json",
@@ -40,8 +88,7 @@ if __name__ == "__main__":
 
     if os.path.exists(out_path[idx]):
         print("Read!")
-        with open(out_path[idx], "rb") as infile:
-            captions_with_entities = pickle.load(infile)
+        captions_with_entities = load_pickle_frames(out_path[idx])
         print(f"The length of datasets: {len(captions_with_entities)}")
         captions_with_entities = captions_with_entities[:20]
         for caption_with_entities in captions_with_entities:
@@ -50,4 +97,4 @@ if __name__ == "__main__":
     else:
         print("Writing... ...")
         captions = load_captions(datasets[idx], captions_path[idx])
-        main(captions, out_path[idx])
+        main(captions, out_path[idx], args.num_workers, args.chunk_size)
@@ -0,0 +1,286 @@
+import os
+import json
+import torch
+import pickle
+import argparse
+import numpy as np
+from typing import Any, Iterator, List, Optional, Set, Union
+
+# a feature store is a directory holding:
+#   features.bin:   contiguous raw matrix with a shape of (length, dim), opened with np.memmap
+#   records.jsonl:  one json list per row, the row in the original pickle without its feature tensor
+#   meta.json:      {'length': int, 'dim': int, 'dtype': str, 'layout': List[str], 'key': Optional[str]}, layout names the items
+#                   of each row and 'features' marks where the feature tensor is, e.g., ['entities', 'caption', 'features'] for
+#                   text features, key names the hashable item identifying a row (None -> the offset of the row)
+FEATURES_FILE = "features.bin"
+RECORDS_FILE = "records.jsonl"
+META_FILE = "meta.json"
+
+# layouts of the pickles written by texts_features_extraction.py and images_features_extraction.py
+# [[entity1, entity2, ...], caption, features]
+TEXTS_LAYOUT = ["entities", "caption", "features"]
+# [image_id, features, [caption1, ...]]
+IMAGES_LAYOUT = ["image_id", "features", "captions"]
+# [image_id, split, features, [caption1, ...]]
+NOCAPS_LAYOUT = ["image_id", "split", "features", "captions"]
+
+
+class FeatureStore:
+
+    def __init__(self, path: str) -> None:
+        """
+        Read-only access to a feature store, the features are memory-mapped (copy-on-write) instead of loaded,
+        so opening is fast and the pages are shared by all processes reading the same store.
+        Args:
+            path: the directory of the feature store
+        """
+        with open(os.path.join(path, META_FILE), "r") as infile:
+            self.meta = json.load(infile)
+        self.path = path
+        self.layout = self.meta["layout"]
+        self.features_index = self.layout.index("features")
+        if self.meta["length"] > 0:
+            self.features = np.memmap(
+                os.path.join(path, FEATURES_FILE),
+                dtype=self.meta["dtype"],
+                mode="c",
+                shape=(self.meta["length"], self.meta["dim"]),
+            )  # (length, dim)
+        else:  # an empty file cannot be memory-mapped
+            self.features = np.zeros((0, self.meta["dim"]), dtype=self.meta["dtype"])
+        self.records = []
+        with open(os.path.join(path, RECORDS_FILE), "r") as infile:
+            for line in infile:
+                if len(self.records) == self.meta["length"]:
+                    break
+                self.records.append(json.loads(line))
+
+    def __len__(self) -> int:
+        return self.meta["length"]
+
+    def __getitem__(self, item: Union[int, slice]) -> Union[List[Any], List[List[Any]]]:
+        """
+        Return:
+            the row laid out as in the original pickle, the features are a tensor with a shape of (dim, ) viewing the memory map
+        """
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        row = list(self.records[item])
+        row.insert(self.features_index, torch.from_numpy(self.features[item]))
+        return row
+
+    def __iter__(self) -> Iterator[List[Any]]:
+        for i in range(len(self)):
+            yield self[i]
+
+
+class FeatureStoreWriter:
+
+    def __init__(
+        self,
+        path: str,
+        layout: List[str],
+        dim: int,
+        dtype: str = "float16",
+        resume: bool = False,
+        key: Optional[str] = None,
+    ) -> None:
+        """
+        Appending rows to a feature store, the store is readable up to the last flush.
+        Args:
+            path: the directory of the feature store
+            layout: names of the items in each row, 'features' marks the feature tensor
+            dim: the dimension of features
+            dtype: the dtype of features on disk
+            resume: continuing an existing store (rows written after its last flush are dropped) instead of overwriting it
+            key: the item identifying a row, 'image_id' if in layout by default, otherwise rows are identified by their offsets
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        key = key if key is not None else default_key(layout)
+        self.meta = {
+            "length": 0,
+            "dim": dim,
+            "dtype": dtype,
+            "layout": layout,
+            "key": key,
+        }
+        self.keys = []  # the key of each row, e.g., image_id, empty if keyed by offsets
+        features_path = os.path.join(path, FEATURES_FILE)
+        records_path = os.path.join(path, RECORDS_FILE)
+        if resume and os.path.exists(os.path.join(path, META_FILE)):
+            store = FeatureStore(path)
+            assert (
+                store.meta["dim"] == dim
+                and store.layout == layout
+                and store.meta.get("key", default_key(layout)) == key
+            ), f"The existing store {path} does not match the features being written!"
+            self.meta = dict(store.meta, key=key)
+            if key is not None:
+                key_index = record_layout(layout).index(key)
+                self.keys = [record[key_index] for record in store.records]
+            # truncating the partially written tail after the last flush
+            size = len(store) * dim * np.dtype(self.meta["dtype"]).itemsize
+            with open(features_path, "r+b") as outfile:
+                outfile.truncate(size)
+            with open(records_path, "w") as outfile:
+                for record in store.records:
+                    outfile.write(json.dumps(record) + "\n")
+            del store
+        else:
+            open(features_path, "wb").close()
+            open(records_path, "w").close()
+            self._write_meta()
+        self.features_file = open(features_path, "ab")
+        self.records_file = open(records_path, "a")
+
+    def __len__(self) -> int:
+        return self.meta["length"]
+
+    def written_keys(self) -> Set[Any]:
+        # the keys (or offsets) of rows already in the store, used to skip them when resuming
+        if self.meta["key"] is None:
+            return set(range(len(self)))
+        return set(self.keys)
+
+    def write(self, rows: List[List[Any]]) -> None:
+        """
+        Args:
+            rows: rows laid out as self.meta['layout'], the features are tensors or arrays with a shape of (dim, )
+        """
+        features_index = self.meta["layout"].index("features")
+        key = self.meta["key"]
+        key_index = (
+            None if key is None else record_layout(self.meta["layout"]).index(key)
+        )
+        for row in rows:
+            row = list(row)
+            features = row.pop(features_index)
+            if isinstance(features, torch.Tensor):
+                features = features.detach().to("cpu").float().numpy()
+            features = np.asarray(features, dtype=self.meta["dtype"]).reshape(-1)
+            assert (
+                len(features) == self.meta["dim"]
+            ), "Unexpected dimension of features!"
+            self.features_file.write(features.tobytes())
+            self.records_file.write(json.dumps(row) + "\n")
+            if key_index is not None:
+                self.keys.append(row[key_index])
+        self.meta["length"] += len(rows)
+
+    def flush(self) -> None:
+        # the meta file is replaced atomically after the data files are synced, so a crash never exposes partial rows
+        self.features_file.flush()
+        self.records_file.flush()
+        os.fsync(self.features_file.fileno())
+        os.fsync(self.records_file.fileno())
+        self._write_meta()
+
+    def close(self) -> None:
+        self.flush()
+        self.features_file.close()
+        self.records_file.close()
+
+    def _write_meta(self) -> None:
+        temp_path = os.path.join(self.path, META_FILE + ".tmp")
+        with open(temp_path, "w") as outfile:
+            json.dump(self.meta, outfile)
+        os.replace(temp_path, os.path.join(self.path, META_FILE))
+
+    def __enter__(self) -> "FeatureStoreWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def features_path(path: str) -> str:
+    # a missing pickle falls back to the feature store of the same name without '.pickle', e.g., written by texts_features_extraction.py
+    if path.endswith(".pickle") and not os.path.exists(path):
+        store = path[: -len(".pickle")]
+        if os.path.isdir(store):
+            return store
+    return path
+
+
+def load_features(path: str) -> Union[FeatureStore, List[List[Any]]]:
+    """
+    Args:
+        path: either a feature store directory or a pickle file of rows with features (the store named as the pickle if missing)
+    Return:
+        rows with features, i.e., FeatureStore or the list loaded from pickle (both support len() and indexing)
+    """
+    path = features_path(path)
+    if os.path.isdir(path):
+        return FeatureStore(path)
+    return load_pickle_frames(path)
+
+
+def load_pickle_frames(path: str) -> List[Any]:
+    # rows of a pickle file holding one pickled list, or several appended one after another (e.g., a frame per chunk)
+    rows = None
+    with open(path, "rb") as infile:
+        while True:
+            try:
+                frame = pickle.load(infile)
+            except EOFError:
+                return rows if rows is not None else []
+            if rows is None:
+                rows = frame
+            else:
+                rows.extend(frame)
+
+
+def record_layout(layout: List[str]) -> List[str]:
+    # the items of a record, i.e., a row without its features
+    return [name for name in layout if name != "features"]
+
+
+def default_key(layout: List[str]) -> Optional[str]:
+    # image ids identify the rows of image features, captions (lists of entities) are not hashable so texts are keyed by offsets
+    return "image_id" if "image_id" in layout else None
+
+
+def infer_layout(row: List[Any]) -> List[str]:
+    # inferring the layout of a row in the pickles written by this repository
+    if len(row) == 4:
+        return NOCAPS_LAYOUT
+    if isinstance(row[0], str):
+        return IMAGES_LAYOUT
+    return TEXTS_LAYOUT
+
+
+def convert_pickle(
+    inpath: str,
+    outpath: str,
+    layout: Optional[List[str]] = None,
+    dtype: str = "float16",
+) -> FeatureStore:
+    """
+    Converting a pickle of rows with features (e.g., coco_texts_features_ViT-L14.pickle) to a feature store.
+    Args:
+        inpath: path of the pickle
+        outpath: directory of the feature store
+        layout: names of the items in each row, inferred from the first row by default
+        dtype: the dtype of features on disk
+    """
+    rows = load_pickle_frames(inpath)
+    layout = layout if layout is not None else infer_layout(rows[0])
+    dim = rows[0][layout.index("features")].numel()
+    with FeatureStoreWriter(outpath, layout, dim, dtype) as writer:
+        writer.write(rows)
+    return FeatureStore(outpath)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--inpath", required=True, help="pickle of rows with features")
+    parser.add_argument("--outpath", default="", help="directory of the feature store")
+    parser.add_argument("--dtype", default="float16")
+    args = parser.parse_args()
+
+    outpath = args.outpath if args.outpath else os.path.splitext(args.inpath)[0]
+    store = convert_pickle(args.inpath, outpath, dtype=args.dtype)
+    print(f"{args.inpath} -> {outpath}: {len(store)} rows, layout: {store.layout}")
@@ -1,10 +1,45 @@
 import os
 import clip
+import json
 import torch
 import pickle
+import argparse
 from tqdm import tqdm
 from typing import List
 from load_annotations import load_entities_text
+from texts_features_extraction import encode_texts
+
+# prompts from CLIP
+DEFAULT_PROMPT_TEMPLATES = [
+    "itap of a {}.",
+    "a bad photo of the {}.",
+    "a origami {}.",
+    "a photo of the large {}.",
+    "a {} in a video game.",
+    "art of the {}.",
+    "a photo of the small {}.",
+]
+
+
+def load_prompt_templates(path: str) -> List[str]:
+    """
+    Args:
+        path: a json list of templates, or a text file with a template per line (blank lines and lines starting with # are skipped)
+    Return:
+        ['a photo of the {}.', ...], '{}' is replaced with the entity
+    """
+    with open(path, "r") as infile:
+        if path.endswith(".json"):
+            templates = json.load(infile)
+        else:
+            templates = [line.strip() for line in infile]
+            templates = [
+                line for line in templates if line and not line.startswith("#")
+            ]
+    assert all(
+        "{}" in template for template in templates
+    ), "Each prompt template should contain '{}'!"
+    return templates
 
 
 @torch.no_grad()
@@ -14,7 +49,16 @@ def generate_ensemble_prompt_embeddings(
     entities: List[str],
     prompt_templates: List[str],
     outpath: str,
+    batch_size: int = 1024,
+    chunk_size: int = 8192,
 ):
+    """
+    The embedding of an entity is the normalized mean of its normalized embeddings under all templates. Entities x templates
+    are flattened and encoded in large batches sorted by length (chunk_size entities at a time to bound memory),
+    then the embeddings are averaged per entity with a segment reduction.
+    Return:
+        tensor with a shape of (num_entities, clip_hidden_size), in the dtype of clip
+    """
     if os.path.exists(outpath):
         with open(outpath, "rb") as infile:
             embeddings = pickle.load(infile)
@@ -22,42 +66,65 @@ def generate_ensemble_prompt_embeddings(
 
     model, _ = clip.load(clip_type, device)
     model.eval()
+    num_templates = len(prompt_templates)
     embeddings = []
-    for entity in tqdm(entities):
+    progress = tqdm(total=len(entities) * num_templates)
+    for start in range(0, len(entities), chunk_size):
+        chunk = entities[start : start + chunk_size]
         texts = [
-            template.format(entity) for template in prompt_templates
-        ]  # ['a picture of dog', 'photo of a dog', ...]
-        tokens = clip.tokenize(texts).to(device)  # (len_of_template, 77)
-        class_embeddings = model.encode_text(tokens).to(
-            "cpu"
-        )  # (len_of_templates, clip_hidden_size)
-        class_embeddings /= class_embeddings.norm(
-            dim=-1, keepdim=True
-        )  # (len_of_templates, clip_hidden_size)
-        class_embedding = class_embeddings.mean(dim=0)  # (clip_hidden_size, )
-        class_embedding /= class_embedding.norm()  # (clip_hidden_size, )
-        embeddings.append(
-            class_embedding
-        )  # [(clip_hidden_size, ), (clip_hidden_size, ), ...]
-    embeddings = torch.stack(embeddings, dim=0).to("cpu")
+            template.format(entity) for entity in chunk for template in prompt_templates
+        ]  # ['a picture of dog', 'photo of a dog', ..., 'a picture of cat', ...]
+        # (len_of_chunk * len_of_templates, 77)
+        tokens = clip.tokenize(texts, truncate=True)
+        # sorting by length (position of the eot token) to minimize padding in each batch
+        order = tokens.argmax(dim=-1).argsort()
+        texts_embeddings = torch.empty(
+            (len(texts), model.text_projection.shape[-1]), dtype=torch.float32
+        )  # (len_of_chunk * len_of_templates, clip_hidden_size)
+        for i in range(0, len(texts), batch_size):
+            indices = order[i : i + batch_size]
+            texts_embeddings[indices] = (
+                encode_texts(model, tokens[indices].to(device)).float().to("cpu")
+            )
+            progress.update(len(indices))
+        texts_embeddings /= texts_embeddings.norm(dim=-1, keepdim=True)
 
-    with open(outpath, "wb") as outfile:
-        pickle.dump(embeddings, outfile)
+        # segment mean, i.e., the mean of the embeddings under all templates of each entity
+        segments = torch.arange(len(chunk)).repeat_interleave(num_templates)
+        class_embeddings = (
+            torch.zeros((len(chunk), texts_embeddings.shape[-1])).index_add_(
+                0, segments, texts_embeddings
+            )
+            / num_templates
+        )  # (len_of_chunk, clip_hidden_size)
+        class_embeddings /= class_embeddings.norm(dim=-1, keepdim=True)
+        embeddings.append(class_embeddings)
+    progress.close()
+    # (num_entities, clip_hidden_size)
+    embeddings = torch.cat(embeddings, dim=0).to(model.dtype)
+
+    # an empty outpath returns the embeddings only, e.g., for EmbeddingsCache
+    if outpath:
+        with open(outpath, "wb") as outfile:
+            pickle.dump(embeddings, outfile)
     return embeddings
 
 
 if __name__ == "__main__":
 
-    # prompts from CLIP
-    prompt_templates = [
-        "itap of a {}.",
-        "a bad photo of the {}.",
-        "a origami {}.",
-        "a photo of the large {}.",
-        "a {} in a video game.",
-        "art of the {}.",
-        "a photo of the small {}.",
-    ]
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--templates",
+        default="",
+        help="file of prompt templates (json list or a template per line), the templates from CLIP by default",
+    )
+    parser.add_argument("--batch_size", type=int, default=1024)
+    args = parser.parse_args()
+
+    if args.templates:
+        prompt_templates = load_prompt_templates(args.templates)
+    else:
+        prompt_templates = DEFAULT_PROMPT_TEMPLATES
 
     # entities = load_entities_text(
     #     "vinvl_vgoi_entities",
@@ -82,7 +149,7 @@ if __name__ == "__main__":
     # outpath = f'../../../dataset/annotations/visual_genome_embedding_{clip_name}_with_ensemble.pickle'
     # outpath = f'../../../dataset/annotations/open_image_embeddings_{clip_name}_with_ensemble.pickle'
     embeddings = generate_ensemble_prompt_embeddings(
-        device, clip_type, entities, prompt_templates, outpath
+        device, clip_type, entities, prompt_templates, outpath, args.batch_size
     )
 
     print(entities[:10], len(entities))
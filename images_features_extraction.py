@@ -1,59 +1,112 @@
 import json
-import os
+import time
 import clip
-from PIL import Image
-import pickle
 import torch
+import argparse
+from tqdm import tqdm
+from images_prefetcher import prefetch_image_batches
+from feature_store import FeatureStoreWriter, IMAGES_LAYOUT, NOCAPS_LAYOUT
 
 
 @torch.no_grad()
-def main(datasets, encoder, proprecess, annotations, outpath):
-
-    results = []
+def main(
+    datasets,
+    encoder,
+    proprecess,
+    annotations,
+    outpath,
+    device: str = "cuda:0",
+    batch_size: int = 64,
+    num_workers: int = 8,
+    flush_every: int = 20,
+):
+    """
+    Encoding images in batches and appending them to a feature store at outpath, the store is flushed every flush_every batches
+    and images already in the store are skipped, so an interrupted extraction resumes where it stopped.
+    """
     if datasets == "coco" or datasets == "flickr30k":  # coco, flickr30k
         # format = {image_path: [caption1, caption2, ...]} -> [[image_path, image_features, [caption1, caption2, ...]], ...]
         if datasets == "coco":
             rootpath = "../../../dataset/coco/val2014/"
         elif datasets == "flickr30k":
             rootpath = "../../../dataset/flickr30k/flickr30k-images/"
-
-        for image_id in annotations:
-            caption = annotations[image_id]
-            image_path = rootpath + image_id
-            image = proprecess(Image.open(image_path)).unsqueeze(dim=0).to(device)
-            image_features = (
-                encoder.encode_image(image).squeeze(dim=0).to("cpu")
-            )  # clip_hidden_size
-            results.append([image_id, image_features, caption])
+        layout = IMAGES_LAYOUT
+        rows = [[image_id, None, annotations[image_id]] for image_id in annotations]
 
     else:  # nocaps
         # format = [{'split': 'near_domain', 'image_id': '4499.jpg', 'caption': [caption1, caption2, ...]}, ...]
         # format = [[image_path, image_split, image_features, [caption1, captions2, ...]], ...]
         rootpath = "../../../dataset/nocaps/val/"
-        for annotation in annotations:
-            split = annotation["split"]
-            image_id = annotation["image_id"]
-            caption = annotation["caption"]
-            image_path = rootpath + image_id
-            try:
-                image = proprecess(Image.open(image_path)).unsqueeze(dim=0).to(device)
-            except:
-                print(image_id)
-                continue
-            image_features = (
-                encoder.encode_image(image).squeeze(dim=0).to("cpu")
-            )  # clip_hidden_size
-            results.append([image_id, split, image_features, caption])
-
-    with open(outpath, "wb") as outfile:
-        pickle.dump(results, outfile)
+        layout = NOCAPS_LAYOUT
+        rows = [
+            [annotation["image_id"], annotation["split"], None, annotation["caption"]]
+            for annotation in annotations
+        ]
+
+    features_index = layout.index("features")
+    writer = FeatureStoreWriter(outpath, layout, encoder.visual.output_dim, resume=True)
+    encoded = writer.written_keys()
+    rows = {rootpath + row[0]: row for row in rows if row[0] not in encoded}
+    if len(encoded) > 0:
+        print(f"resuming {outpath}: {len(encoded)} images encoded, {len(rows)} left")
+
+    progress = tqdm(total=len(rows), desc=datasets)
+    num_of_encoded = 0
+    start = time.time()
+    batches = prefetch_image_batches(list(rows), proprecess, batch_size, num_workers)
+    for idx, (images_path, images, failures) in enumerate(batches):
+        for image_path, error in failures:
+            print(f"failed to load {image_path}: {error}")
+        if images is not None:
+            images_features = encoder.encode_image(images.to(device)).to(
+                "cpu"
+            )  # (b, clip_hidden_size)
+            results = []
+            for image_path, image_features in zip(images_path, images_features):
+                row = list(rows[image_path])
+                row[features_index] = image_features
+                results.append(row)
+            writer.write(results)
+            num_of_encoded += len(results)
+        if (idx + 1) % flush_every == 0:
+            writer.flush()
+        progress.update(len(images_path) + len(failures))
+        progress.set_postfix(
+            {"images/s": f"{num_of_encoded / (time.time() - start):.1f}"}
+        )
+    progress.close()
+    writer.close()
+    print(
+        f"{num_of_encoded} images encoded in {time.time() - start:.1f}s "
+        f"({num_of_encoded / max(time.time() - start, 1e-6):.1f} images/s), {len(writer)} images in {outpath}"
+    )
 
 
 if __name__ == "__main__":
 
-    device = "cuda:0"
-    # clip_type = "ViT-B/32"
-    clip_type = "ViT-L/14"
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cuda:0")
+    # parser.add_argument("--clip_model", default="ViT-B/32")
+    parser.add_argument("--clip_model", default="ViT-L/14")
+    parser.add_argument(
+        "--datasets",
+        default="nocaps",
+        choices=("nocaps", "val_coco", "test_coco", "val_flickr30k", "test_flickr30k"),
+    )
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument(
+        "--num_workers", type=int, default=8, help="number of image decoding threads"
+    )
+    parser.add_argument(
+        "--flush_every",
+        type=int,
+        default=20,
+        help="flushing the feature store to disk every n batches",
+    )
+    args = parser.parse_args()
+
+    device = args.device
+    clip_type = args.clip_model
     clip_name = clip_type.replace("/", "")
 
     path_nocaps = "../../../dataset/nocaps/nocaps_corpus.json"
@@ -62,48 +115,40 @@ if __name__ == "__main__":
     path_val_flickr30k = "../../../dataset/flickr30k/val_captions.json"
     path_test_flickr30k = "../../../dataset/flickr30k/test_captions.json"
 
-    outpath_nocaps = f"../../../dataset/annotations/nocaps_corpus_{clip_name}.pickle"
-    outpath_val_coco = (
-        f"../../../dataset/coco/annotations/val_captions_{clip_name}.pickle"
-    )
-    outpath_test_coco = (
-        f"../../../dataset/coco/annotations/test_captions_{clip_name}.pickle"
-    )
+    # feature stores are directories named as the former pickles without '.pickle', e.g., nocaps_corpus_ViT-L14
+    outpath_nocaps = f"../../../dataset/annotations/nocaps_corpus_{clip_name}"
+    outpath_val_coco = f"../../../dataset/coco/annotations/val_captions_{clip_name}"
+    outpath_test_coco = f"../../../dataset/coco/annotations/test_captions_{clip_name}"
     outpath_val_flickr30k = (
-        f"../../../dataset/annotations/flickr30k_val_captions_{clip_name}.pickle"
+        f"../../../dataset/annotations/flickr30k_val_captions_{clip_name}"
     )
     outpath_test_flickr30k = (
-        f"../../../dataset/annotations/flickr30k_test_captions_{clip_name}.pickle"
+        f"../../../dataset/annotations/flickr30k_test_captions_{clip_name}"
     )
 
-    # format = [{'split': 'near_domain', 'image_id': '4499.jpg', 'caption': [caption1, caption2, ...]}, ...]
-    # format = [[image_path, image_split, image_features, [caption1, captions2, ...]], ...]
-    with open(path_nocaps, "r") as infile:
-        nocaps = json.load(infile)
-
-    # format = {image_path: [caption1, caption2, ...]} -> [[image_path, image_features, [caption1, caption2, ...]], ...]
-    # with open(path_val_coco, "r") as infile:
-    #     val_coco = json.load(infile)
-    # with open(path_test_coco, "r") as infile:
-    #     test_coco = json.load(infile)
-    # with open(path_val_flickr30k, "r") as infile:
-    #     val_flickr30k = json.load(infile)
-    # with open(path_test_flickr30k, "r") as infile:
-    #     test_flickr30k = json.load(infile)
+    # datasets -> (name of the branch in main, annotations path, output path)
+    # format = [{'split': 'near_domain', 'image_id': '4499.jpg', 'caption': [caption1, caption2, ...]}, ...] for nocaps
+    # format = {image_path: [caption1, caption2, ...]} for coco and flickr30k
+    tasks = {
+        "nocaps": ("nocaps", path_nocaps, outpath_nocaps),
+        "val_coco": ("coco", path_val_coco, outpath_val_coco),
+        "test_coco": ("coco", path_test_coco, outpath_test_coco),
+        "val_flickr30k": ("flickr30k", path_val_flickr30k, outpath_val_flickr30k),
+        "test_flickr30k": ("flickr30k", path_test_flickr30k, outpath_test_flickr30k),
+    }
+    datasets, inpath, outpath = tasks[args.datasets]
+    with open(inpath, "r") as infile:
+        annotations = json.load(infile)
 
     encoder, proprecess = clip.load(clip_type, device)
-
-    if not os.path.exists(outpath_nocaps):
-        main("nocaps", encoder, proprecess, nocaps, outpath_nocaps)
-
-    # if not os.path.exists(outpath_val_coco):
-    #     main("coco", encoder, proprecess, val_coco, outpath_val_coco)
-
-    # if not os.path.exists(outpath_test_coco):
-    #     main("coco", encoder, proprecess, test_coco, outpath_test_coco)
-
-    # if not os.path.exists(outpath_val_flickr30k):
-    #     main("flickr30k", encoder, proprecess, val_flickr30k, outpath_val_flickr30k)
-
-    # if not os.path.exists(outpath_test_flickr30k):
-    #     main("flickr30k", encoder, proprecess, test_flickr30k, outpath_test_flickr30k)
+    main(
+        datasets,
+        encoder,
+        proprecess,
+        annotations,
+        outpath,
+        device=device,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        flush_every=args.flush_every,
+    )
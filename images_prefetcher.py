@@ -0,0 +1,101 @@
+import torch
+from PIL import Image
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Tuple
+
+
+def load_image(image_path: str, preprocess: Callable) -> torch.Tensor:
+    """
+    Args:
+        image_path: the path of a single image
+        preprocess: the image processor of clip, PIL.Image -> (3, H, W)
+    Return:
+        tensor with a shape of (3, H, W)
+    """
+    with Image.open(image_path) as image:
+        return preprocess(image)
+
+
+def prefetch_images(
+    images_path: List[str],
+    preprocess: Callable,
+    num_workers: int = 4,
+    max_prefetch: int = 64,
+) -> Iterator[Tuple[str, Optional[torch.Tensor], Optional[Exception]]]:
+    """
+    Decoding and preprocessing images in a thread pool while the caller is computing, the images are yielded in the input order.
+    Args:
+        images_path: the paths of images, i.e., [image_path1, image_path2, ...]
+        preprocess: the image processor of clip, PIL.Image -> (3, H, W)
+        num_workers: the number of decoding threads, decoding on the calling thread when num_workers = 0
+        max_prefetch: the maximum number of images decoded ahead of the caller (bounding the memory)
+    Return:
+        iterator of (image_path, image, error), image is a tensor with a shape of (3, H, W) and error is None if loaded successfully,
+        otherwise image is None and error is the exception raised when loading this image
+    """
+    if num_workers == 0:
+        for image_path in images_path:
+            try:
+                yield image_path, load_image(image_path, preprocess), None
+            except Exception as error:
+                yield image_path, None, error
+        return
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        paths = iter(images_path)
+        for image_path in paths:  # filling the queue
+            pending.append(
+                (image_path, executor.submit(load_image, image_path, preprocess))
+            )
+            if len(pending) >= max_prefetch:
+                break
+
+        while pending:
+            image_path, future = pending.popleft()
+            next_path = next(paths, None)  # keeping the queue full
+            if next_path is not None:
+                pending.append(
+                    (next_path, executor.submit(load_image, next_path, preprocess))
+                )
+            try:
+                yield image_path, future.result(), None
+            except Exception as error:
+                yield image_path, None, error
+
+
+def prefetch_image_batches(
+    images_path: List[str],
+    preprocess: Callable,
+    batch_size: int = 32,
+    num_workers: int = 4,
+    max_prefetch: Optional[int] = None,
+) -> Iterator[Tuple[List[str], Optional[torch.Tensor], List[Tuple[str, Exception]]]]:
+    """
+    Grouping prefetched images into batches (images failed to load are left out and reported instead).
+    Args:
+        images_path: the paths of images, i.e., [image_path1, image_path2, ...]
+        preprocess: the image processor of clip, PIL.Image -> (3, H, W)
+        batch_size: the number of images per batch
+        num_workers: the number of decoding threads
+        max_prefetch: the maximum number of images decoded ahead of the caller, 2 * batch_size by default
+    Return:
+        iterator of (images_path, images, failures), images is a tensor with a shape of (b, 3, H, W) where b <= batch_size
+        (None when every image in this batch fails), and failures is [(image_path, error), ...]
+    """
+    max_prefetch = max_prefetch if max_prefetch is not None else 2 * batch_size
+    batch_path, batch_images, failures = [], [], []
+    for idx, (image_path, image, error) in enumerate(
+        prefetch_images(images_path, preprocess, num_workers, max_prefetch)
+    ):
+        if error is None:
+            batch_path.append(image_path)
+            batch_images.append(image)
+        else:
+            failures.append((image_path, error))
+
+        if (idx + 1) % batch_size == 0 or idx == len(images_path) - 1:
+            images = torch.stack(batch_images, dim=0) if batch_images else None
+            yield batch_path, images, failures
+            batch_path, batch_images, failures = [], [], []
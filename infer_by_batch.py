@@ -4,124 +4,39 @@ import clip
 import torch
 import argparse
 from tqdm import tqdm
-from PIL import Image
 from ClipCap import ClipCaptionModel
+from images_prefetcher import prefetch_image_batches
 from transformers import AutoTokenizer
-from utils import compose_discrete_prompts
-from load_annotations import load_entities_text
-from search import greedy_search, beam_search, opt_search
-from retrieval_categories import (
-    clip_texts_embeddings,
-    image_text_simiarlity,
-    top_k_categories,
+from utils import (
+    DiscretePromptsCache,
+    compose_discrete_prompts,
+    compose_prefix_embeddings,
 )
+from search import greedy_search, beam_search, opt_search
+from embeddings_cache import add_retrieval_args, build_vocabulary
 
 
 @torch.no_grad()
 def main(args) -> None:
     # initializing
     device = args.device
-    clip_name = args.clip_model.replace("/", "")
     # 适配L14
     clip_hidden_size = 512 if args.is_rn else 768
     # clip_hidden_size = 640 if args.is_rn else 512
 
-    # loading categories vocabulary for objects
-    if args.name_of_entities_text == "visual_genome_entities":
-        entities_text = load_entities_text(
-            args.name_of_entities_text,
-            "../../../dataset/annotations/all_objects_attributes_relationships.pickle",
-            not args.disable_all_entities,
-        )
-        if args.prompt_ensemble:  # loading ensemble embeddings
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/visual_genome_embedding_{clip_name}_with_ensemble.pickle",
-            )
-        else:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/visual_genome_embedding_{clip_name}.pickle",
-            )
-    elif args.name_of_entities_text == "coco_entities":
-        entities_text = load_entities_text(
-            args.name_of_entities_text,
-            "../../../dataset/annotations/coco_categories.json",
-            not args.disable_all_entities,
-        )
-        if args.prompt_ensemble:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/coco_embeddings_{clip_name}_with_ensemble.pickle",
-            )
-        else:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/coco_embeddings_{clip_name}.pickle",
-            )
-    elif args.name_of_entities_text == "open_image_entities":
-        entities_text = load_entities_text(
-            args.name_of_entities_text,
-            "../../../dataset/annotations/oidv7-class-descriptions-boxable.csv",
-            not args.disable_all_entities,
-        )
-        if args.prompt_ensemble:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/open_image_embeddings_{clip_name}_with_ensemble.pickle",
-            )
-        else:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/open_image_embeddings_{clip_name}.pickle",
-            )
-    elif args.name_of_entities_text == "vinvl_vg_entities":
-        entities_text = load_entities_text(
-            args.name_of_entities_text,
-            "../../../dataset/annotations/VG-SGG-dicts-vgoi6-clipped.json",
-            not args.disable_all_entities,
-        )
-        if args.prompt_ensemble:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/vg_embeddings_{clip_name}_with_ensemble.pickle",
-            )
-        else:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/vg_embeddings_{clip_name}.pickle",
-            )
-    elif args.name_of_entities_text == "vinvl_vgoi_entities":
-        entities_text = load_entities_text(
-            args.name_of_entities_text,
-            "../../../dataset/annotations/vgcocooiobjects_v1_class2ind.json",
-            not args.disable_all_entities,
-        )
-        if args.prompt_ensemble:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/vgoi_embeddings_{clip_name}_with_ensemble.pickle",
-            )
-        else:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/vgoi_embeddings_{clip_name}.pickle",
-            )
-    else:
-        print("The entities text should be input correctly!")
-        return
+    # loading categories vocabulary for objects (exact or approximate index)
+    vocabulary, _ = build_vocabulary(args, device)
 
     # loading model
     tokenizer = AutoTokenizer.from_pretrained(args.language_model)
+    prompts_cache = DiscretePromptsCache(tokenizer)
     model = ClipCaptionModel(
         args.continuous_prompt_length,
         args.clip_project_length,
         clip_hidden_size,
         gpt_type=args.language_model,
     )
-    model.load_state_dict(
-        torch.load(args.weight_path, map_location=device), strict=False
-    )
+    model.load_checkpoint(args.weight_path, map_location=device, strict=False)
     model.to(device)
     encoder, preprocess = clip.load(args.clip_model, device=device)
 
@@ -130,75 +45,83 @@ def main(args) -> None:
     images_list = [os.path.join(args.image_path, image) for image in images_list]
 
     predicts = []
-    for _, im_path in tqdm(enumerate(images_list)):
-        try:
-            image = preprocess(Image.open(im_path)).unsqueeze(dim=0).to(device)
-        except:
+    # decoding and preprocessing the next images in background threads while the current batch is computed
+    batches = prefetch_image_batches(
+        images_list, preprocess, args.batch_size, args.num_workers
+    )
+    for images_path, images, failures in tqdm(batches):
+        for im_path, error in failures:
+            print(f"failed to load {im_path}: {error}")
+        if images is None:
             continue
-        image_features = encoder.encode_image(image).float()  # (1, clip_hidden_size)
+        images = images.to(device)  # (b, 3, 224, 224)
+
+        image_features = encoder.encode_image(images).float()  # (b, clip_hidden_size)
         image_features /= image_features.norm(2, dim=-1, keepdim=True)
         continuous_embeddings = model.mapping_network(image_features).view(
             -1, args.continuous_prompt_length, model.gpt_hidden_size
-        )
+        )  # (b, continuous_prompt_length, gpt_hidden_size)
+        discrete_embeddings = None
         if args.using_hard_prompt:
-            logits = image_text_simiarlity(
-                texts_embeddings,
-                temperature=args.temperature,
-                images_features=image_features,
-            )
-            detected_objects, _ = top_k_categories(
-                entities_text, logits, args.top_k, args.threshold
+            _, detected_objects, _ = vocabulary.query(
+                image_features, args.top_k, args.threshold, args.temperature
             )  # List[List[]], [[category1, category2, ...], [], ...]
-            detected_objects = detected_objects[
-                0
-            ]  # infering single image -> List[category1, category2, ...]
-            discrete_tokens = (
-                compose_discrete_prompts(tokenizer, detected_objects)
-                .unsqueeze(dim=0)
-                .to(args.device)
-            )
-            discrete_embeddings = model.word_embed(discrete_tokens)
-            if args.only_hard_prompt:
-                embeddings = discrete_embeddings
-            elif args.soft_prompt_first:
-                embeddings = torch.cat(
-                    (continuous_embeddings, discrete_embeddings), dim=1
-                )
-            else:
-                embeddings = torch.cat(
-                    (discrete_embeddings, continuous_embeddings), dim=1
-                )
-        else:
-            embeddings = continuous_embeddings
+            discrete_tokens = [
+                compose_discrete_prompts(tokenizer, objects, prompts_cache)
+                for objects in detected_objects
+            ]  # [(n_seq1, ), (n_seq2, ), ...]
+            # embedding the hard prompts of the whole batch at once
+            discrete_embeddings = model.word_embed(
+                torch.cat(discrete_tokens).to(device)
+            ).split([len(tokens) for tokens in discrete_tokens])
+        # prefixes with different lengths are left padded and masked
+        embeddings, masks = compose_prefix_embeddings(
+            continuous_embeddings,
+            discrete_embeddings,
+            args.soft_prompt_first,
+            args.only_hard_prompt,
+        )
 
         if "gpt" in args.language_model:
             if not args.using_greedy_search:
-                sentence = beam_search(
+                sentences = beam_search(
                     embeddings=embeddings,
+                    attention_mask=masks,
                     tokenizer=tokenizer,
                     beam_width=args.beam_width,
                     model=model.gpt,
-                )  # List[str]
-                sentence = sentence[0]  # selected top 1
+                )  # List[str] for a single image, List[List[str]] for a batch
+                if len(images_path) == 1:
+                    sentences = [sentences]
+                sentences = [sentence[0] for sentence in sentences]  # selected top 1
             else:
-                sentence = greedy_search(
-                    embeddings=embeddings, tokenizer=tokenizer, model=model.gpt
+                sentences = greedy_search(
+                    embeddings=embeddings,
+                    attention_mask=masks,
+                    tokenizer=tokenizer,
+                    model=model.gpt,
                 )
+                if len(images_path) == 1:
+                    sentences = [sentences]
         else:
-            sentence = opt_search(
-                prompts=args.text_prompt,
-                embeddings=embeddings,
-                tokenizer=tokenizer,
-                beam_width=args.beam_width,
-                model=model.gpt,
-            )
-            sentence = sentence[0]
+            # opt_search does not take padding masks, decoding the unpadded prefix of each image
+            sentences = []
+            for i in range(len(images_path)):
+                sentence = opt_search(
+                    prompts=args.text_prompt,
+                    embeddings=embeddings[i : i + 1, masks[i].bool()],
+                    tokenizer=tokenizer,
+                    beam_width=args.beam_width,
+                    model=model.gpt,
+                )
+                sentences.append(sentence[0])
 
-        _, im_path = os.path.split(im_path)
-        predict = {}
-        predict["image_name"] = im_path
-        predict["prediction"] = sentence
-        predicts.append(predict)
+        for im_path, sentence in zip(images_path, sentences):
+            _, im_path = os.path.split(im_path)
+            predict = {}
+            predict["image_name"] = im_path
+            predict["prediction"] = sentence
+            predicts.append(predict)
 
     outpath = os.path.join(args.image_path, "predictions.json")
     with open(outpath, "w") as outfile:
@@ -216,24 +139,7 @@ if __name__ == "__main__":
     parser.add_argument("--temperature", type=float, default=0.01)
     parser.add_argument("--top_k", type=int, default=3)
     parser.add_argument("--threshold", type=float, default=0.2)
-    parser.add_argument(
-        "--disable_all_entities",
-        action="store_true",
-        default=False,
-        help="whether to use entities with a single word only",
-    )
-    parser.add_argument(
-        "--name_of_entities_text",
-        default="vinvl_vgoi_entities",
-        choices=(
-            "visual_genome_entities",
-            "coco_entities",
-            "open_image_entities",
-            "vinvl_vg_entities",
-            "vinvl_vgoi_entities",
-        ),
-    )
-    parser.add_argument("--prompt_ensemble", action="store_true", default=False)
+    add_retrieval_args(parser)
     parser.add_argument(
         "--weight_path", default="./checkpoints/train_coco/coco_prefix-0014.pt"
     )
@@ -248,6 +154,18 @@ if __name__ == "__main__":
         help="greedy search or beam search",
     )
     parser.add_argument("--beam_width", type=int, default=5, help="width of beam")
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=32,
+        help="number of images encoded and decoded together",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="number of threads decoding images ahead of the model",
+    )
     parser.add_argument("--text_prompt", type=str, default=None)
     args = parser.parse_args()
     print("args: {}\n".format(vars(args)))
@@ -1,112 +1,24 @@
 import clip
 import torch
 import argparse
-from PIL import Image
 from ClipCap import ClipCaptionModel
+from images_prefetcher import load_image
 from transformers import AutoTokenizer
 from utils import compose_discrete_prompts
-from load_annotations import load_entities_text
 from search import greedy_search, beam_search, opt_search
-from retrieval_categories import (
-    clip_texts_embeddings,
-    image_text_simiarlity,
-    top_k_categories,
-)
+from embeddings_cache import add_retrieval_args, build_vocabulary
 
 
 @torch.no_grad()
 def main(args) -> None:
     # initializing
     device = args.device
-    clip_name = args.clip_model.replace("/", "")
     # 适配L14
     clip_hidden_size = 512 if args.is_rn else 768
     # clip_hidden_size = 640 if args.is_rn else 512
 
-    # loading categories vocabulary for objects
-    if args.name_of_entities_text == "visual_genome_entities":
-        entities_text = load_entities_text(
-            args.name_of_entities_text,
-            "../../../dataset/annotations/all_objects_attributes_relationships.pickle",
-            not args.disable_all_entities,
-        )
-        if args.prompt_ensemble:  # loading ensemble embeddings
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/visual_genome_embedding_{clip_name}_with_ensemble.pickle",
-            )
-        else:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/visual_genome_embedding_{clip_name}.pickle",
-            )
-    elif args.name_of_entities_text == "coco_entities":
-        entities_text = load_entities_text(
-            args.name_of_entities_text,
-            "../../../dataset/annotations/coco_categories.json",
-            not args.disable_all_entities,
-        )
-        if args.prompt_ensemble:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/coco_embeddings_{clip_name}_with_ensemble.pickle",
-            )
-        else:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/coco_embeddings_{clip_name}.pickle",
-            )
-    elif args.name_of_entities_text == "open_image_entities":
-        entities_text = load_entities_text(
-            args.name_of_entities_text,
-            "../../../dataset/annotations/oidv7-class-descriptions-boxable.csv",
-            not args.disable_all_entities,
-        )
-        if args.prompt_ensemble:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/open_image_embeddings_{clip_name}_with_ensemble.pickle",
-            )
-        else:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/open_image_embeddings_{clip_name}.pickle",
-            )
-    elif args.name_of_entities_text == "vinvl_vg_entities":
-        entities_text = load_entities_text(
-            args.name_of_entities_text,
-            "../../../dataset/annotations/VG-SGG-dicts-vgoi6-clipped.json",
-            not args.disable_all_entities,
-        )
-        if args.prompt_ensemble:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/vg_embeddings_{clip_name}_with_ensemble.pickle",
-            )
-        else:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/vg_embeddings_{clip_name}.pickle",
-            )
-    elif args.name_of_entities_text == "vinvl_vgoi_entities":
-        entities_text = load_entities_text(
-            args.name_of_entities_text,
-            "../../../dataset/annotations/vgcocooiobjects_v1_class2ind.json",
-            not args.disable_all_entities,
-        )
-        if args.prompt_ensemble:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/vgoi_embeddings_{clip_name}_with_ensemble.pickle",
-            )
-        else:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/vgoi_embeddings_{clip_name}.pickle",
-            )
-    else:
-        print("The entities text should be input correctly!")
-        return
+    # loading categories vocabulary for objects (exact or approximate index)
+    vocabulary, _ = build_vocabulary(args, device)
 
     # loading model
     tokenizer = AutoTokenizer.from_pretrained(args.language_model)
@@ -116,26 +28,19 @@ def main(args) -> None:
         clip_hidden_size,
         gpt_type=args.language_model,
     )
-    model.load_state_dict(
-        torch.load(args.weight_path, map_location=device), strict=False
-    )
+    model.load_checkpoint(args.weight_path, map_location=device, strict=False)
     model.to(device)
     encoder, preprocess = clip.load(args.clip_model, device=device)
 
-    image = preprocess(Image.open(args.image_path)).unsqueeze(dim=0).to(device)
+    image = load_image(args.image_path, preprocess).unsqueeze(dim=0).to(device)
     image_features = encoder.encode_image(image).float()
     image_features /= image_features.norm(2, dim=-1, keepdim=True)
     continuous_embeddings = model.mapping_network(image_features).view(
         -1, args.continuous_prompt_length, model.gpt_hidden_size
     )
     if args.using_hard_prompt:
-        logits = image_text_simiarlity(
-            texts_embeddings,
-            temperature=args.temperature,
-            images_features=image_features,
-        )
-        detected_objects, _ = top_k_categories(
-            entities_text, logits, args.top_k, args.threshold
+        _, detected_objects, _ = vocabulary.query(
+            image_features, args.top_k, args.threshold, args.temperature
         )  # List[List[]], [[category1, category2, ...], [], ...]
         detected_objects = detected_objects[
             0
@@ -193,24 +98,7 @@ if __name__ == "__main__":
     parser.add_argument("--temperature", type=float, default=0.01)
     parser.add_argument("--top_k", type=int, default=3)
     parser.add_argument("--threshold", type=float, default=0.2)
-    parser.add_argument(
-        "--disable_all_entities",
-        action="store_true",
-        default=False,
-        help="whether to use entities with a single word only",
-    )
-    parser.add_argument(
-        "--name_of_entities_text",
-        default="vinvl_vgoi_entities",
-        choices=(
-            "visual_genome_entities",
-            "coco_entities",
-            "open_image_entities",
-            "vinvl_vg_entities",
-            "vinvl_vgoi_entities",
-        ),
-    )
-    parser.add_argument("--prompt_ensemble", action="store_true", default=False)
+    add_retrieval_args(parser)
     parser.add_argument(
         "--weight_path", default="./checkpoints/train_coco/coco_prefix-0014.pt"
     )
@@ -1,7 +1,7 @@
 import json
 import pickle
 import pandas as pd
-from typing import List
+from typing import FrozenSet, List, Union
 
 
 def load_coco_captions(path: str) -> List[str]:
@@ -143,8 +143,8 @@ def load_captions(name_of_datasets: str, path_of_datasets: str) -> List[str]:
     print("The datasets for training fail to load!")
 
 
-def load_stopwords() -> List[str]:
-    # Return: stopwords and punctuations
+def load_stopwords(as_set: bool = False) -> Union[List[str], FrozenSet[str]]:
+    # Return: stopwords and punctuations, sorted list or frozenset (as_set = True) for O(1) membership tests
 
     stopwords = {
         "per",
@@ -596,6 +596,8 @@ def load_stopwords() -> List[str]:
         stopword.lower() for stopword in stopwords_and_punctuations
     ]
     stopwords_and_punctuations.sort()
+    if as_set:
+        return frozenset(stopwords_and_punctuations)
 
     return stopwords_and_punctuations
 
@@ -705,33 +707,53 @@ def load_vinvl_vgoi_entities(path: str, all_entities: bool = True) -> List[str]:
     return entities
 
 
+# annotations each kind of entities text is loaded from, relative to the scripts
+ENTITIES_ANNOTATIONS = {
+    "visual_genome_entities": "../../../dataset/annotations/all_objects_attributes_relationships.pickle",
+    "coco_entities": "../../../dataset/annotations/coco_categories.json",
+    "open_image_entities": "../../../dataset/annotations/oidv7-class-descriptions-boxable.csv",
+    "vinvl_vg_entities": "../../../dataset/annotations/VG-SGG-dicts-vgoi6-clipped.json",
+    "vinvl_vgoi_entities": "../../../dataset/annotations/vgcocooiobjects_v1_class2ind.json",
+}
+
+
 def load_entities_text(
-    name_of_entities: str, path_of_entities: str, all_entities: bool = True
-) -> List[str]:
+    name_of_entities: str,
+    path_of_entities: str,
+    all_entities: bool = True,
+    as_set: bool = False,
+) -> Union[List[str], FrozenSet[str]]:
     """
     Args:
         name_of_entities: specifying the name of entities text
         path_of_entities: specifying the path of entities text
         all_entities: whether to apply all entities text. True denotes using entities including len(entitites.split()) > 1
+        as_set: returning a frozenset for O(1) membership tests instead of the sorted list (whose order indexes the entities embeddings)
     Return:
-        [entity1, entity2, ...]
+        [entity1, entity2, ...] or frozenset({entity1, entity2, ...})
     """
     if name_of_entities == "visual_genome_entities":
-        return load_visual_genome_entities(path_of_entities, all_entities)
+        entities = load_visual_genome_entities(path_of_entities, all_entities)
 
-    if name_of_entities == "coco_entities":
-        return load_coco_entities(path_of_entities, all_entities)
+    elif name_of_entities == "coco_entities":
+        entities = load_coco_entities(path_of_entities, all_entities)
 
-    if name_of_entities == "open_image_entities":
-        return load_open_image_entities(path_of_entities, all_entities)
+    elif name_of_entities == "open_image_entities":
+        entities = load_open_image_entities(path_of_entities, all_entities)
 
-    if name_of_entities == "vinvl_vg_entities":
-        return load_vinvl_vg_entities(path_of_entities, all_entities)
+    elif name_of_entities == "vinvl_vg_entities":
+        entities = load_vinvl_vg_entities(path_of_entities, all_entities)
 
-    if name_of_entities == "vinvl_vgoi_entities":
-        return load_vinvl_vgoi_entities(path_of_entities, all_entities)
+    elif name_of_entities == "vinvl_vgoi_entities":
+        entities = load_vinvl_vgoi_entities(path_of_entities, all_entities)
 
-    print("The entities text fails to load!")
+    else:
+        print("The entities text fails to load!")
+        return None
+
+    if as_set:
+        return frozenset(entities)
+    return entities
 
 
 if __name__ == "__main__":
@@ -1,6 +1,7 @@
 import datetime
 import os
 import sys
+import re
 import clip
 import torch
 import random
@@ -8,11 +9,14 @@ import argparse
 import numpy as np
 from tqdm import tqdm
 import torch.nn.functional as nnf
+from functools import partial
 from utils import noise_injection
-from CaptionsDataset import collate
-from torch.utils.data import DataLoader
+from CaptionsDataset import collate, BucketBatchSampler, EpochBatches
+from typing import Any, Dict, List, Optional
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler
 from CaptionsDataset import CaptionsDataset
-from ClipCap import ClipCaptionModel, ClipCaptionPrefix
+from ClipCap import TRAINING_STATE, ClipCaptionModel, ClipCaptionPrefix
+from checkpoint_writer import CheckpointWriter
 from transformers import AdamW, get_linear_schedule_with_warmup
 
 
@@ -26,6 +30,62 @@ def set_seed(seed: int) -> None:
     torch.backends.cudnn.benchmark = False
 
 
+def get_rng_state() -> Dict[str, Any]:
+    return {
+        "python": random.getstate(),
+        # plain python values instead of an ndarray, loadable by torch.load(weights_only = True) as well
+        "numpy": [
+            value.tolist() if isinstance(value, np.ndarray) else value
+            for value in np.random.get_state()
+        ],
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state: Dict[str, Any]) -> None:
+    random.setstate(state["python"])
+    name, keys, pos, has_gauss, cached_gaussian = state["numpy"]
+    np.random.set_state(
+        (name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian)
+    )
+    torch.set_rng_state(state["torch"])
+    if torch.cuda.is_available() and len(state["cuda"]) > 0:
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def training_state(
+    model: ClipCaptionModel,
+    optimizer: torch.optim.Optimizer,
+    schedular,
+    scaler: torch.cuda.amp.GradScaler,
+    epoch: int,  # the epoch to resume from
+    step: int,  # the number of batches trained in this epoch
+    sampler_seed: Optional[int] = None,  # seed of the data order in this epoch
+    loader_seed: Optional[int] = None,  # seed of the random entity masks in this epoch
+) -> Dict[str, Any]:
+    # everything --resume needs to continue training as if it was never interrupted, the weights are loadable as a checkpoint
+    return {
+        "format": TRAINING_STATE,
+        "model": model.checkpoint(),
+        "optimizer": optimizer.state_dict(),
+        "scheduler": schedular.state_dict(),
+        "scaler": scaler.state_dict(),
+        "rng": get_rng_state(),
+        "epoch": epoch,
+        "step": step,
+        "sampler_seed": sampler_seed,
+        "loader_seed": loader_seed,
+    }
+
+
+def draw_batches(batch_sampler, seed: int) -> List[List[int]]:
+    # the data order of an epoch is a function of its seed, so a training state saves the seed instead of the order
+    with torch.random.fork_rng(devices=[]):
+        torch.manual_seed(seed)
+        return [list(batch) for batch in batch_sampler]
+
+
 def train(
     args,  # parameters used for training
     datasets: CaptionsDataset,  # datasets used for training
@@ -51,23 +111,52 @@ def train(
 
     # method of optimization
     optimizer = AdamW(model.parameters(), lr=args.lr)
-    dataloader = DataLoader(
-        datasets,
-        batch_size=batch_size,
-        shuffle=True,
-        drop_last=True,
-        num_workers=args.num_workers,
-        collate_fn=collate,
-    )
-    tokenizer = dataloader.dataset.tokenizer
+    # each batch is padded to its longest caption only
+    collate_fn = partial(
+        collate, max_length_per_caption=datasets.max_length_per_caption
+    )
+    if args.bucket_size > 0:  # batching captions of similar length
+        batch_sampler = BucketBatchSampler(
+            datasets.captions_lm_lengths,
+            batch_size,
+            drop_last=True,
+            bucket_size=args.bucket_size,
+        )
+    else:  # the same as DataLoader(shuffle = True, drop_last = True)
+        batch_sampler = BatchSampler(RandomSampler(datasets), batch_size, True)
+    tokenizer = datasets.tokenizer
     schedular = get_linear_schedule_with_warmup(
         optimizer,
         num_warmup_steps=warmup_steps,
-        num_training_steps=epochs * len(dataloader),
+        num_training_steps=epochs * len(batch_sampler),
     )
     scaler = torch.cuda.amp.GradScaler(enabled=args.use_amp)
+    # checkpoints are written in background, keeping the last args.keep_checkpoints of epochs (including those already on disk)
+    checkpoint_writer = CheckpointWriter(
+        args.keep_checkpoints, output_dir, re.escape(output_prefix) + r"-00(\d+)\.pt"
+    )
+    # packing several samples into a row of the language model, None -> a row per sample
+    max_packed_length = args.max_packed_length if args.packing else None
+
+    # resuming from the step where the training state was saved, the unseen batches of that epoch are trained in the same order
+    start_epoch, start_step, resumed_seeds = 0, 0, None
+    if args.resume:
+        state = torch.load(args.resume, map_location="cpu")
+        model.load_checkpoint(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        schedular.load_state_dict(state["scheduler"])
+        scaler.load_state_dict(state["scaler"])
+        set_rng_state(state["rng"])
+        start_epoch, start_step = state["epoch"], state["step"]
+        if state["sampler_seed"] is not None:
+            resumed_seeds = state["sampler_seed"], state["loader_seed"]
+        print(f"resuming from {args.resume}, epoch {start_epoch}, step {start_step}")
+        del state
+    # the latest weights are saved within the training state
+    latest_path = os.path.join(output_dir, f"{output_prefix}_latest.pt")
+
     use_prior = args.use_prior
-    for epoch in range(epochs):
+    for epoch in range(start_epoch, epochs):
         if epoch != epochs - 1:
             # 只在第一个epoch使用prior
             use_prior = False
@@ -76,7 +165,24 @@ def train(
         # visualization
         sys.stdout.flush()
         print(f">>> Training epoch {epoch}")
-        progress = tqdm(total=len(dataloader), desc=output_prefix)
+        # the seeds of data order and entity masks are drawn once per epoch and saved with the training state
+        if epoch == start_epoch and resumed_seeds is not None:
+            sampler_seed, loader_seed = resumed_seeds
+            first_step = start_step
+        else:
+            sampler_seed, loader_seed = torch.randint(2**62, (2,)).tolist()
+            first_step = 0
+        batches = draw_batches(batch_sampler, sampler_seed)
+        # a batch per item, the generator keeps the global random state untouched by the workers' base seed
+        dataloader = DataLoader(
+            EpochBatches(datasets, batches, loader_seed),
+            batch_size=None,
+            sampler=range(first_step, len(batches)),
+            num_workers=args.num_workers,
+            collate_fn=collate_fn,
+            generator=torch.Generator().manual_seed(loader_seed),
+        )
+        progress = tqdm(total=len(batches), initial=first_step, desc=output_prefix)
         train_loss_sum = 0
         dis_sum = 0
         # training
@@ -90,7 +196,7 @@ def train(
             # 100, 73
             masks,
             hard_prompts_length,
-        ) in enumerate(dataloader):
+        ) in enumerate(dataloader, start=first_step):
             model.zero_grad()
             if not args.using_clip_features:
                 with torch.no_grad():
@@ -127,6 +233,7 @@ def train(
                         hard_prompts_length,
                         masks,
                         use_prior,
+                        max_packed_length,
                     )
                     # (batch_size, max_length, vocab_size)
                     # logits = outputs.logits
@@ -138,6 +245,7 @@ def train(
                         captions_gpt_tokens,
                         mask=masks,
                         use_prior=use_prior,
+                        max_packed_length=max_packed_length,
                     )
                     # (batch_size, max_length, vocab_size)
                     # logits = outputs.logits
@@ -145,6 +253,9 @@ def train(
             captions_tokens_for_loss = captions_tokens_for_loss.masked_fill(
                 captions_tokens_for_loss == tokenizer.eos_token_id, 0
             )
+            if max_packed_length is not None:
+                # packed logits only cover the valid positions, (num_of_tokens, vocab_size)
+                captions_tokens_for_loss = captions_tokens_for_loss[masks > 0]
 
             # ignore_index = target, value: specifying a target value that is ignored and does not contribute to the input gradient
             loss_origin = nnf.cross_entropy(
@@ -189,7 +300,7 @@ def train(
             progress.update()
             train_loss_sum += loss_origin.item()
             dis_sum += dis_loss
-            log_iters = len(dataloader) // 5 if len(dataloader) > 5 else len(dataloader)
+            log_iters = len(batches) // 5 if len(batches) > 5 else len(batches)
             if (idx + 1) % (log_iters) == 0:
                 print(
                     "epoch {}, iter {}, gpt loss: {}, dis:{}".format(
@@ -198,15 +309,28 @@ def train(
                 )
                 train_loss_sum = 0
                 dis_sum = 0
-                torch.save(
-                    model.state_dict(),
-                    os.path.join(output_dir, f"{output_prefix}_latest.pt"),
-                )
+                if idx + 1 < len(batches):  # the end of epoch is saved below
+                    state = training_state(
+                        model,
+                        optimizer,
+                        schedular,
+                        scaler,
+                        epoch,
+                        idx + 1,
+                        sampler_seed,
+                        loader_seed,
+                    )
+                    checkpoint_writer.save(state, latest_path)
         progress.close()
+        # a single background job per epoch, the epoch checkpoint shares the snapshot of weights with the training state
+        state = training_state(model, optimizer, schedular, scaler, epoch + 1, 0, None)
+        checkpoints = [(state, latest_path, False)]
         if (epoch + 1) % args.save_every == 0 or epoch == epochs - 1:
             ckpt_path = os.path.join(output_dir, f"{output_prefix}-00{epoch}.pt")
-            torch.save(model.state_dict(), ckpt_path)
+            checkpoints.append((state["model"], ckpt_path, True))
             print(f"saving checkpoint to {ckpt_path}")
+        checkpoint_writer.save_all(checkpoints)
+    checkpoint_writer.flush()
 
 
 def main():
@@ -319,6 +443,17 @@ def main():
     parser.add_argument(
         "--prefix", default="coco_prefix", help="prefix name for saved weights"
     )
+    parser.add_argument(
+        "--resume",
+        default="",
+        help="path of a training state (<prefix>_latest.pt) to continue training from, saved as the latest weights and each epoch",
+    )
+    parser.add_argument(
+        "--keep_checkpoints",
+        type=int,
+        default=0,
+        help="number of the latest epoch checkpoints kept on disk, 0 -> keeping all",
+    )
     parser.add_argument(
         "--path_of_datasets",
         default="../../../dataset/annotations/coco_with_entities.pickle",
@@ -356,6 +491,24 @@ def main():
         help="use prior for soft prompt",
     )
     parser.add_argument("--num_workers", type=int, default=0)
+    parser.add_argument(
+        "--bucket_size",
+        type=int,
+        default=0,
+        help="number of batches per bucket for length-bucketed batching (e.g., 100), 0 -> random batches",
+    )
+    parser.add_argument(
+        "--packing",
+        action="store_true",
+        default=False,
+        help="packing several samples into a row of the language model with block-diagonal attention (gpt2 only)",
+    )
+    parser.add_argument(
+        "--max_packed_length",
+        type=int,
+        default=256,
+        help="maximum length of a packed row",
+    )
     parser.add_argument(
         "--use_amp",
         action="store_true",
@@ -412,7 +565,7 @@ def main():
 
     # 加载checkpoint
     if args.checkpoint:
-        model.load_state_dict(torch.load(args.checkpoint))
+        model.load_checkpoint(args.checkpoint)
     train(args, datasets, model, output_dir=args.out_dir, output_prefix=args.prefix)
 
 
@@ -16,7 +16,7 @@ def clip_texts_embeddings(
     """
     Args:
         texts: name of categories, i.e., ['category1', 'category2', ...]
-        outpath: saving embeddings of category texts to outpath. reading it directly if existing
+        outpath: saving embeddings of category texts to outpath. reading it directly if existing, nothing is saved if empty
         device: specifying device used
         batch_size: the number of categories that would be transformed to embeddings per epoch
         clip_type: specifying clip backbone used
@@ -53,8 +53,9 @@ def clip_texts_embeddings(
         else:
             texts_embeddings = torch.cat((texts_embeddings, temp_texts_embeddings), dim = 0)
 
-    with open(outpath, 'wb') as outfile:
-        pickle.dump(texts_embeddings, outfile)
+    if outpath: # an empty outpath returns the embeddings only, e.g., for EmbeddingsCache
+        with open(outpath, 'wb') as outfile:
+            pickle.dump(texts_embeddings, outfile)
 
     return texts_embeddings
 
@@ -95,23 +96,105 @@ def image_text_simiarlity(
     
     return image_to_text_logits
 
+def top_k_categories_ids(
+    logits: torch.Tensor,              # (num_images, num_categories)
+    top_k: Optional[int] = 5,          # choosing top k categories as retrieved category
+    threshold: Optional[float] = 0.0   # probability which is less than threshold will be filtered
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Retrieving the top k categories of a whole batch at once, the categories of all images are returned as a ragged array.
+    Return:
+        ids: (num_retrieved, ), indices of retrieved categories, those of the ith image are ids[offsets[i]: offsets[i + 1]]
+        offsets: (num_images + 1, )
+        top_k_probs: (num_images, top_k), probability of the top k categories (before thresholding)
+        top_k_indices: (num_images, top_k), indices of the top k categories (before thresholding)
+    """
+    top_k_probs, top_k_indices = torch.topk(logits, k = top_k, dim = -1) # (num_images, top_k)
+    keep = (top_k_probs >= threshold).cumprod(dim = -1).bool()            # (num_images, top_k), stopping at the first probability below threshold
+    ids = top_k_indices[keep]                                             # row-major, i.e., grouped by images in order
+    offsets = torch.zeros(len(keep) + 1, dtype = torch.int64, device = keep.device)
+    offsets[1:] = keep.sum(dim = -1).cumsum(dim = 0)
+    return ids, offsets, top_k_probs, top_k_indices
+
 def top_k_categories(
     texts: List[str],                  # ['category1', 'category2', ...], len = num_categories
     logits: torch.Tensor,              # (num_images, num_categories)
     top_k: Optional[int] = 5,          # choosing top k categories as retrieved category
     threshold: Optional[float] = 0.0   # probability which is less than threshold will be filtered
 ) -> Tuple:
-    
-    top_k_probs, top_k_indices = torch.topk(logits, k = top_k, dim = -1) # (num_images, top_k)
-    top_k_texts = []
-    for i in range(len(top_k_probs)):
-        per_image_top_k_probs = top_k_probs[i]            # the ith image top k probability
-        per_image_top_k_indices = top_k_indices[i]        # the ith image top k indices
-        temp_texts = []
-        for j in range(top_k):
-            if per_image_top_k_probs[j] < threshold:
-                break
-            temp_texts.append(texts[per_image_top_k_indices[j]])
-        top_k_texts.append(temp_texts)
-    
-    return top_k_texts, top_k_probs
\ No newline at end of file
+    # Return: [[category1, category2, ...], [], ...], top_k_probs with a shape of (num_images, top_k)
+
+    ids, offsets, top_k_probs, _ = top_k_categories_ids(logits, top_k, threshold)
+    ids, offsets = ids.tolist(), offsets.tolist() # a single transfer for the whole batch
+    top_k_texts = [[texts[idx] for idx in ids[offsets[i]: offsets[i + 1]]] for i in range(len(offsets) - 1)]
+
+    return top_k_texts, top_k_probs
+
+class VocabularyIndex:
+
+    def __init__(
+        self,
+        texts: List[str],
+        texts_embeddings: torch.Tensor,
+        device: Optional[str] = 'cpu',
+        dtype: Optional[torch.dtype] = torch.float32
+    ) -> None:
+        """
+        Normalized embeddings of categories kept on the device, so retrieving categories for a batch of images is a single matmul.
+        Args:
+            texts: name of categories, i.e., ['category1', 'category2', ...]
+            texts_embeddings: (num_categories, clip_hidden_size), the output of clip_texts_embeddings (left untouched)
+            device: device where the embeddings stay and similarity is computed
+            dtype: dtype of the stored embeddings, e.g., torch.float16 halves the memory of a large vocabulary
+        """
+        self.texts = texts
+        self.device = device
+        self.dtype = dtype
+        texts_embeddings = texts_embeddings.to(device = device, dtype = torch.float32)                   # normalizing in float32 before casting
+        self.embeddings = (texts_embeddings / texts_embeddings.norm(dim = -1, keepdim = True)).to(dtype) # (num_categories, clip_hidden_size)
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @torch.no_grad()
+    def similarity(
+        self,
+        images_features: torch.Tensor,
+        temperature: float = 0.01
+    ) -> torch.Tensor:
+        """
+        Args:
+            images_features: (num_images, clip_hidden_size), left untouched
+            temperature: temperature hyperparameter for computing similarity
+        Return:
+            logits with a shape of (num_images, num_categories), float32, the same as image_text_simiarlity
+        """
+        images_features = images_features.to(device = self.device, dtype = torch.float32)
+        images_features = (images_features / images_features.norm(dim = -1, keepdim = True)).to(self.dtype) # (num_images, clip_hidden_size)
+        image_to_text_similarity = torch.matmul(images_features, self.embeddings.transpose(1, 0)).float() / temperature # (num_images, num_categories)
+        return torch.nn.functional.softmax(image_to_text_similarity, dim = -1)
+
+    @torch.no_grad()
+    def query(
+        self,
+        images_features: torch.Tensor,
+        top_k: int = 5,
+        threshold: float = 0.0,
+        temperature: float = 0.01
+    ) -> Tuple[torch.Tensor, List[List[str]], torch.Tensor]:
+        """
+        Args:
+            images_features: (num_images, clip_hidden_size)
+            top_k: choosing top k categories as retrieved category
+            threshold: probability which is less than threshold will be filtered
+            temperature: temperature hyperparameter for computing similarity
+        Return:
+            top_k_ids: (num_images, top_k), indices of the top k categories
+            top_k_texts: [[category1, category2, ...], [], ...], categories with a probability not less than threshold
+            top_k_probs: (num_images, top_k), probability of the top k categories
+        """
+        logits = self.similarity(images_features, temperature)
+        ids, offsets, top_k_probs, top_k_ids = top_k_categories_ids(logits, top_k, threshold)
+        ids, offsets = ids.tolist(), offsets.tolist()
+        top_k_texts = [[self.texts[idx] for idx in ids[offsets[i]: offsets[i + 1]]] for i in range(len(offsets) - 1)]
+        return top_k_ids, top_k_texts, top_k_probs
@@ -3,7 +3,7 @@ import torch
 import numpy as np
 from PIL import Image
 import torch.nn.functional as F
-from typing import Optional, Tuple, List
+from typing import Optional, Tuple, List, Union
 from transformers import GPT2Tokenizer, GPT2LMHeadModel
 
 
@@ -109,18 +109,22 @@ def greedy_search(
     prompts: Optional[str] = None,
     tokens: Optional[torch.Tensor] = None,
     embeddings: Optional[torch.Tensor] = None,
+    attention_mask: Optional[torch.Tensor] = None,
     max_len: int = 64,
     end_of_sentences: List = [".", " ."],
     tokenizer: GPT2Tokenizer = None,
     model: GPT2LMHeadModel = None
-) -> List[str]:
+) -> Union[str, List[str]]:
     """
     Sentence generation through choosing token guided by model confidence.
     Taking text input as prompts, tokens or embeddings, if more than one input a time, priority should follow: embeddings > tokens > prompts.
+    Sentences which have generated the end of sentence are dropped from the active batch (together with their past key values),
+    so that later steps only compute the unfinished ones and the generation stops once all sentences are finished.
     Args:
         prompts: str, prompts for generated sentence
         tokens: tensor with shape of (b, n_seq), device = model.device, dtype = int64
         embeddings: tensor with shape of (b, n_seq, lm_hidden_size), device = model.device, dtype = float16/float32 (from clip encoder/gpt2 encoder)
+        attention_mask: tensor with shape of (b, n_seq), 1 for valid prefix and 0 for padding, prefixes with different lengths should be left padded
         max_len: int, the maximum length of generated sentence (without considering the length of prompts/tokens/embeddings)
         end_of_sentence: str, early stopping once generated word is equal to end_of_sentence
         tokenizer: transforming word/sentence to indice/list and vice versa, i.e., str -> List[int64] or List[int64] -> str
@@ -132,12 +136,13 @@ def greedy_search(
     device = model.device
 
     # tokenizing end of sentence, when the length of eos tokens is greater than 1, setting the first token of eos tokens as eos token
-    eos = [tokenizer.encode(end_of_sentence)[-1] for end_of_sentence in end_of_sentences]
+    eos = torch.tensor([tokenizer.encode(end_of_sentence)[-1] for end_of_sentence in end_of_sentences], device = device)
 
     # prefix should transform into word embeddings so that sentence generation is capable of processing input of prompts, tokens or embeddings unifiedly
     # priority: embeddings > tokens > prompts
     if embeddings is not None:
         generating = embeddings # (b, n_seq, lm_hidden_size)
+        tokens = None           # the prefix is given as embeddings, only generated tokens are decoded
     else:
         if tokens is None:
             tokens = torch.tensor(tokenizer.encode(prompts))  # (n_seq), tokenizing prompts
@@ -147,87 +152,107 @@ def greedy_search(
     generating = generating.float()                           # (b, n_seq, lm_hidden_size)
     assert generating.dim() == 3, 'The dimension of prompts should equal to 3!'
     
-    b = generating.shape[0] 
-    past_key_values = None
+    b, n_seq = generating.shape[:2]
+    if attention_mask is None:
+        attention_mask = torch.ones((b, n_seq), dtype = torch.int64, device = device)
+    attention_mask = attention_mask.to(device = device, dtype = torch.int64)                     # (b, n_seq)
+    # positions are counted from the first valid token so that left padded prefixes share the positions of unpadded ones
+    position_ids = (attention_mask.cumsum(dim = -1) - 1).clamp(min = 0)                        # (b, n_seq)
+
+    # generating initial states of language model
+    outputs = model(inputs_embeds = generating.type(model.dtype), attention_mask = attention_mask, position_ids = position_ids, use_cache = True)
+    next_token_logits = outputs.logits[:, -1, :]   # (b, n_seq, vocal_size) -> (b, vocal_size), logits of the last token
+    past_key_values = outputs.past_key_values      # Tuple[Tuple[(b, h, n_seq, lm_hidden_size/h)]], layers -> (key, value) -> torch.tensor
+    positions = position_ids[:, -1]                # (b), position of the last token
+
+    active = torch.arange(b, device = device)                                    # (b_active), rows of the batch which are still generating
+    generated_tokens = torch.zeros((b, max_len), dtype = torch.int64, device = device)
+    generated_lengths = torch.zeros(b, dtype = torch.int64, device = device)
     for step in range(max_len):
-        # generating initial states of language model
-        if step == 0:
-            outputs = model(inputs_embeds = generating.type(model.dtype), past_key_values = past_key_values, use_cache = True)
-            next_token_logits = outputs.logits[:, -1, :]   # (b, n_seq, vocal_size) -> (b, vocal_size), logits of the last token
-            past_key_values = outputs.past_key_values      # Tuple[Tuple[(b, h, n_seq, lm_hidden_size/h)]], layers -> (key, value) -> torch.tensor
-
-        next_token = torch.argmax(next_token_logits, dim = -1, keepdim = True) # (b, 1)
-        next_embedding = word_embed(model, next_token)                     # (b, 1, lm_hidden_size)
-        # next_embedding = model.transformer.wte(next_token)                     # (b, 1, lm_hidden_size)
-        outputs = model(inputs_embeds = next_embedding.type(model.dtype), past_key_values = past_key_values, use_cache = True)
-        next_token_logits = outputs.logits[:, -1, :]           # (b, 1, vocal_size) -> (b, vocal_size)
-        past_key_values = outputs.past_key_values              # Tuple[Tuple[(b, h, n_seq + 1, lm_hidden_size/h)]]
-
-        # updating tokens
-        if tokens is None:
-            tokens = next_token
-        else:
-            tokens = torch.cat((tokens, next_token), dim = 1)                                                   # (b, n_seq + 1)
+        next_token = torch.argmax(next_token_logits, dim = -1)                   # (b_active)
+        generated_tokens[active, step] = next_token
+        generated_lengths[active] = step + 1
+
+        # dropping the finished rows (and their key-values) from the active batch
+        unfinished = ~torch.isin(next_token, eos)                                # (b_active)
+        if not unfinished.all():
+            keep = unfinished.nonzero(as_tuple = True)[0]
+            if len(keep) == 0:
+                break
+            active = active[keep]
+            next_token = next_token[keep]
+            past_key_values = reorder_past_key_values(past_key_values, keep)
+            attention_mask = attention_mask[keep]
+            positions = positions[keep]
+        if step == max_len - 1:
+            break
 
-        # whether to stop early according to the end of sentence, only working when batch size is equal to 1
-        if b == 1 and next_token.item() in eos:
-            new_tokens = tokens.squeeze(dim = 0).tolist()
-            sentence = tokenizer.decode(new_tokens)
-            return sentence
-        
-    # tokens: (1/b, n_seq + max_len) where n_seq refers to the length of inputs tokens or prompts 
-    # torch.tensor(1/b, n_seq + max_Len) -> str/list[str]
-    sentence = []
+        next_embedding = word_embed(model, next_token.unsqueeze(dim = 1))        # (b_active, 1, lm_hidden_size)
+        # next_embedding = model.transformer.wte(next_token)                     # (b_active, 1, lm_hidden_size)
+        attention_mask = torch.cat((attention_mask, attention_mask.new_ones((len(active), 1))), dim = 1)
+        positions = positions + 1
+        outputs = model(
+            inputs_embeds = next_embedding.type(model.dtype),
+            attention_mask = attention_mask,
+            position_ids = positions.unsqueeze(dim = 1),
+            past_key_values = past_key_values,
+            use_cache = True
+        )
+        next_token_logits = outputs.logits[:, -1, :]           # (b_active, 1, vocal_size) -> (b_active, vocal_size)
+        past_key_values = outputs.past_key_values              # Tuple[Tuple[(b_active, h, n_seq + 1, lm_hidden_size/h)]]
+
+    # generated tokens are kept up to (and including) the end of sentence, and prefixed with the input tokens if given
+    # torch.tensor(b, max_len) -> str/list[str]
+    generated_tokens = generated_tokens.cpu().tolist()
+    generated_lengths = generated_lengths.cpu().tolist()
+    prefix_tokens = tokens.cpu().tolist() if tokens is not None else [[] for _ in range(b)]
+    sentence = [tokenizer.decode(prefix_tokens[i] + generated_tokens[i][:generated_lengths[i]]) for i in range(b)]
     if b == 1:
-        new_tokens = tokens.squeeze(dim = 0).tolist()
-        sentence = tokenizer.decode(new_tokens)
-    else:
-        for temp_tokens in tokens:
-            for i in range(len(temp_tokens)):
-                if temp_tokens[i].item() in eos:
-                    break
-            new_tokens = temp_tokens[:i + 1].tolist()
-            sentence.append(tokenizer.decode(new_tokens))
+        return sentence[0]
     return sentence
 
+@torch.no_grad()
 def beam_search(
     prompts: Optional[str] = None,
     tokens: Optional[torch.Tensor] = None,
     embeddings: Optional[torch.Tensor] = None,
+    attention_mask: Optional[torch.Tensor] = None,
     temperature = 1.0,
     max_len: int = 64,
     beam_width: int = 5,
     end_of_sentences: List = [".", " ."],
     tokenizer: GPT2Tokenizer = None,
     model: GPT2LMHeadModel = None
-) -> List[str]:
+) -> Union[List[str], List[List[str]]]:
     """
     Sentence generation through choosing token guided by model confidence.
     Taking text input as prompts, tokens or embeddings, if more than one input a time, priority should follow: embeddings > tokens > prompts.
+    The prefix is encoded once and the past key values are cached, reordered by the selected beams and extended by one token per step,
+    so that a batch of b prefixes produces b * beam_width hypotheses with a single forward of shape (b * beam_width, 1) each step.
     Args:
         prompts: str, prompts for generated sentence
         tokens: tensor with shape of (b, n_seq), device = model.device, dtype = int64
         embeddings: tensor with shape of (b, n_seq, lm_hidden_size), device = model.device, dtype = float16/float32 (from clip encoder/gpt2 encoder)
+        attention_mask: tensor with shape of (b, n_seq), 1 for valid prefix and 0 for padding, prefixes with different lengths should be left padded
         max_len: int, the maximum length of generated sentence (without considering the length of prompts/tokens/embeddings)
         beam_width: the width of beam
         end_of_sentence: str, early stopping once generated word is equal to end_of_sentence
         tokenizer: transforming word/sentence to indice/list and vice versa, i.e., str -> List[int64] or List[int64] -> str
         model: language model (taking input as either tokens or embeddings)
     Return:
-        list[str] for generated sentence when batch size is greater than 1 (i.e., len(list) = batch_size), and string when batch size is equal to 1 
+        list[str] with beam_width sentences sorted by score when batch size is equal to 1,
+        and list[list[str]] (i.e., len(list) = batch_size, each with beam_width sorted sentences) when batch size is greater than 1
     """
     model.eval()
     device = model.device
 
     # tokenizing end of sentence, when the length of eos tokens is greater than 1, setting the first token of eos tokens as eos token
-    eos = [tokenizer.encode(end_of_sentence)[-1] for end_of_sentence in end_of_sentences]
-    scores = None
-    seq_lengths = torch.ones(beam_width, device = device)
-    is_stopped = torch.zeros(beam_width, device = device, dtype=torch.bool)
+    eos = torch.tensor([tokenizer.encode(end_of_sentence)[-1] for end_of_sentence in end_of_sentences], device = device)
     # prefix should transform into word embeddings so that sentence generation is capable of processing input of prompts, tokens or embeddings unifiedly
     # priority: embeddings > tokens > prompts
     if embeddings is not None:
         generated = embeddings # (b, n_seq, lm_hidden_size)
+        tokens = None          # the prefix is given as embeddings, only generated tokens are decoded
     else:
         if tokens is None:
             tokens = torch.tensor(tokenizer.encode(prompts))  # (n_seq), tokenizing prompts
@@ -237,53 +262,91 @@ def beam_search(
     generated = generated.float()                             # (b, n_seq, lm_hidden_size)
     assert generated.dim() == 3, 'The dimension of prompts should equal to 3!'
 
-
-    for i in range(max_len):
-        outputs = model(inputs_embeds=generated.type(model.dtype))
-        logits = outputs.logits
-        logits = logits[:, -1, :] / (temperature if temperature > 0 else 1.0)
-        logits = logits.softmax(-1).log()
-        if scores is None:
-            scores, next_tokens = logits.topk(beam_width, -1)
-            generated = generated.expand(beam_width, *generated.shape[1:])
-            next_tokens, scores = next_tokens.permute(1, 0), scores.squeeze(0)
-            if tokens is None:
-                tokens = next_tokens
-            else:
-                tokens = tokens.expand(beam_width, *tokens.shape[1:])
-                tokens = torch.cat((tokens, next_tokens), dim=1)
-        else:
-            logits[is_stopped] = -float(np.inf)
-            logits[is_stopped, 0] = 0
-            scores_sum = scores[:, None] + logits
-            seq_lengths[~is_stopped] += 1
-            scores_sum_average = scores_sum / seq_lengths[:, None]
-            scores_sum_average, next_tokens = scores_sum_average.view(-1).topk(beam_width, -1)
-            # next_tokens_source = torch.floor(torch.div(next_tokens, scores_sum.shape[1])).long()
-            next_tokens_source = torch.div(next_tokens, scores_sum.shape[1], rounding_mode = 'trunc')
-            seq_lengths = seq_lengths[next_tokens_source]
-            next_tokens = next_tokens % scores_sum.shape[1]
-            next_tokens = next_tokens.unsqueeze(1)
-            tokens = tokens[next_tokens_source]
-            tokens = torch.cat((tokens, next_tokens), dim=1)
-            generated = generated[next_tokens_source]
-            scores = scores_sum_average * seq_lengths
-            is_stopped = is_stopped[next_tokens_source]
-        next_token_embed = word_embed(model, next_tokens.squeeze()).view(generated.shape[0], 1, -1)
-        # next_token_embed = model.gpt.transformer.wte(next_tokens.squeeze()).view(generated.shape[0], 1, -1)
-        generated = torch.cat((generated, next_token_embed), dim=1)
-        assert len(eos) == 2 # hack
-        is_stopped = is_stopped + (next_tokens.eq(eos[0]) | next_tokens.eq(eos[1])).squeeze()
+    b, n_seq = generated.shape[:2]
+    if attention_mask is None:
+        attention_mask = torch.ones((b, n_seq), dtype = torch.int64, device = device)
+    attention_mask = attention_mask.to(device = device, dtype = torch.int64)                     # (b, n_seq)
+    # positions are counted from the first valid token so that left padded prefixes share the positions of unpadded ones
+    position_ids = (attention_mask.cumsum(dim = -1) - 1).clamp(min = 0)                        # (b, n_seq)
+
+    # encoding the prefix once, the first beam_width tokens come from the last position of each prefix
+    outputs = model(inputs_embeds = generated.type(model.dtype), attention_mask = attention_mask, position_ids = position_ids, use_cache = True)
+    logits = outputs.logits[:, -1, :] / (temperature if temperature > 0 else 1.0)              # (b, vocab_size)
+    logits = logits.float().log_softmax(dim = -1)
+    scores, next_tokens = logits.topk(beam_width, dim = -1)                                    # (b, beam_width)
+
+    # expanding the cache, mask and positions of each prefix to its beams, i.e., b -> b * beam_width
+    beams = torch.arange(b, device = device).repeat_interleave(beam_width)                     # (b * beam_width)
+    past_key_values = reorder_past_key_values(outputs.past_key_values, beams)
+    attention_mask = attention_mask[beams]                                                     # (b * beam_width, n_seq)
+    positions = position_ids[beams, -1]                                                        # (b * beam_width)
+    offsets = (torch.arange(b, device = device) * beam_width).unsqueeze(dim = 1)               # (b, 1)
+
+    output_tokens = next_tokens.view(-1, 1)                                                    # (b * beam_width, 1)
+    seq_lengths = torch.ones((b, beam_width), device = device)                                 # (b, beam_width)
+    is_stopped = torch.isin(next_tokens, eos)                                                  # (b, beam_width)
+    for _ in range(max_len - 1):
         if is_stopped.all():
             break
+        next_token_embed = word_embed(model, next_tokens.view(-1, 1))                          # (b * beam_width, 1, lm_hidden_size)
+        attention_mask = torch.cat((attention_mask, attention_mask.new_ones((b * beam_width, 1))), dim = 1)
+        positions = positions + 1
+        outputs = model(
+            inputs_embeds = next_token_embed.type(model.dtype),
+            attention_mask = attention_mask,
+            position_ids = positions.unsqueeze(dim = 1),
+            past_key_values = past_key_values,
+            use_cache = True
+        )
+        logits = outputs.logits[:, -1, :] / (temperature if temperature > 0 else 1.0)          # (b * beam_width, vocab_size)
+        logits = logits.float().log_softmax(dim = -1).view(b, beam_width, -1)                  # (b, beam_width, vocab_size)
+        vocab_size = logits.shape[-1]
+
+        # a stopped beam only keeps itself alive (appending token 0 without changing its score or length)
+        logits[is_stopped] = -float(np.inf)
+        logits[is_stopped.nonzero(as_tuple = True) + (0,)] = 0
+        scores_sum = scores.unsqueeze(dim = -1) + logits                                       # (b, beam_width, vocab_size)
+        seq_lengths[~is_stopped] += 1
+        scores_sum_average = scores_sum / seq_lengths.unsqueeze(dim = -1)
+        scores_sum_average, next_tokens = scores_sum_average.view(b, -1).topk(beam_width, dim = -1) # (b, beam_width)
+        next_tokens_source = torch.div(next_tokens, vocab_size, rounding_mode = 'trunc')      # (b, beam_width), beam index within each prefix
+        next_tokens = next_tokens % vocab_size
+
+        # reordering every per-beam state with the selected source beams
+        seq_lengths = seq_lengths.gather(1, next_tokens_source)
+        is_stopped = is_stopped.gather(1, next_tokens_source)
+        scores = scores_sum_average * seq_lengths
+        source = (next_tokens_source + offsets).view(-1)                                       # (b * beam_width), flattened beam index
+        output_tokens = torch.cat((output_tokens[source], next_tokens.view(-1, 1)), dim = 1)
+        past_key_values = reorder_past_key_values(outputs.past_key_values, source)
+        attention_mask = attention_mask[source]
+        positions = positions[source]
+        is_stopped = is_stopped | torch.isin(next_tokens, eos)
+
     scores = scores / seq_lengths
-    output_list = tokens.cpu().numpy()
-    output_texts = [tokenizer.decode(output[:int(length)]) for output, length in zip(output_list, seq_lengths)]
-    order = scores.argsort(descending=True)
-    output_texts = [output_texts[i] for i in order]
+    order = scores.argsort(dim = -1, descending = True)                                        # (b, beam_width)
+    output_list = output_tokens.view(b, beam_width, -1).cpu().tolist()
+    seq_lengths = seq_lengths.long().cpu().tolist()
+    prefix_list = tokens.cpu().tolist() if tokens is not None else [[] for _ in range(b)]
+    output_texts = []
+    for i in range(b):
+        output_texts.append([tokenizer.decode(prefix_list[i] + output_list[i][j][:seq_lengths[i][j]]) for j in order[i].tolist()])
 
+    if b == 1:
+        return output_texts[0]
     return output_texts
 
+def reorder_past_key_values(past_key_values: Tuple[Tuple[torch.Tensor]], indices: torch.Tensor) -> Tuple[Tuple[torch.Tensor]]:
+    """
+    Selecting (and duplicating) the cached key-values of the given sentences, e.g., expanding prefixes to beams or following the selected beams.
+    Args:
+        past_key_values: Tuple[Tuple[(b, h, n_seq, lm_hidden_size/h)]], the first tuple refers to layers and the second tuple refers to key-value pair
+        indices: tensor with shape of (b'), indices of sentences in the batch dimension
+    Return:
+        Tuple[Tuple[(b', h, n_seq, lm_hidden_size/h)]]
+    """
+    return tuple(tuple(item.index_select(0, indices) for item in layer) for layer in past_key_values)
+
 def word_embed(gpt, caption_tokens):
     if hasattr(gpt, 'transformer'):
         embedding_text = gpt.transformer.wte(caption_tokens)
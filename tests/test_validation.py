@@ -0,0 +1,53 @@
+import os
+import sys
+import torch
+import pytest
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip("dalle2_pytorch")  # imported by ClipCap
+
+from main import training_state
+from validation import load_changed_tensors, load_checkpoint_lazily, tensor_digests
+from ClipCap import is_trainable_checkpoint, is_training_state
+
+
+class TinyModel(nn.Module):
+    # standing in for ClipCaptionModel, whose checkpoint is its full state dict
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.mapping_network = nn.Linear(4, 4)
+        self.gpt = nn.Linear(4, 8)
+
+    def checkpoint(self):
+        return self.state_dict()
+
+
+def test_validating_latest_training_state(tmp_path):
+    torch.manual_seed(0)
+    trained = TinyModel()
+    optimizer = torch.optim.AdamW(trained.parameters(), lr=1e-3)
+    trained.gpt(trained.mapping_network(torch.randn(2, 4))).sum().backward()
+    optimizer.step()
+    schedular = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step: 1.0)
+    scaler = torch.cuda.amp.GradScaler(enabled=False)
+    path = str(tmp_path / "coco_prefix_latest.pt")
+    state = training_state(trained, optimizer, schedular, scaler, 1, 3, 5, 7)
+    torch.save(state, path)
+
+    # the sweep in validation.main
+    state_dict = load_checkpoint_lazily(path)
+    assert is_training_state(state_dict)
+    state_dict = state_dict["model"]
+    strict = not is_trainable_checkpoint(state_dict)
+    digests = tensor_digests(path)
+    assert set(digests) == set(trained.state_dict())
+
+    model = TinyModel()
+    changed = load_changed_tensors(model, state_dict, digests, {}, strict)
+    assert changed == len(trained.state_dict())
+    for key, tensor in trained.state_dict().items():
+        assert torch.equal(model.state_dict()[key], tensor)
+    # nothing changed since the same weights were loaded
+    assert load_changed_tensors(model, state_dict, digests, digests, strict) == 0
@@ -1,69 +1,158 @@
-import os
-import clip
-import pickle
-import torch
-
-
-@torch.no_grad()
-def main(device: str, clip_type: str, inpath: str, outpath: str):
-
-    device = device
-    encoder, _ = clip.load(clip_type, device)
-
-    with open(inpath, "rb") as infile:
-        captions_with_entities = pickle.load(
-            infile
-        )  # [[[entity1, entity2, ...], caption], ...]
-
-    for idx in range(len(captions_with_entities)):
-        caption = captions_with_entities[idx][1]
-        tokens = clip.tokenize(caption, truncate=True).to(device)
-        embeddings = encoder.encode_text(tokens).squeeze(dim=0).to("cpu")
-        captions_with_entities[idx].append(embeddings)
-
-    with open(outpath, "wb") as outfile:
-        pickle.dump(captions_with_entities, outfile)
-
-    return captions_with_entities
-
-
-if __name__ == "__main__":
-
-    idx = 1  # change here! 0 -> coco training data, 1 -> flickr30k training data
-    device = "cuda:0"
-    clip_type = "ViT-L/14"  # change here for different clip backbone (ViT-B/32, RN50x4)
-    clip_name = clip_type.replace("/", "")
-
-    inpath = [
-        "../../../dataset/coco/annotations/coco_with_entities.pickle",
-        "../../../dataset/flickr30k/flickr30k_with_entities.pickle",
-    ]
-    outpath = [
-        f"../../../dataset/coco/annotations/coco_texts_features_{clip_name}.pickle",
-        f"../../../dataset/flickr30k/flickr30k_texts_features_{clip_name}.pickle",
-    ]
-
-    if os.path.exists(outpath[idx]):
-        with open(outpath[idx], "rb") as infile:
-            captions_with_features = pickle.load(infile)
-    else:
-        captions_with_features = main(device, clip_type, inpath[idx], outpath[idx])
-
-    import random
-
-    print(f"datasets for {inpath[idx]}")
-    print(f"The length of datasets: {len(captions_with_features)}")
-    caption_with_features = captions_with_features[
-        random.randint(0, len(captions_with_features) - 1)
-    ]
-    detected_entities, caption, caption_features = caption_with_features
-    print(detected_entities, caption, caption_features.size(), caption_features.dtype)
-
-    encoder, _ = clip.load(clip_type, device)
-    with torch.no_grad():
-        embeddings = (
-            encoder.encode_text(clip.tokenize(caption, truncate=True).to(device))
-            .squeeze(dim=0)
-            .to("cpu")
-        )
-    print(abs(embeddings - caption_features).mean())
+import clip
+import torch
+import argparse
+from tqdm import tqdm
+from feature_store import (
+    FeatureStoreWriter,
+    TEXTS_LAYOUT,
+    load_features,
+    load_pickle_frames,
+)
+
+
+def encode_texts(encoder, tokens: torch.Tensor) -> torch.Tensor:
+    """
+    The same as encoder.encode_text, but computing over the shortest context covering the batch instead of all 77 positions.
+    The text transformer of clip is causal and pools the feature at the end of text token, so the padding behind it never changes the result.
+    Args:
+        encoder: clip model
+        tokens: tensor with a shape of (b, 77), clip tokens
+    Return:
+        tensor with a shape of (b, clip_hidden_size)
+    """
+    eot = tokens.argmax(dim=-1)  # (b, ), the end of text token has the largest id
+    context_length = int(eot.max()) + 1
+    tokens = tokens[:, :context_length]
+    x = encoder.token_embedding(tokens).type(encoder.dtype)  # (b, n_ctx, d_model)
+    x = x + encoder.positional_embedding[:context_length].type(encoder.dtype)
+    x = x.permute(1, 0, 2)  # NLD -> LND
+    # causal mask of clip cut to the context
+    attn_mask = (
+        torch.full((context_length, context_length), float("-inf"), device=x.device)
+        .triu_(1)
+        .type(x.dtype)
+    )
+    for block in encoder.transformer.resblocks:
+        y = block.ln_1(x)
+        x = x + block.attn(y, y, y, need_weights=False, attn_mask=attn_mask)[0]
+        x = x + block.mlp(block.ln_2(x))
+    x = x.permute(1, 0, 2)  # LND -> NLD
+    x = encoder.ln_final(x).type(encoder.dtype)
+    return x[torch.arange(x.shape[0]), eot] @ encoder.text_projection
+
+
+@torch.no_grad()
+def main(
+    device: str,
+    clip_type: str,
+    inpath: str,
+    outpath: str,
+    batch_size: int = 1024,
+    chunk_size: int = 65536,
+):
+    """
+    Encoding captions into a feature store at outpath. Captions are processed chunk by chunk: within a chunk they are sorted by
+    their clip token length and encoded in batches, then written back in the original order, so memory stays bounded by a chunk.
+    An interrupted run resumes after the captions flushed to the store, a complete store is returned as is.
+    """
+    device = device
+    encoder, _ = clip.load(clip_type, device)
+
+    # [[[entity1, entity2, ...], caption], ...]
+    captions_with_entities = load_pickle_frames(inpath)
+
+    writer = FeatureStoreWriter(
+        outpath, TEXTS_LAYOUT, encoder.text_projection.shape[-1], resume=True
+    )
+    # rows are written in the order of captions, the store holds a prefix of them
+    encoded = len(writer)
+    if encoded > 0:
+        print(
+            f"resuming {outpath}: {encoded} captions encoded, {len(captions_with_entities) - encoded} left"
+        )
+    progress = tqdm(total=len(captions_with_entities), initial=encoded)
+    for start in range(encoded, len(captions_with_entities), chunk_size):
+        chunk = captions_with_entities[start : start + chunk_size]
+        tokens = clip.tokenize(
+            [caption for _, caption in chunk], truncate=True
+        )  # (chunk_size, 77)
+        # sorting by length to minimize padding in each batch
+        order = tokens.argmax(dim=-1).argsort()
+        embeddings = torch.empty(
+            (len(chunk), encoder.text_projection.shape[-1]), dtype=encoder.dtype
+        )  # (chunk_size, clip_hidden_size)
+        for i in range(0, len(chunk), batch_size):
+            indices = order[i : i + batch_size]
+            batch_embeddings = encode_texts(encoder, tokens[indices].to(device))
+            embeddings[indices] = batch_embeddings.to("cpu")
+            progress.update(len(indices))
+        writer.write(
+            [
+                [detected_entities, caption, embedding]
+                for (detected_entities, caption), embedding in zip(chunk, embeddings)
+            ]
+        )
+        writer.flush()
+    progress.close()
+    writer.close()
+
+    return load_features(outpath)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--idx",
+        type=int,
+        default=1,
+        help="0 -> coco training data, 1 -> flickr30k training data",
+    )
+    parser.add_argument("--device", default="cuda:0")
+    parser.add_argument(
+        "--clip_model",
+        default="ViT-L/14",
+        help="change here for different clip backbone (ViT-B/32, RN50x4)",
+    )
+    parser.add_argument("--batch_size", type=int, default=1024)
+    args = parser.parse_args()
+
+    idx = args.idx  # change here! 0 -> coco training data, 1 -> flickr30k training data
+    device = args.device
+    # change here for different clip backbone (ViT-B/32, RN50x4)
+    clip_type = args.clip_model
+    clip_name = clip_type.replace("/", "")
+
+    inpath = [
+        "../../../dataset/coco/annotations/coco_with_entities.pickle",
+        "../../../dataset/flickr30k/flickr30k_with_entities.pickle",
+    ]
+    # feature stores, i.e., directories named as the former pickles without '.pickle'
+    outpath = [
+        f"../../../dataset/coco/annotations/coco_texts_features_{clip_name}",
+        f"../../../dataset/flickr30k/flickr30k_texts_features_{clip_name}",
+    ]
+
+    # continuing a partially written store, never taking it as the whole datasets
+    captions_with_features = main(
+        device, clip_type, inpath[idx], outpath[idx], args.batch_size
+    )
+
+    import random
+
+    print(f"datasets for {inpath[idx]}")
+    print(f"The length of datasets: {len(captions_with_features)}")
+    caption_with_features = captions_with_features[
+        random.randint(0, len(captions_with_features) - 1)
+    ]
+    detected_entities, caption, caption_features = caption_with_features
+    print(detected_entities, caption, caption_features.size(), caption_features.dtype)
+
+    encoder, _ = clip.load(clip_type, device)
+    with torch.no_grad():
+        embeddings = (
+            encoder.encode_text(clip.tokenize(caption, truncate=True).to(device))
+            .squeeze(dim=0)
+            .to("cpu")
+        )
+    print(abs(embeddings - caption_features).mean())
@@ -1,7 +1,7 @@
 import math
 import torch
 import random
-from typing import List, Tuple, Union
+from typing import Collection, List, Tuple, Union
         
 def noise_injection(x, variance = 0.001, device = 'cuda:0') -> torch.Tensor:
     """
@@ -24,9 +24,9 @@ def noise_injection(x, variance = 0.001, device = 'cuda:0') -> torch.Tensor:
 def entities_process(
     args,
     detected_entities: List[str],  # [man, dog, park]
-    stopwords: List[str],
-    people_vocabs: List[str],
-    objects_vocabs: List[str],
+    stopwords: Collection[str],    # frozensets are preferred for O(1) membership tests
+    people_vocabs: Collection[str],
+    objects_vocabs: Collection[str],
 ) -> List[str]:
     process_entities = []
     for i in range(len(detected_entities)):
@@ -55,7 +55,12 @@ def entities_process(
 def compose_discrete_prompts(
     tokenizer,
     process_entities: List[str],
+    prompts_cache = None,
 ) -> torch.Tensor:
+    # prompts_cache: DiscretePromptsCache assembling the same tokens from cached pieces, None -> tokenizing the whole prompt
+
+    if prompts_cache is not None:
+        return prompts_cache(process_entities)
 
     prompt_head = 'There are'
     prompt_tail = ' in image.'
@@ -73,13 +78,59 @@ def compose_discrete_prompts(
 
     return entities_tokens
 
+class DiscretePromptsCache:
+
+    def __init__(self, tokenizer) -> None:
+        """
+        Assembling the tokens of hard prompts from cached pieces instead of tokenizing the whole prompt, i.e.,
+        tokens('There are e1, e2 in image.') = tokens('There are') + tokens(' e1') + tokens(',') + tokens(' e2') + tokens(' in image.'),
+        which holds for byte-level BPE (gpt2, opt) as it never merges across ' word' or punctuation boundaries.
+        Each entity is tokenized once, when first seen, and checked against the tokenizer. An entity breaking the rule
+        (or any entity of a tokenizer breaking it) falls back to tokenizing the whole prompt.
+        """
+        self.tokenizer = tokenizer
+        self.head = tokenizer.encode('There are')                                   # with special tokens if any, e.g., </s> of opt
+        self.tail = tokenizer.encode(' in image.', add_special_tokens = False)
+        self.comma = tokenizer.encode(',', add_special_tokens = False)
+        self.without_entities = compose_discrete_prompts(tokenizer, [])              # 'There are something in image.'
+        self.pieces = {}                                                             # {entity: tokens of ' ' + entity or None}
+
+    def piece(self, entity: str) -> List[int]:
+        if entity not in self.pieces:
+            piece = self.tokenizer.encode(' ' + entity, add_special_tokens = False)
+            # covering every boundary an entity may have: 'There are' | entity | ',' | entity | ' in image.'
+            expected = self.head + piece + self.comma + piece + self.tail
+            if self.tokenizer.encode('There are ' + entity + ', ' + entity + ' in image.') != expected:
+                piece = None
+            self.pieces[entity] = piece
+        return self.pieces[entity]
+
+    def __call__(self, process_entities: List[str]) -> torch.Tensor:
+        """
+        Return:
+            tensor with a shape of (discrete_prompt_length, ), the same as compose_discrete_prompts(tokenizer, process_entities)
+        """
+        if len(process_entities) == 0:
+            return self.without_entities.clone()
+        tokens = list(self.head)
+        for i, entity in enumerate(process_entities):
+            piece = self.piece(entity)
+            if piece is None:
+                return compose_discrete_prompts(self.tokenizer, process_entities)
+            if i > 0:
+                tokens += self.comma
+            tokens += piece
+        tokens += self.tail
+        return torch.tensor(tokens)
+
 def parse_entities(
     args,
     tokenizer,
     detected_entities: Tuple[str],      # [[man, dog, park, ...], len = batch size
-    stopwords: List[str],
-    people_vocabs: List[str],
-    objects_vocabs: List[str],
+    stopwords: Collection[str],
+    people_vocabs: Collection[str],
+    objects_vocabs: Collection[str],
+    prompts_cache: DiscretePromptsCache = None,
 ) -> List[torch.Tensor]:
     # List[(n_seq1, ), (n_seq2, ), ...]
 
@@ -90,7 +141,7 @@ def parse_entities(
         process_entities = list(set(process_entities)) # list
 
         # tokenizing
-        discrete_tokens.append(compose_discrete_prompts(tokenizer, process_entities))
+        discrete_tokens.append(compose_discrete_prompts(tokenizer, process_entities, prompts_cache))
 
     return discrete_tokens
 
@@ -99,8 +150,12 @@ def padding_captions(
     captions_tokens: torch.Tensor,   # (batch_size, caption_seq)
     masks: torch.Tensor,             # (batch_size, caption_seq)
     discrete_tokens: List[torch.Tensor] = None, # len = batch_size, [(n_seq1, ), (n_seq2, ), ...]
+    max_length: int = None,
 ) -> Union[torch.Tensor, torch.Tensor, torch.Tensor, List]:
     """
+    Args:
+        max_length: the length (without soft prompts) that hard prompts + captions are padded or truncated to,
+                    2 * max_num_of_entities - 1 + prompt_template_length + caption_seq by default
     Return:
         captions_tokens:
         captions_tokens_for_loss:
@@ -114,48 +169,93 @@ def padding_captions(
         return captions_tokens, captions_tokens_for_loss, masks
 
     else: # discrete tokens
-        captions_tokens_with_hard_prompts = None
-        captions_tokens_for_loss = None
-        padding_masks = None
-        hard_prompts_length = []
-        max_length = 2 * args.max_num_of_entities - 1 + args.prompt_template_length + captions_tokens.shape[-1] # max length without soft prompt
-        for i in range(len(discrete_tokens)):
-            tokens = torch.cat((discrete_tokens[i], captions_tokens[i]))
-            loss_tokens = torch.cat((torch.zeros((len(discrete_tokens[i])), dtype = torch.int64), captions_tokens[i]))
-            padding = max_length - len(tokens)
-            if padding > 0:
-                tokens = torch.cat((tokens, torch.zeros((padding), dtype = torch.int64)))
-                loss_tokens = torch.cat((loss_tokens, torch.zeros((padding), dtype = torch.int64)))
-            tokens = tokens[:max_length].unsqueeze(dim = 0) # (1, max_length)
-            if args.only_hard_prompt:
-                loss_tokens = loss_tokens[:max_length]
-            else:
-                loss_tokens = torch.cat((torch.zeros((args.continuous_prompt_length), dtype = torch.int64), loss_tokens[:max_length]))
-            loss_tokens = torch.cat((loss_tokens[1:], torch.zeros((1), dtype = torch.int64))).unsqueeze(dim = 0) # (1, max_length + continuous_prompt_length)
-            if captions_tokens_with_hard_prompts is None:
-                captions_tokens_with_hard_prompts = tokens
-                captions_tokens_for_loss = loss_tokens
-            else:
-                captions_tokens_with_hard_prompts = torch.cat((captions_tokens_with_hard_prompts, tokens), dim = 0)
-                captions_tokens_for_loss = torch.cat((captions_tokens_for_loss, loss_tokens), dim = 0)
-
-            hard_prompts_length.append(len(discrete_tokens[i]))
-            if padding > 0:
-                if args.only_hard_prompt:
-                    temp_masks = torch.cat((torch.ones(hard_prompts_length[-1]).float(), masks[i], torch.zeros(padding).float()))
-                else:
-                    temp_masks = torch.cat((torch.ones(hard_prompts_length[-1] + args.continuous_prompt_length).float(), masks[i], torch.zeros(padding).float()))
-            else:
-                if args.only_hard_prompt:
-                    temp_masks = torch.cat((torch.ones(hard_prompts_length[-1]).float(), masks[i]))
-                else:
-                    temp_masks = torch.cat((torch.ones(hard_prompts_length[-1] + args.continuous_prompt_length).float(), masks[i]))
-            if args.only_hard_prompt:
-                temp_masks = temp_masks[:max_length].unsqueeze(dim = 0)
-            else:
-                temp_masks = temp_masks[:max_length + args.continuous_prompt_length].unsqueeze(dim = 0)
-            if padding_masks is None:
-                padding_masks = temp_masks
-            else:
-                padding_masks = torch.cat((padding_masks, temp_masks), dim = 0)
-        return captions_tokens_with_hard_prompts, captions_tokens_for_loss, padding_masks, hard_prompts_length
\ No newline at end of file
+        # all rows are written into tensors preallocated with the final shape, i.e., row i = [hard prompt i, caption i, padding]
+        batch_size, caption_seq = captions_tokens.shape
+        soft_length = 0 if args.only_hard_prompt else args.continuous_prompt_length
+        if max_length is None:
+            max_length = 2 * args.max_num_of_entities - 1 + args.prompt_template_length + caption_seq # max length without soft prompt
+        hard_prompts_length = torch.tensor([len(tokens) for tokens in discrete_tokens], dtype = torch.int64) # (batch_size, )
+
+        # hard prompts: (sum of hard prompts length, ) -> positions [0, hard_prompts_length[i]) of row i
+        hard_prompts_rows = torch.repeat_interleave(torch.arange(batch_size), hard_prompts_length)
+        hard_prompts_cols = torch.arange(len(hard_prompts_rows)) - torch.repeat_interleave(hard_prompts_length.cumsum(dim = 0) - hard_prompts_length, hard_prompts_length)
+        hard_prompts_valid = hard_prompts_cols < max_length # truncating to max_length
+        # captions: (batch_size, caption_seq) -> positions [hard_prompts_length[i], hard_prompts_length[i] + caption_seq) of row i
+        captions_rows = torch.arange(batch_size).unsqueeze(dim = 1).expand(-1, caption_seq)
+        captions_cols = hard_prompts_length.unsqueeze(dim = 1) + torch.arange(caption_seq).unsqueeze(dim = 0)
+        captions_valid = captions_cols < max_length
+
+        captions_tokens_with_hard_prompts = torch.zeros((batch_size, max_length), dtype = torch.int64) # (batch_size, max_length)
+        captions_tokens_with_hard_prompts[hard_prompts_rows[hard_prompts_valid], hard_prompts_cols[hard_prompts_valid]] = torch.cat(discrete_tokens)[hard_prompts_valid]
+        captions_tokens_with_hard_prompts[captions_rows[captions_valid], captions_cols[captions_valid]] = captions_tokens[captions_valid]
+
+        # targets are captions behind the soft prompts and hard prompts, shifted left by one token (the first token is dropped if it is at position 0)
+        captions_tokens_for_loss = torch.zeros((batch_size, soft_length + max_length), dtype = torch.int64) # (batch_size, soft_length + max_length)
+        loss_cols = soft_length + captions_cols - 1
+        loss_valid = captions_valid & (loss_cols >= 0)
+        captions_tokens_for_loss[captions_rows[loss_valid], loss_cols[loss_valid]] = captions_tokens[loss_valid]
+
+        # masks: ones for soft prompts and hard prompts, then masks of captions, then zeros for padding
+        padding_masks = (torch.arange(soft_length + max_length).unsqueeze(dim = 0) < (soft_length + hard_prompts_length).unsqueeze(dim = 1)).to(masks.dtype)
+        padding_masks[captions_rows[captions_valid], soft_length + captions_cols[captions_valid]] = masks[captions_valid]
+
+        return captions_tokens_with_hard_prompts, captions_tokens_for_loss, padding_masks, hard_prompts_length.tolist()
+
+def pack_sequences(
+    lengths: List[int],     # the length of each sequence
+    max_packed_length: int, # the maximum length of a packed row
+) -> Tuple[List[int], List[int], int, int]:
+    """
+    Packing sequences into as few rows as possible (first fit decreasing), a sequence longer than max_packed_length takes a row alone.
+    Return:
+        rows: the packed row of each sequence
+        starts: the start position of each sequence in its row
+        num_of_rows: the number of packed rows
+        packed_length: the length of the longest packed row
+    """
+    rows = [0] * len(lengths)
+    starts = [0] * len(lengths)
+    used = [] # the used length of each row
+    for i in sorted(range(len(lengths)), key = lambda i: lengths[i], reverse = True):
+        for row in range(len(used)):
+            if used[row] + lengths[i] <= max_packed_length:
+                break
+        else: # opening a new row
+            row = len(used)
+            used.append(0)
+        rows[i], starts[i] = row, used[row]
+        used[row] += lengths[i]
+    return rows, starts, len(used), max(used, default = 0)
+
+def compose_prefix_embeddings(
+    continuous_embeddings: torch.Tensor,                # (batch_size, continuous_prompt_length, lm_hidden_size)
+    discrete_embeddings: List[torch.Tensor] = None,     # len = batch_size, [(n_seq1, lm_hidden_size), (n_seq2, lm_hidden_size), ...]
+    soft_prompt_first: bool = False,
+    only_hard_prompt: bool = False,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Composing the prefix of each sample (soft prompts and/or hard prompts) and left padding them to the same length for batched decoding.
+    Return:
+        embeddings: tensor with a shape of (batch_size, max_prefix_length, lm_hidden_size), padding positions are filled with 0
+        masks: tensor with a shape of (batch_size, max_prefix_length), 1 for valid prefix and 0 for padding
+    """
+    if discrete_embeddings is None: # soft prompts only, all prefixes share the same length
+        masks = torch.ones(continuous_embeddings.shape[:2], dtype = torch.int64, device = continuous_embeddings.device)
+        return continuous_embeddings, masks
+
+    prefixes = []
+    for i in range(len(discrete_embeddings)):
+        if only_hard_prompt:
+            prefixes.append(discrete_embeddings[i])
+        elif soft_prompt_first:
+            prefixes.append(torch.cat((continuous_embeddings[i], discrete_embeddings[i]), dim = 0))
+        else:
+            prefixes.append(torch.cat((discrete_embeddings[i], continuous_embeddings[i]), dim = 0))
+
+    max_length = max(len(prefix) for prefix in prefixes)
+    embeddings = prefixes[0].new_zeros((len(prefixes), max_length, prefixes[0].shape[-1]))
+    masks = torch.zeros((len(prefixes), max_length), dtype = torch.int64, device = prefixes[0].device)
+    for i, prefix in enumerate(prefixes):
+        embeddings[i, max_length - len(prefix):] = prefix
+        masks[i, max_length - len(prefix):] = 1
+    return embeddings, masks
@@ -4,132 +4,292 @@ import json
 import clip
 import torch
 import pickle
+import zipfile
 import argparse
 from tqdm import tqdm
-from PIL import Image
-from typing import List
-from ClipCap import ClipCaptionModel
+from ClipCap import ClipCaptionModel, is_trainable_checkpoint, is_training_state
+from feature_store import features_path, load_features
+from images_prefetcher import prefetch_image_batches
 from transformers import AutoTokenizer
-from utils import compose_discrete_prompts
-from load_annotations import load_entities_text
-from search import greedy_search, beam_search, opt_search
-from retrieval_categories import (
-    clip_texts_embeddings,
-    image_text_simiarlity,
-    top_k_categories,
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from utils import (
+    DiscretePromptsCache,
+    compose_discrete_prompts,
+    compose_prefix_embeddings,
+)
+from embeddings_cache import (
+    add_retrieval_args,
+    build_vocabulary,
+    cache_key,
+    save_atomically,
 )
+from search import greedy_search, beam_search, opt_search
+from retrieval_categories import VocabularyIndex
+
+
+@torch.no_grad()
+def caption_images(
+    args,
+    image_features: torch.Tensor,  # (b, clip_hidden_size), normalized
+    vocabulary: VocabularyIndex,  # normalized entities embeddings of vocabulary
+    model: ClipCaptionModel,  # trained language model
+    tokenizer: AutoTokenizer,  # tokenizer
+    prompts_cache: DiscretePromptsCache = None,
+    indices: Optional[
+        List[int]
+    ] = None,  # indices of the images, keys of retrieval_cache
+    retrieval_cache: Optional["RetrievalCache"] = None,
+) -> List[str]:
+    """
+    Captioning a batch of images: the mapping network, retrieval and hard prompts run on the whole batch,
+    then the left padded prefixes are decoded together by a batched search.
+    Return:
+        [caption1, caption2, ...], len = b
+    """
+    continuous_embeddings = model.mapping_network(image_features).view(
+        -1, args.continuous_prompt_length, model.gpt_hidden_size
+    )  # (b, continuous_prompt_length, gpt_hidden_size)
+    discrete_embeddings = None
+    if args.using_hard_prompt:
+        discrete_tokens = None
+        if retrieval_cache is not None:
+            discrete_tokens = retrieval_cache.get(indices)
+        if discrete_tokens is None:
+            _, detected_objects, _ = vocabulary.query(
+                image_features, args.top_k, args.threshold, args.temperature
+            )  # List[List[]], [[category1, category2, ...], [], ...]
+            discrete_tokens = [
+                compose_discrete_prompts(tokenizer, objects, prompts_cache)
+                for objects in detected_objects
+            ]  # [(n_seq1, ), (n_seq2, ), ...]
+            if retrieval_cache is not None:
+                retrieval_cache.update(indices, discrete_tokens)
+        # embedding the hard prompts of the whole batch at once
+        discrete_embeddings = model.word_embed(
+            torch.cat(discrete_tokens).to(args.device)
+        ).split([len(tokens) for tokens in discrete_tokens])
+    # prefixes with different lengths are left padded and masked
+    embeddings, masks = compose_prefix_embeddings(
+        continuous_embeddings,
+        discrete_embeddings,
+        args.soft_prompt_first,
+        args.only_hard_prompt,
+    )
+
+    if "gpt" in args.language_model:
+        if not args.using_greedy_search:
+            sentences = beam_search(
+                embeddings=embeddings,
+                attention_mask=masks,
+                tokenizer=tokenizer,
+                beam_width=args.beam_width,
+                model=model.gpt,
+            )  # List[str] for a single image, List[List[str]] for a batch
+            if len(embeddings) == 1:
+                sentences = [sentences]
+            sentences = [sentence[0] for sentence in sentences]  # selected top 1
+        else:
+            sentences = greedy_search(
+                embeddings=embeddings,
+                attention_mask=masks,
+                tokenizer=tokenizer,
+                model=model.gpt,
+            )
+            if len(embeddings) == 1:
+                sentences = [sentences]
+    else:
+        # opt_search does not take padding masks, decoding the unpadded prefix of each image
+        sentences = []
+        for i in range(len(embeddings)):
+            sentence = opt_search(
+                prompts=args.text_prompt,
+                embeddings=embeddings[i : i + 1, masks[i].bool()],
+                tokenizer=tokenizer,
+                beam_width=args.beam_width,
+                model=model.gpt,
+            )
+            sentences.append(sentence[0])
+    return sentences
+
+
+def image_features_batches(
+    args,
+    annotations: Sequence,  # rows of pre-extracted features, or entries aligned with images_path
+    features_index: int = 1,  # position of the features in each row of pre-extracted features
+    images_path: Optional[
+        List[str]
+    ] = None,  # the image of each entry, when not using image features
+    preprocess: clip = None,  # processor of the image
+    encoder: clip = None,  # clip backbone
+) -> Iterator[Tuple[List[int], torch.Tensor]]:
+    """
+    Return:
+        iterator of (indices, image_features), indices of the entries in annotations and their normalized image features
+        with a shape of (b, clip_hidden_size), b <= args.batch_size (images failed to load are reported and left out)
+    """
+    if args.using_image_features:
+        for start in range(0, len(annotations), args.batch_size):
+            rows = annotations[start : start + args.batch_size]
+            image_features = torch.stack(
+                [row[features_index] for row in rows], dim=0
+            ).float()
+            image_features = image_features.to(args.device)  # (b, clip_hidden_size)
+            image_features /= image_features.norm(2, dim=-1, keepdim=True)
+            yield list(range(start, start + len(rows))), image_features
+        return
+
+    # decoding and preprocessing the next images in background threads while the current batch is computed
+    indices = {image_path: idx for idx, image_path in enumerate(images_path)}
+    batches = prefetch_image_batches(
+        images_path, preprocess, args.batch_size, args.num_workers
+    )
+    for batch_path, images, failures in batches:
+        for image_path, error in failures:
+            print(f"failed to load {image_path}: {error}")
+        if images is None:
+            continue
+        images = images.to(args.device)  # (b, 3, 224, 224)
+        image_features = encoder.encode_image(images).float()  # (b, clip_hidden_size)
+        image_features /= image_features.norm(2, dim=-1, keepdim=True)
+        yield [indices[image_path] for image_path in batch_path], image_features
+
+
+class RetrievalCache:
+
+    def __init__(self, path: str) -> None:
+        """
+        The hard prompt tokens of each image depend on the image features, the vocabulary and the hyperparameters of retrieval only,
+        so they are computed by the first checkpoint of a sweep and reused by the others (and by reruns through the persisted pickle).
+        Args:
+            path: pickle of {index of image: [token1, token2, ...]}, loaded if existing
+        """
+        self.path = path
+        self.tokens = {}
+        if os.path.exists(path):
+            with open(path, "rb") as infile:
+                self.tokens = {
+                    idx: torch.tensor(tokens, dtype=torch.int64)
+                    for idx, tokens in pickle.load(infile).items()
+                }
+        self.updated = False
+
+    def get(self, indices: List[int]) -> Optional[List[torch.Tensor]]:
+        # Return: [(n_seq1, ), (n_seq2, ), ...], None if any of the images is missing
+        if all(idx in self.tokens for idx in indices):
+            return [self.tokens[idx] for idx in indices]
+        return None
+
+    def update(self, indices: List[int], discrete_tokens: List[torch.Tensor]) -> None:
+        for idx, tokens in zip(indices, discrete_tokens):
+            self.tokens[idx] = tokens
+        self.updated = True
+
+    def save(self) -> None:
+        if self.updated:
+            save_atomically(
+                {idx: tokens.tolist() for idx, tokens in self.tokens.items()},
+                self.path,
+            )
+            self.updated = False
+
+
+def retrieval_cache_path(
+    args,
+    inpath: str,  # path of annotations file (or feature store directory)
+    embeddings_path: str,  # the cache entry of the vocabulary, addressed by its content
+) -> str:
+    # e.g., retrieval_<sha1>.pickle, next to the entities embeddings
+    files = (
+        [inpath]
+        if os.path.isfile(inpath)
+        else sorted(os.path.join(inpath, name) for name in os.listdir(inpath))
+    )
+    key = cache_key(
+        [
+            [os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)]
+            for path in files
+        ],
+        None if args.using_image_features else args.image_folder,
+        os.path.basename(embeddings_path),
+        [args.ann, args.ann_nlist, args.ann_nprobe, args.ann_pq_m],
+        [args.top_k, args.threshold, args.temperature],
+        args.language_model,
+    )
+    return os.path.join(args.embeddings_cache_dir, f"retrieval_{key}.pickle")
 
 
 def validation_nocaps(
     args,
     inpath: str,  # path of annotations file
-    entities_text: List[str],  # entities texts of vocabulary
-    texts_embeddings: torch.Tensor,  # entities embeddings of vocabulary
+    vocabulary: VocabularyIndex,  # normalized entities embeddings of vocabulary
     model: ClipCaptionModel,  # trained language model
     tokenizer: AutoTokenizer,  # tokenizer
     preprocess: clip = None,  # processor of the image
     encoder: clip = None,  # clip backbone
+    retrieval_cache: Optional[
+        RetrievalCache
+    ] = None,  # hard prompts shared by checkpoints
 ) -> None:
 
-    device = args.device
+    prompts_cache = DiscretePromptsCache(tokenizer)
+    images_path = None
     if args.using_image_features:
-        with open(inpath, "rb") as infile:
-            annotations = pickle.load(
-                infile
-            )  # [[image_path, image_split, image_features, [caption1, captions2, ...]], ...]
+        # pickle or feature store directory
+        annotations = load_features(
+            inpath
+        )  # [[image_path, image_split, image_features, [caption1, captions2, ...]], ...]
     else:
         with open(inpath, "r") as infile:
             annotations = json.load(
                 infile
             )  # [{'split': 'near_domain', 'image_id': '4499.jpg', 'caption': [caption1, caption2, ...]}, ...]
+        images_path = [
+            args.image_folder + annotation["split"] + "/" + annotation["image_id"]
+            for annotation in annotations
+        ]
 
     indomain = []
     neardomain = []
     outdomain = []
     overall = []
-    for idx, annotation in tqdm(enumerate(annotations)):
-        if args.using_image_features:
-            image_id, split, image_features, captions = annotation
-            image_features = image_features.float().unsqueeze(dim=0).to(device)
-        else:
-            image_id = annotation["image_id"]
-            split = annotation["split"]
-            captions = annotation["caption"]
-            image_path = args.image_folder + split + "/" + image_id
-            image = preprocess(Image.open(image_path)).unsqueeze(dim=0).to(device)
-            image_features = encoder.encode_image(image).float()
-
-        image_features /= image_features.norm(2, dim=-1, keepdim=True)
-        continuous_embeddings = model.mapping_network(image_features).view(
-            -1, args.continuous_prompt_length, model.gpt_hidden_size
+    progress = tqdm(total=len(annotations))
+    for indices, image_features in image_features_batches(
+        args, annotations, 2, images_path, preprocess, encoder
+    ):
+        sentences = caption_images(
+            args,
+            image_features,
+            vocabulary,
+            model,
+            tokenizer,
+            prompts_cache,
+            indices,
+            retrieval_cache,
         )
-        if args.using_hard_prompt:
-            logits = image_text_simiarlity(
-                texts_embeddings,
-                temperature=args.temperature,
-                images_features=image_features,
-            )
-            detected_objects, _ = top_k_categories(
-                entities_text, logits, args.top_k, args.threshold
-            )  # List[List[]], [[category1, category2, ...], [], ...]
-            detected_objects = detected_objects[
-                0
-            ]  # infering single image -> List[category1, category2, ...]
-            discrete_tokens = (
-                compose_discrete_prompts(tokenizer, detected_objects)
-                .unsqueeze(dim=0)
-                .to(args.device)
-            )
-
-            discrete_embeddings = model.word_embed(discrete_tokens)
-            if args.only_hard_prompt:
-                embeddings = discrete_embeddings
-            elif args.soft_prompt_first:
-                embeddings = torch.cat(
-                    (continuous_embeddings, discrete_embeddings), dim=1
-                )
-            else:
-                embeddings = torch.cat(
-                    (discrete_embeddings, continuous_embeddings), dim=1
-                )
-        else:
-            embeddings = continuous_embeddings
-
-        if "gpt" in args.language_model:
-            if not args.using_greedy_search:
-                sentence = beam_search(
-                    embeddings=embeddings,
-                    tokenizer=tokenizer,
-                    beam_width=args.beam_width,
-                    model=model.gpt,
-                )  # List[str]
-                sentence = sentence[0]  # selected top 1
+        for idx, sentence in zip(indices, sentences):
+            if args.using_image_features:
+                image_id, split, _, captions = annotations[idx]
             else:
-                sentence = greedy_search(
-                    embeddings=embeddings, tokenizer=tokenizer, model=model.gpt
-                )
-        else:
-            sentence = opt_search(
-                prompts=args.text_prompt,
-                embeddings=embeddings,
-                tokenizer=tokenizer,
-                beam_width=args.beam_width,
-                model=model.gpt,
-            )
-            sentence = sentence[0]
-
-        predict = {}
-        predict["split"] = split
-        predict["image_name"] = image_id
-        predict["captions"] = captions
-        predict["prediction"] = sentence
-        overall.append(predict)
-        if split == "in_domain":
-            indomain.append(predict)
-        elif split == "near_domain":
-            neardomain.append(predict)
-        elif split == "out_domain":
-            outdomain.append(predict)
+                image_id = annotations[idx]["image_id"]
+                split = annotations[idx]["split"]
+                captions = annotations[idx]["caption"]
+
+            predict = {}
+            predict["split"] = split
+            predict["image_name"] = image_id
+            predict["captions"] = captions
+            predict["prediction"] = sentence
+            overall.append(predict)
+            if split == "in_domain":
+                indomain.append(predict)
+            elif split == "near_domain":
+                neardomain.append(predict)
+            elif split == "out_domain":
+                outdomain.append(predict)
+        progress.update(len(indices))
+    progress.close()
+    if retrieval_cache is not None:
+        retrieval_cache.save()
     out_path = args.out_path if args.out_path else args.weight_path
     with open(os.path.join(out_path, f"overall.json"), "w") as outfile:
         json.dump(overall, outfile, indent=4)
@@ -144,118 +304,64 @@ def validation_nocaps(
 def validation_coco_flickr30k(
     args,
     inpath: str,  # path of annotations file
-    entities_text: List[str],  # entities texts of vocabulary
-    texts_embeddings: torch.Tensor,  # entities embeddings of vocabulary
+    vocabulary: VocabularyIndex,  # normalized entities embeddings of vocabulary
     model: ClipCaptionModel,  # trained language model
     tokenizer: AutoTokenizer,  # tokenizer
     preprocess: clip = None,  # processor of the image
     encoder: clip = None,  # clip backbone
+    retrieval_cache: Optional[
+        RetrievalCache
+    ] = None,  # hard prompts shared by checkpoints
     tag: int = 0,
 ) -> None:
 
-    device = args.device
+    prompts_cache = DiscretePromptsCache(tokenizer)
+    images_path = None
     if args.using_image_features:
-        with open(inpath, "rb") as infile:
-            annotations = pickle.load(
-                infile
-            )  # [[image_path, image_features, [caption1, caption2, ...]], ...]
+        # pickle or feature store directory
+        annotations = load_features(
+            inpath
+        )  # [[image_path, image_features, [caption1, caption2, ...]], ...]
     else:
         with open(inpath, "r") as infile:
             annotations = json.load(infile)  # {image_path: [caption1, caption2, ...]}
+        annotations = list(
+            annotations.items()
+        )  # [(image_path, [caption1, caption2, ...]), ...]
 
     if args.debug:
         annotations = annotations[:500]
-    predicts = []
-    for idx, item in tqdm(enumerate(annotations)):
-        if args.using_image_features:
-            image_id, image_features, captions = item
-            image_features = (
-                image_features.float().unsqueeze(dim=0).to(device)
-            )  # (1, clip_hidden_size)
-        else:
-            image_id = item
-            captions = annotations[item]
-            image_path = args.image_folder + image_id
-            image = preprocess(Image.open(image_path)).unsqueeze(dim=0).to(device)
-            image_features = encoder.encode_image(image).float()
+    if not args.using_image_features:
+        images_path = [args.image_folder + image_id for image_id, _ in annotations]
 
-        image_features /= image_features.norm(2, dim=-1, keepdim=True)
-
-        # 比较图像编码和相应描述使用prior采样后的相似度
-        # test_caption = captions[0]
-        # clip_tokens = clip.tokenize(test_caption, truncate=True).to(device)
-        # priored_samlpe = model.prior.sample(
-        #     clip_tokens,
-        #     num_samples_per_batch=1,
-        # )
-        # priored_samlpe /= priored_samlpe.norm(dim=-1, keepdim=True)
-        # image_features = priored_samlpe
-
-        continuous_embeddings = model.mapping_network(image_features).view(
-            -1, args.continuous_prompt_length, model.gpt_hidden_size
+    predicts = []
+    progress = tqdm(total=len(annotations))
+    for indices, image_features in image_features_batches(
+        args, annotations, 1, images_path, preprocess, encoder
+    ):
+        sentences = caption_images(
+            args,
+            image_features,
+            vocabulary,
+            model,
+            tokenizer,
+            prompts_cache,
+            indices,
+            retrieval_cache,
         )
-        if args.using_hard_prompt:
-            logits = image_text_simiarlity(
-                texts_embeddings,
-                temperature=args.temperature,
-                images_features=image_features,
-            )
-            detected_objects, _ = top_k_categories(
-                entities_text, logits, args.top_k, args.threshold
-            )  # List[List[]], [[category1, category2, ...], [], ...]
-            detected_objects = detected_objects[
-                0
-            ]  # infering single image -> List[category1, category2, ...]
-            discrete_tokens = (
-                compose_discrete_prompts(tokenizer, detected_objects)
-                .unsqueeze(dim=0)
-                .to(args.device)
-            )
+        for idx, sentence in zip(indices, sentences):
+            image_id, captions = annotations[idx][0], annotations[idx][-1]
 
-            discrete_embeddings = model.word_embed(discrete_tokens)
-            if args.only_hard_prompt:
-                embeddings = discrete_embeddings
-            elif args.soft_prompt_first:
-                embeddings = torch.cat(
-                    (continuous_embeddings, discrete_embeddings), dim=1
-                )
-            else:
-                embeddings = torch.cat(
-                    (discrete_embeddings, continuous_embeddings), dim=1
-                )
-        else:
-            embeddings = continuous_embeddings
-
-        if "gpt" in args.language_model:
-            if not args.using_greedy_search:
-                sentence = beam_search(
-                    embeddings=embeddings,
-                    tokenizer=tokenizer,
-                    beam_width=args.beam_width,
-                    model=model.gpt,
-                )  # List[str]
-                sentence = sentence[0]  # selected top 1
-            else:
-                sentence = greedy_search(
-                    embeddings=embeddings, tokenizer=tokenizer, model=model.gpt
-                )
-        else:
-            sentence = opt_search(
-                prompts=args.text_prompt,
-                embeddings=embeddings,
-                tokenizer=tokenizer,
-                beam_width=args.beam_width,
-                model=model.gpt,
-            )
-            sentence = sentence[0]
-
-        predict = {}
-        predict["split"] = "valid"
-        predict["image_name"] = image_id
-        predict["captions"] = captions
-        predict["prediction"] = sentence
-        predicts.append(predict)
-    # print("dis_loss: ", dis_loss / len(annotations))
+            predict = {}
+            predict["split"] = "valid"
+            predict["image_name"] = image_id
+            predict["captions"] = captions
+            predict["prediction"] = sentence
+            predicts.append(predict)
+        progress.update(len(indices))
+    progress.close()
+    if retrieval_cache is not None:
+        retrieval_cache.save()
     # 检查路径是否存在
     out_path = args.out_path if args.out_path else args.weight_path
     if not os.path.exists(out_path):
@@ -265,6 +371,100 @@ def validation_coco_flickr30k(
         json.dump(predicts, outfile, indent=4)
 
 
+class TensorDigestUnpickler(pickle.Unpickler):
+    # unpickling data.pkl of a checkpoint with (storage key, storage offset, size, stride) in place of each tensor
+
+    def persistent_load(self, saved_id):
+        return saved_id[2]  # ('storage', storage_type, key, location, numel)
+
+    def find_class(self, module, name):
+        if module == "torch._utils" and name.startswith("_rebuild_tensor"):
+            return self.tensor_view
+        return super().find_class(module, name)
+
+    @staticmethod
+    def tensor_view(key, storage_offset, size, stride, *args) -> Tuple:
+        return key, storage_offset, tuple(size), tuple(stride)
+
+
+def tensor_digests(path: str) -> Optional[Dict[str, Optional[Tuple]]]:
+    """
+    Identifying each tensor of a checkpoint without reading its data, by the crc32 and size of its storage record (kept in the
+    zip directory by torch.save) and the view of the tensor on that storage.
+    Return:
+        {key: digest} of the state dict (the 'state_dict' of a trainable checkpoint, within the 'model' of a training state),
+        a digest is None if saved without crc32, None for a legacy (non-zip) checkpoint
+    """
+    if not zipfile.is_zipfile(path):
+        return None
+    with zipfile.ZipFile(path) as archive:
+        records = {}  # storage key -> (crc32, size)
+        data_pkl = None
+        for info in archive.infolist():
+            directory, name = os.path.split(info.filename)
+            if name == "data.pkl":
+                data_pkl = info.filename
+            elif os.path.basename(directory) == "data":
+                # torch.save can skip computing crc32 (torch.serialization.set_crc32_options)
+                records[name] = (info.CRC, info.file_size) if info.CRC != 0 else None
+        with archive.open(data_pkl) as infile:
+            checkpoint = TensorDigestUnpickler(infile).load()
+    if is_training_state(checkpoint):  # e.g., <prefix>_latest.pt
+        checkpoint = checkpoint["model"]
+    if is_trainable_checkpoint(checkpoint):
+        checkpoint = checkpoint["state_dict"]
+    digests = {}
+    for key, (storage, *view) in checkpoint.items():
+        digests[key] = None if records[storage] is None else (records[storage], *view)
+    return digests
+
+
+def load_checkpoint_lazily(path: str) -> Dict[str, Any]:
+    # tensors are memory-mapped and only read from disk once copied, torch < 2.1 and legacy checkpoints are loaded fully
+    try:
+        return torch.load(path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        return torch.load(path, map_location="cpu")
+
+
+@torch.no_grad()
+def load_changed_tensors(
+    model: ClipCaptionModel,
+    state_dict: Dict[str, torch.Tensor],
+    digests: Dict[str, Optional[Tuple]],
+    previous: Dict[str, Optional[Tuple]],
+    strict: bool = True,
+) -> int:
+    """
+    Loading a checkpoint as strictly as load_state_dict, but copying into the model only the tensors differing from the previous
+    checkpoint, e.g., only the mapping network when sweeping checkpoints trained with a frozen language model.
+    Args:
+        state_dict: the checkpoint to load, on cpu (memory-mapped)
+        digests: tensor_digests of state_dict, a tensor without digest is always copied
+        previous: digests of the checkpoint loaded last, {} at first
+        strict: False -> tensors missing from a trainable checkpoint keep the pretrained weights
+    Return:
+        the number of tensors copied
+    """
+    model_state = model.state_dict()  # sharing the storage of parameters and buffers
+    missing = [key for key in model_state if key not in state_dict]
+    if not strict:  # unless a full checkpoint loaded before has overwritten them
+        missing = [key for key in missing if key in previous]
+    unexpected = [key for key in state_dict if key not in model_state]
+    if len(missing) > 0 or len(unexpected) > 0:
+        raise RuntimeError(
+            f"Error(s) in loading state_dict, missing keys: {missing}, unexpected keys: {unexpected}"
+        )
+    changed = 0
+    for key, tensor in state_dict.items():
+        digest = digests.get(key)
+        if digest is not None and previous.get(key) == digest:
+            continue
+        model_state[key].copy_(tensor)
+        changed += 1
+    return changed
+
+
 @torch.no_grad()
 def main(args) -> None:
     # initializing
@@ -274,92 +474,9 @@ def main(args) -> None:
     clip_hidden_size = 512 if args.clip_model == "ViT-B/32" else 768
     # clip_hidden_size = 640 if "RN" in args.clip_model else 512
 
-    # loading categories vocabulary for objects
-    if args.name_of_entities_text == "visual_genome_entities":
-        entities_text = load_entities_text(
-            args.name_of_entities_text,
-            "../../../dataset/annotations/all_objects_attributes_relationships.pickle",
-            not args.disable_all_entities,
-        )
-        if args.prompt_ensemble:  # loading ensemble embeddings
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/visual_genome_embedding_{clip_name}_with_ensemble.pickle",
-            )
-        else:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/visual_genome_embedding_{clip_name}.pickle",
-            )
-    elif args.name_of_entities_text == "coco_entities":
-        entities_text = load_entities_text(
-            args.name_of_entities_text,
-            "../../../dataset/annotations/coco_categories.json",
-            not args.disable_all_entities,
-        )
-        if args.prompt_ensemble:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/coco_embeddings_{clip_name}_with_ensemble.pickle",
-            )
-        else:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/coco_embeddings_{clip_name}.pickle",
-            )
-    elif args.name_of_entities_text == "open_image_entities":
-        entities_text = load_entities_text(
-            args.name_of_entities_text,
-            "../../../dataset/annotations/oidv7-class-descriptions-boxable.csv",
-            not args.disable_all_entities,
-        )
-        if args.prompt_ensemble:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/open_image_embeddings_{clip_name}_with_ensemble.pickle",
-            )
-        else:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/open_image_embeddings_{clip_name}.pickle",
-            )
-    elif args.name_of_entities_text == "vinvl_vg_entities":
-        entities_text = load_entities_text(
-            args.name_of_entities_text,
-            "../../../dataset/annotations/VG-SGG-dicts-vgoi6-clipped.json",
-            not args.disable_all_entities,
-        )
-        if args.prompt_ensemble:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/vg_embeddings_{clip_name}_with_ensemble.pickle",
-            )
-        else:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/vg_embeddings_{clip_name}.pickle",
-            )
-    elif args.name_of_entities_text == "vinvl_vgoi_entities":
-        entities_text = load_entities_text(
-            args.name_of_entities_text,
-            "../../../dataset/annotations/vgcocooiobjects_v1_class2ind.json",
-            not args.disable_all_entities,
-        )
-        if args.prompt_ensemble:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/vgoi_embeddings_{clip_name}_with_ensemble.pickle",
-                device=device,
-                clip_type=args.clip_model,
-            )
-        else:
-            texts_embeddings = clip_texts_embeddings(
-                entities_text,
-                f"../../../dataset/annotations/vgoi_embeddings_{clip_name}.pickle",
-            )
-    else:
-        print("The entities text should be input correctly!")
-        return
+    # loading categories vocabulary for objects (exact or approximate index)
+    # normalized once and kept on device, shared by all weights
+    vocabulary, embeddings_path = build_vocabulary(args, device)
 
     # loading model
     tokenizer = AutoTokenizer.from_pretrained(args.language_model)
@@ -381,56 +498,84 @@ def main(args) -> None:
             if f.endswith(".pt") and not f.endswith("latest.pt")
         ]
 
+    if not args.using_image_features:
+        inpath = args.path_of_val_datasets
+    else:
+        inpath = (
+            args.path_of_val_datasets[:-5] + f"_{clip_name}.pickle"
+        )  # file with image features
+        inpath = features_path(inpath)  # or the converted feature store
+    # retrieved entities do not depend on checkpoints, hard prompts are computed once for the whole sweep
+    retrieval_cache = None
+    if args.using_hard_prompt:
+        retrieval_cache = RetrievalCache(
+            retrieval_cache_path(args, inpath, embeddings_path)
+        )
+
+    # the language model and clip are loaded once for the whole sweep
+    model.to(device)
+    if not args.using_image_features:
+        encoder, preprocess = clip.load(args.clip_model, device=device)
+
     counter = 0
+    previous = {}  # only the digests of the last checkpoint are kept, not its tensors
     for file in weight_files:
-        model.load_state_dict(torch.load(file, map_location=device))
+        state_dict = load_checkpoint_lazily(file)
+        if is_training_state(state_dict):  # e.g., <prefix>_latest.pt
+            state_dict = state_dict["model"]
+        strict = not is_trainable_checkpoint(state_dict)
+        if not strict:  # mapping network only
+            state_dict = state_dict["state_dict"]
+        digests = tensor_digests(file)
+        if digests is None:
+            digests = dict.fromkeys(state_dict)
+        changed = load_changed_tensors(model, state_dict, digests, previous, strict)
+        previous = digests
         # 只保留文件名
         file = file.split("/")[-1]
-        model.to(device)
-        if not args.using_image_features:
-            encoder, preprocess = clip.load(args.clip_model, device=device)
-            inpath = args.path_of_val_datasets
-        else:
-            inpath = (
-                args.path_of_val_datasets[:-5] + f"_{clip_name}.pickle"
-            )  # file with image features
+        print(f"{file}: {changed}/{len(state_dict)} tensors changed and loaded")
         if args.name_of_datasets == "nocaps":  # nocaps
             if args.using_image_features:
                 validation_nocaps(
-                    args, inpath, entities_text, texts_embeddings, model, tokenizer
+                    args,
+                    inpath,
+                    vocabulary,
+                    model,
+                    tokenizer,
+                    retrieval_cache=retrieval_cache,
                 )
             else:
                 validation_nocaps(
                     args,
                     inpath,
-                    entities_text,
-                    texts_embeddings,
+                    vocabulary,
                     model,
                     tokenizer,
                     preprocess,
                     encoder,
+                    retrieval_cache,
                 )
         else:  # coco, flickr30k
             if args.using_image_features:
                 validation_coco_flickr30k(
                     args,
                     inpath,
-                    entities_text,
-                    texts_embeddings,
+                    vocabulary,
                     model,
                     tokenizer,
+                    retrieval_cache=retrieval_cache,
                     tag=args.name_of_datasets + "-" + str(counter),
                 )
             else:
                 validation_coco_flickr30k(
                     args,
                     inpath,
-                    entities_text,
-                    texts_embeddings,
+                    vocabulary,
                     model,
                     tokenizer,
                     preprocess,
                     encoder,
+                    retrieval_cache,
                     tag=args.name_of_datasets + "-" + str(counter),
                 )
         counter += 1
@@ -448,6 +593,7 @@ if __name__ == "__main__":
     parser.add_argument("--temperature", type=float, default=0.01)
     parser.add_argument("--top_k", type=int, default=3)
     parser.add_argument("--threshold", type=float, default=0.4)
+    add_retrieval_args(parser, prompt_ensemble=True)
     parser.add_argument(
         "--using_image_features",
         action="store_true",
@@ -463,24 +609,6 @@ if __name__ == "__main__":
         "--path_of_val_datasets",
         default="../../../dataset/flickr30k/test_captions.json",
     )
-    parser.add_argument(
-        "--disable_all_entities",
-        action="store_true",
-        default=False,
-        help="whether to use entities with a single word only",
-    )
-    parser.add_argument(
-        "--name_of_entities_text",
-        default="vinvl_vgoi_entities",
-        choices=(
-            "visual_genome_entities",
-            "coco_entities",
-            "open_image_entities",
-            "vinvl_vg_entities",
-            "vinvl_vgoi_entities",
-        ),
-    )
-    parser.add_argument("--prompt_ensemble", action="store_true", default=True)
     parser.add_argument(
         "--weight_path",
         default="eval/",
@@ -492,6 +620,18 @@ if __name__ == "__main__":
         "--image_folder", default="../../../dataset/flickr30k/flickr30k-images/"
     )
     parser.add_argument("--out_path", default="")
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="number of threads decoding images when not using image features",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=32,
+        help="number of images mapped, retrieved and decoded together",
+    )
     parser.add_argument("--using_hard_prompt", action="store_true", default=True)
     parser.add_argument("--soft_prompt_first", action="store_true", default=True)
     parser.add_argument("--only_hard_prompt", action="store_true", default=False)